@@ -0,0 +1,125 @@
+import threading
+import time
+
+# Stages that only matter for their latest message per device; batch stages are always admitted
+COLLAPSIBLE_STAGES = ("live", "boot")
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class AdmissionController:
+    """Decides which incoming messages are processed now and which are shed.
+
+    Each device has a token bucket of `burst` messages refilled at `rate` per second,
+    and pressure() reports how full the ingest queues are (0.0 - 1.0).  A live or boot
+    message is admitted when its device has a token and pressure is below high_water;
+    otherwise it is parked as the device's latest message of that stage, replacing any
+    older one still parked.  take_parked() hands parked messages back once their device
+    has tokens again and pressure has dropped.  Batch messages bypass the buckets and
+    are never dropped here.
+    """
+
+    def __init__(self, rate=2.0, burst=10.0, high_water=0.7, pressure=None):
+        self.rate = rate
+        self.burst = burst
+        self.high_water = high_water
+        self._pressure = pressure or (lambda: 0.0)
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._parked = {}  # dispatcher key -> item, in parking order
+
+        self._admitted = 0
+        self._rate_limited = 0
+        self._pressure_limited = 0
+        self._superseded = 0
+        self._released = 0
+        self._batch = 0
+        self._max_pressure = 0.0
+
+    def _take_token(self, device_id, now):
+        if self.rate <= 0:
+            return True
+        bucket = self._buckets.get(device_id)
+        if bucket is None:
+            bucket = self._buckets[device_id] = _Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens >= 1.0:
+            bucket.tokens -= 1.0
+            return True
+        return False
+
+    def pressure(self):
+        try:
+            return float(self._pressure())
+        except Exception:
+            return 0.0
+
+    def admit(self, key, stage, item, device_id):
+        """True when item should be processed now; False when it was parked"""
+        if stage not in COLLAPSIBLE_STAGES:
+            with self._lock:
+                self._batch += 1
+            return True
+
+        pressure = self.pressure()
+        with self._lock:
+            if pressure > self._max_pressure:
+                self._max_pressure = pressure
+            has_token = self._take_token(device_id, time.monotonic())
+            if has_token and pressure < self.high_water:
+                if self._parked.pop(key, None) is not None:
+                    self._superseded += 1  # a newer message made the parked one stale
+                self._admitted += 1
+                return True
+
+            if not has_token:
+                self._rate_limited += 1
+            else:
+                self._pressure_limited += 1
+            if self._parked.pop(key, None) is not None:
+                self._superseded += 1
+            self._parked[key] = (item, device_id)
+            return False
+
+    def take_parked(self):
+        """Parked items that may be processed now, longest-parked first"""
+        if not self._parked or self.pressure() >= self.high_water:
+            return []
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for key, (item, device_id) in list(self._parked.items()):
+                if self._take_token(device_id, now):
+                    del self._parked[key]
+                    ready.append(item)
+            self._released += len(ready)
+        return ready
+
+    def stats(self):
+        pressure = self.pressure()
+        with self._lock:
+            return {
+                "pressure": round(pressure, 3),
+                "pressure_max": round(max(self._max_pressure, pressure), 3),
+                "high_water": self.high_water,
+                "overloaded": pressure >= self.high_water,
+                "rate_per_device": self.rate,
+                "burst_per_device": self.burst,
+                "admitted": self._admitted,
+                "batch_admitted": self._batch,
+                "shed_rate_limited": self._rate_limited,
+                "shed_over_high_water": self._pressure_limited,
+                "shed_superseded": self._superseded,
+                "parked": len(self._parked),
+                "released": self._released,
+                "devices_tracked": len(self._buckets),
+            }
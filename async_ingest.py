@@ -0,0 +1,428 @@
+"""asyncio ingest process: the same MQTT pipeline as ingest.py without a thread per wait.
+
+One event loop drives an async MQTT client (aiomqtt), a pooled async Postgres driver
+(psycopg 3 with psycopg_pool) and an async HTTP client (aiohttp) for Overpass road
+lookups.  Messages are routed exactly like server.on_message and run as coroutines
+through an AsyncOrderedDispatcher, so messages of one device stay in order while up
+to ASYNC_INGEST_CONCURRENCY of them are in flight.
+
+    pip install -r requirements-async.txt
+    python async_ingest.py
+
+The pure pipeline code in server.py (validation, sessions, spool, distance and event
+detection) is reused as is.  What blocks is moved off the loop: database writes and
+Overpass requests are awaited, and the CPU part of a batch runs in the default
+executor.  Reference data is served from the in-memory cache; only an unknown
+vehicle or driver costs a synchronous lookup, which is cached negatively after that.
+Batch sessions are saved at END rather than streamed (INCREMENTAL_BATCH), as the
+streaming path writes through psycopg2.
+
+The Flask routes stay on gunicorn.  Set INGEST_STATUS_PORT to serve server.app from
+a thread of this process for its own status endpoints.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+from collections import namedtuple
+
+import aiohttp
+import aiomqtt
+import numpy as np
+import paho.mqtt.client as mqtt
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+import compact_upload
+import metrics
+import server
+from dispatch import AsyncOrderedDispatcher, QueueFull
+from event_sink import EventSink
+from live_buffer import AsyncLiveWriteBuffer
+from logs import device_context
+from positions import newest_rows, upsert_sql as positions_upsert_sql
+
+log = logging.getLogger("async_ingest")
+
+ASYNC_INGEST_CONCURRENCY = int(os.getenv("ASYNC_INGEST_CONCURRENCY", "64"))
+OVERPASS_CONCURRENCY = int(os.getenv("OVERPASS_CONCURRENCY", "4"))
+MQTT_RECONNECT_DELAY = float(os.getenv("MQTT_RECONNECT_DELAY", "5"))
+SESSION_EXPIRY_POLL = 5.0
+
+GPS_INSERT_SQL = """
+    INSERT INTO GPSData (vehicle_id, driver_id, timestamp, lat, lon, speed)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (vehicle_id, driver_id, timestamp) DO NOTHING
+"""
+LIVE_INSERT_SQL = """
+    INSERT INTO GPSData_live (vehicle_id, driver_id, timestamp, lat, lon, speed)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+# Only valid once the gpsdata_live_unique index exists, as in server.write_live_rows
+LIVE_CONFLICT_SQL = "ON CONFLICT (vehicle_id, driver_id, timestamp) DO NOTHING"
+POSITIONS_UPSERT_SQL = positions_upsert_sql("(%s, %s, %s, %s, %s, %s)")
+EVENTS_INSERT_SQL = """
+    INSERT INTO events (vehicle_id, driver_id, timestamp, lat, lon, event_type)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+"""
+MILEAGE_SQL = """
+    UPDATE vehicles
+    SET total_milage = total_milage + %s
+    WHERE id = %s
+"""
+
+PublishResult = namedtuple("PublishResult", "rc mid")
+
+
+def db_conninfo():
+    return make_conninfo(
+        host=os.getenv("DB_HOST"),
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        port=os.getenv("DB_PORT", "5432"),
+        sslmode=os.getenv("DB_SSLMODE", "require"),
+    )
+
+
+class AsyncPublisher:
+    """paho-style publish()/is_connected() backed by the aiomqtt client.
+
+    Installed as server.mqtt_client, so send_confirmation, send_driver_list and
+    publish_async work unchanged: publish() returns at once with a message id, and
+    server.on_publish is called with that id when the broker acknowledges it.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._loop_thread = threading.get_ident()  # created on the loop
+        self._client = None
+        self._mids = itertools.count(1)
+        self._tasks = set()
+
+    def attach(self, client):
+        self._client = client
+
+    def detach(self):
+        self._client = None
+
+    def is_connected(self):
+        return self._client is not None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        client = self._client
+        if client is None:
+            return PublishResult(mqtt.MQTT_ERR_NO_CONN, 0)
+        mid = next(self._mids)
+        send = self._send(client, topic, payload, qos, retain, mid)
+        if threading.get_ident() == self._loop_thread:
+            task = self._loop.create_task(send)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(send, self._loop)
+        return PublishResult(mqtt.MQTT_ERR_SUCCESS, mid)
+
+    async def _send(self, client, topic, payload, qos, retain, mid):
+        try:
+            # Returns once the broker has acknowledged a QoS 1/2 message
+            await client.publish(topic, payload, qos=qos, retain=retain)
+        except aiomqtt.MqttError as e:
+            log.error(f"❌ Publish to {topic} failed: {e}")
+            return
+        server.on_publish(None, None, mid)
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=5)
+
+
+class AsyncIngest:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.db = AsyncConnectionPool(
+            db_conninfo(),
+            min_size=int(os.getenv("DB_POOL_MIN", "1")),
+            max_size=int(os.getenv("DB_POOL_MAX", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            open=False,
+        )
+        self.http = None
+        self.overpass_slots = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+        self.publisher = AsyncPublisher(self.loop)
+        self.dispatcher = AsyncOrderedDispatcher(
+            self.process_message,
+            concurrency=ASYNC_INGEST_CONCURRENCY,
+            max_queue=int(os.getenv("INGEST_QUEUE_MAX", "10000")),
+            name="async-ingest",
+        )
+        self.live_buffer = AsyncLiveWriteBuffer(
+            self.write_live_rows,
+            max_batch=server.live_buffer.max_batch,
+            max_delay=server.live_buffer.max_delay,
+            max_pending=server.live_buffer.max_pending,
+        )
+
+    # ------------------ lifecycle ------------------
+
+    async def start(self):
+        server.ingest_running.set()
+        # The helpers in server.py publish, buffer and report through these module globals
+        server.mqtt_client = self.publisher
+        server.message_dispatcher = self.dispatcher
+        server.live_buffer = self.live_buffer
+        server.INCREMENTAL_BATCH = False
+
+        await self.db.open()
+        self.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        await asyncio.to_thread(server.recover_sessions)
+        try:
+            # psycopg2 pool for the reference cache and the sync fallbacks
+            await asyncio.to_thread(server.db_pool.warm)
+            await asyncio.to_thread(server.ensure_schema)
+        except Exception as e:
+            log.error(f"❌ Database pool warm-up failed: {e}")
+        server.reference_data.start()
+        server.notification_feed.start()
+        self.dispatcher.start()
+        self.live_buffer.start()
+
+    async def stop(self):
+        await self.dispatcher.join()
+        self.dispatcher.stop()
+        await self.publisher.drain()
+        await self.live_buffer.aclose()
+        await self.http.close()
+        await self.db.close()
+
+    async def expire_sessions(self):
+        while True:
+            await asyncio.sleep(SESSION_EXPIRY_POLL)
+            for key in server.data_sessions.expire_due():
+                if server.session_spool:
+                    server.session_spool.remove(key)
+                log.info(f"🧹 Cleaning expired session: {key}")
+
+    async def release_parked(self):
+        while True:
+            await asyncio.sleep(server.ADMISSION_RELEASE_INTERVAL)
+            for key, stage, topic, data, device_id in server.admission.take_parked():
+                try:
+                    await self.dispatcher.submit(key, stage, topic, data, device_id,
+                                                 timeout=server.submit_timeout(stage))
+                except QueueFull as e:
+                    log.error(f"❌ Dropping parked MQTT message on {topic}: {e}")
+
+    async def run_mqtt(self):
+        topics = server.ingest_subscriptions()
+        while True:
+            try:
+                async with aiomqtt.Client(server.MQTT_HOST, server.MQTT_PORT, client_id=server.MQTT_CLIENT_ID,
+                                          clean_session=True, keepalive=60) as client:
+                    self.publisher.attach(client)
+                    log.info("✅ Connected to MQTT broker")
+                    async with client.messages() as messages:
+                        await client.subscribe([(topic, 0) for topic in topics])
+                        log.info(f"✅ Subscribed to MQTT topics (including live GPS): {', '.join(topics)}")
+                        async for message in messages:
+                            await self.on_message(message.topic.value, message.payload)
+            except aiomqtt.MqttError as e:
+                log.error(f"❌ MQTT connection lost: {e}; reconnecting in {MQTT_RECONNECT_DELAY:.0f}s")
+            finally:
+                self.publisher.detach()
+            await asyncio.sleep(MQTT_RECONNECT_DELAY)
+
+    # ------------------ messages ------------------
+
+    async def on_message(self, topic, payload):
+        try:
+            routed = server.route_message(topic, payload)
+            if routed is not None:
+                key, stage, data, device_id = routed
+                if server.admission.admit(key, stage, (key, stage, topic, data, device_id), device_id):
+                    await self.dispatcher.submit(key, stage, topic, data, device_id,
+                                                 timeout=server.submit_timeout(stage))
+        except json.JSONDecodeError:
+            log.error("❌ Invalid JSON received")
+        except compact_upload.ChunkError as e:
+            log.error(f"❌ Invalid batch chunk on {topic}: {e}")
+        except QueueFull as e:
+            log.error(f"❌ Dropping MQTT message on {topic}: {e}")
+        except Exception as e:
+            log.error(f"❌ MQTT Error: {e}")
+
+    async def process_message(self, topic, data, device_id):
+        with device_context(device_id):
+            if topic.endswith("/chunk"):
+                closing = []
+                server.handle_batch_chunk(data, device_id, finish=lambda *args: closing.append(args))
+                for args in closing:
+                    await self.finish_batch_session(*args)
+            elif (topic == "gps/driver001" or topic.endswith("/batch")) and data.get('time', '') == "END":
+                driver_id = data.get('driver_id', '').strip()
+                log.info(f"📥 Received END marker for {device_id} - {driver_id}")
+                await self.finish_batch_session(device_id, driver_id, f"{device_id}_{driver_id}")
+            elif topic.endswith("/boot") or topic.endswith("/notifications/ack"):
+                # Notification delivery may load the device's cursor and queue from Postgres
+                await asyncio.to_thread(server.process_message, topic, data, device_id)
+            else:
+                # Live and batch START/points only touch memory, the spool and the publisher
+                server.process_message(topic, data, device_id)
+
+    async def finish_batch_session(self, device_id, driver_id, session_key):
+        """server.finish_batch_session with the save awaited instead of blocking"""
+        try:
+            session = server.close_batch_session(device_id, driver_id, session_key)
+            if session is None:
+                return
+            result = await self.save_gps_data(device_id, driver_id, session.points())
+            server.confirm_batch_session(device_id, driver_id, session_key, result)
+        except Exception as e:
+            server.batch_session_failed(device_id, driver_id, e)
+
+    # ------------------ batch pipeline ------------------
+
+    async def save_gps_data(self, device_id, driver_id, gps_points):
+        """server.save_gps_data_to_db with the database and Overpass calls awaited"""
+        with metrics.timer("save_gps_data_async"):
+            return await self._save_gps_data(device_id, driver_id, gps_points)
+
+    async def _save_gps_data(self, device_id, driver_id, gps_points):
+        schema = await asyncio.to_thread(server.ensure_schema)
+        if not (server.GPS_BULK_INSERT and schema.get("gpsdata_unique") and schema.get("events_unique")):
+            # Row-by-row duplicate checks are left to the psycopg2 path
+            return await asyncio.to_thread(server.save_gps_data_to_db, device_id, driver_id, gps_points)
+
+        log.info(f"🔄 Starting to save {len(gps_points)} GPS points to database...")
+        if not await asyncio.to_thread(server.verify_device_exists, device_id):
+            log.error(f"❌ Device verification failed: {device_id}")
+            return False, "error_invalid_device"
+        if not await asyncio.to_thread(server.verify_driver_exists, driver_id):
+            log.error(f"❌ Driver verification failed: {driver_id}")
+            return False, "error_invalid_driver"
+
+        await self.prefetch_road_types(gps_points)
+        sink = EventSink()
+        distance_traveled = await asyncio.to_thread(self.analyse, gps_points, device_id, driver_id, sink)
+        rows = server.gps_point_rows(device_id, driver_id, gps_points)
+
+        try:
+            async with self.db.connection() as conn:
+                async with conn.transaction():
+                    async with conn.cursor() as cursor:
+                        await cursor.executemany(GPS_INSERT_SQL, rows)
+                        inserted_count = cursor.rowcount if rows else 0
+                        events = sink.rows()
+                        if events:
+                            await cursor.executemany(EVENTS_INSERT_SQL, events)
+                            sink.inserted += cursor.rowcount
+                            sink.duplicates += len(events) - cursor.rowcount
+                        if distance_traveled > 0:
+                            await cursor.execute(MILEAGE_SQL, (distance_traveled, device_id))
+        except Exception as e:
+            log.error(f"❌ Critical database error in save_gps_data: {e}")
+            return False, "error_database"
+
+        skipped_count = len(gps_points) - inserted_count
+        log.info(f"✅ Database operation completed: {inserted_count} inserted, "
+                 f"{skipped_count} skipped as duplicates, 0 errors")
+        log.info(f"🚨 Events: {sink.inserted} inserted, {sink.duplicates} duplicates dropped")
+        log.info(f"📊 Batch summary: {distance_traveled:.2f} km traveled, events detected and vehicle mileage updated")
+        if len(gps_points) > 0:
+            return True, f"success_saved_{len(gps_points)}_points_distance_{distance_traveled:.2f}km"
+        return False, "error_no_valid_points"
+
+    @staticmethod
+    def analyse(gps_points, device_id, driver_id, sink):
+        """Distance, overspeed and harsh-event detection; CPU only once road types are cached"""
+        distance_traveled = server.calculate_distance_and_check_events(gps_points, device_id, driver_id, sink=sink)
+        log.info(f"📏 Distance traveled in batch: {distance_traveled:.2f} km")
+        server.detect_harsh_events(gps_points, device_id, driver_id, sink=sink)
+        return distance_traveled
+
+    async def prefetch_road_types(self, gps_points):
+        """Load the road types the offline index does not cover, OVERPASS_CONCURRENCY at a time"""
+        lats = np.fromiter((point['lat'] for point in gps_points), dtype=np.float64, count=len(gps_points))
+        lons = np.fromiter((point['lon'] for point in gps_points), dtype=np.float64, count=len(gps_points))
+        missing = await asyncio.to_thread(uncached_road_keys, lats[1:], lons[1:])
+        if missing:
+            await asyncio.gather(*(self.load_road_type(key, lat, lon) for key, (lat, lon) in missing.items()))
+
+    async def load_road_type(self, key, lat, lon):
+        async with self.overpass_slots:
+            try:
+                with metrics.timer("overpass_request"):
+                    async with self.http.post(server.OVERPASS_URL, data=server.overpass_query(lat, lon)) as response:
+                        if response.status == 200:
+                            road_type, negative = server.road_type_from_overpass(
+                                await response.json(content_type=None))
+                        else:
+                            road_type, negative = "Other Roads", True
+            except Exception as e:
+                log.error(f"❌ Error getting road type for {lat},{lon}: {e}")
+                road_type, negative = "Other Roads", True
+        server.road_type_cache.put(key, road_type, negative)
+
+    # ------------------ live points ------------------
+
+    async def write_live_rows(self, rows):
+        schema = await asyncio.to_thread(server.ensure_schema)
+        sql = LIVE_INSERT_SQL + LIVE_CONFLICT_SQL if schema.get("gpsdata_live_unique") else LIVE_INSERT_SQL
+        async with self.db.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(sql, rows)
+        if schema.get("latest_positions"):
+            # As server.publish_positions: the live points are stored, so this never raises
+            try:
+                async with self.db.connection() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.executemany(POSITIONS_UPSERT_SQL, newest_rows(rows))
+            except Exception as e:
+                log.warning(f"⚠️ Could not update latest_positions: {e}")
+
+
+def uncached_road_keys(lats, lons):
+    """{cache_key: (lat, lon)} for points outside the offline index that are not cached"""
+    missing = {}
+    for lat, lon in zip(lats.tolist(), lons.tolist()):
+        if server.road_index is not None and server.road_index.covers(lat, lon):
+            continue
+        key = f"{lat:.4f},{lon:.4f}"
+        if key not in missing and server.road_type_cache.get(key) is None:
+            missing[key] = (lat, lon)
+    return missing
+
+
+async def main():
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+
+    log.info(f"🚀 Starting async MQTT ingest {server.MQTT_CLIENT_ID} "
+             f"(shard {server.INGEST_SHARD_INDEX + 1}/{server.INGEST_SHARDS}, "
+             f"batch routing {server.INGEST_BATCH_ROUTING})")
+    ingest = AsyncIngest()
+    await ingest.start()
+
+    status_port = os.getenv("INGEST_STATUS_PORT")
+    if status_port:
+        threading.Thread(target=server.app.run, kwargs={"host": "0.0.0.0", "port": int(status_port)},
+                         daemon=True).start()
+
+    tasks = [asyncio.create_task(ingest.run_mqtt()), asyncio.create_task(ingest.expire_sessions()),
+             asyncio.create_task(ingest.release_parked())]
+    await stopped.wait()
+    log.info("🛑 Async ingest shutting down")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await ingest.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1 @@
+"""Offline micro-benchmarks and load tools for the GPS server."""
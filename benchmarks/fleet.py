@@ -0,0 +1,492 @@
+"""Fleet load generator: N simulated devices against a real MQTT broker.
+
+    python -m benchmarks.fleet --ramp 10,50,100,200,400
+    python -m benchmarks.fleet --ramp 100 --step-seconds 300 --serve postgres
+    python -m benchmarks.fleet --serve none --host mqtt.internal --ramp 50,100
+
+Every device boots (gps/<id>/boot), sends a live point on live/gps/<id> every
+--live-interval seconds and, every --batch-interval seconds, uploads a trip as a
+START / points / END session on gps/<id>/batch (or as compact chunks on gps/<id>/chunk
+with --chunks).  The tool measures
+
+  * confirmation latency: END (or the last chunk) to device/<id>/confirmation;
+    a session without a confirmation after --confirm-timeout counts as timed out
+  * live insert lag: live publish to the GPSData_live write that contains the point
+    (only when the server runs in this process, see --serve)
+
+The device count is ramped through --ramp, --step-seconds per step.  A step is
+healthy when nothing timed out or failed, the p99 confirmation latency and p99 live
+lag stay under their SLOs and no more than --max-live-loss of the live points went
+missing; the first unhealthy step is the saturation point.
+
+--serve stub (the default) runs the server in this process on the stand-ins of
+benchmarks/standins.py, so only MQTT is real; --serve postgres runs it against the
+database configured in the environment; --serve none measures a server started
+elsewhere (confirmations only).  Start a local broker first, e.g. `mosquitto -p 1883`.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from benchmarks import standins
+from benchmarks.trips import PKT, synthetic_trip
+from compact_upload import encode
+from session_store import parse_timestamp
+
+DEFAULT_RAMP = (10, 25, 50, 100, 200, 400)
+LIVE_TRACK_POINTS = 3600
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    if not values:
+        return [None] * len(qs)
+    return [round(float(v) * 1000, 1) for v in np.percentile(values, qs)]
+
+
+class StepStats:
+    """What one ramp step observed; shared by the scheduler and MQTT callback threads"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.duration = 0.0
+        self.messages = 0
+        self.sessions = 0
+        self.confirmations = []  # END -> confirmation seconds
+        self.confirm_errors = 0
+        self.timeouts = 0
+        self.live_sent = 0
+        self.live_lags = []  # publish -> GPSData_live write seconds
+        self.pressure_max = 0.0
+
+    def summary(self, server_stats=None):
+        confirm = percentiles(self.confirmations)
+        lag = percentiles(self.live_lags)
+        return {
+            "devices": self.devices,
+            "seconds": round(self.duration, 1),
+            "messages_per_sec": round(self.messages / self.duration, 1) if self.duration else 0.0,
+            "sessions": self.sessions,
+            "confirmed": len(self.confirmations),
+            "confirm_errors": self.confirm_errors,
+            "timeouts": self.timeouts,
+            "confirm_p50_ms": confirm[0], "confirm_p95_ms": confirm[1], "confirm_p99_ms": confirm[2],
+            "live_sent": self.live_sent,
+            "live_written": len(self.live_lags),
+            "live_lag_p50_ms": lag[0], "live_lag_p95_ms": lag[1], "live_lag_p99_ms": lag[2],
+            "ingest_pressure_max": round(self.pressure_max, 3),
+            "server": server_stats,
+        }
+
+
+class Device:
+    def __init__(self, index, args, rng):
+        self.id = f"{args.prefix}{index:05d}"
+        self.driver_id = str(1 + index % 2)
+        self.rng = rng
+        self.args = args
+        self.live_track = None
+        self.live_index = 0
+        self.trip_started = datetime.now(PKT).replace(microsecond=0) - timedelta(days=1, seconds=index)
+        self.upload_ids = itertools.count(1)
+        self.awaiting = None  # (END sent at, StepStats) while the upload waits for its confirmation
+
+    def next_live_point(self):
+        if self.live_track is None:
+            self.live_track = synthetic_trip(LIVE_TRACK_POINTS, seed=zlib.crc32(self.id.encode()))
+        point = self.live_track[self.live_index % LIVE_TRACK_POINTS]
+        self.live_index += 1
+        return point
+
+    def next_trip(self):
+        """A trip continuing where the previous upload stopped, so sessions never overlap"""
+        trip = synthetic_trip(self.args.batch_points, seed=self.rng.randrange(1 << 30),
+                              timestamp_format=self.args.timestamp_format, started=self.trip_started)
+        self.trip_started += timedelta(seconds=self.args.batch_points + 60)
+        return trip
+
+
+class Fleet:
+    """Devices spread over a few publisher connections plus one confirmation subscriber"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.devices = []
+        self.stats = StepStats(0)
+        self.live_sent = {}  # (device_id, timestamp) -> (publish time, StepStats), for the live lag
+        self.live_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        self.subscriber = self._client("sub", on_message=self.on_confirmation,
+                                       on_connect=lambda c, u, f, rc: c.subscribe("device/+/confirmation", qos=1))
+        self.publishers = [self._client(f"pub-{k}") for k in range(args.connections)]
+        self.schedules = [[] for _ in self.publishers]  # heaps of (due, seq, action, device)
+        self.schedule_locks = [threading.Lock() for _ in self.publishers]
+        self._seq = itertools.count()
+
+    def _client(self, role, on_connect=None, on_message=None):
+        client = mqtt.Client(client_id=f"fleet-{role}-{os.getpid()}", clean_session=True)
+        client.max_queued_messages_set(0)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(self.args.host, self.args.port, 60)
+        client.loop_start()
+        return client
+
+    def wait_connected(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        clients = [self.subscriber] + self.publishers
+        while not all(c.is_connected() for c in clients):
+            if time.monotonic() > deadline:
+                raise SystemExit(f"Could not connect to the broker at {self.args.host}:{self.args.port}")
+            time.sleep(0.05)
+
+    # --- scheduling ---
+
+    def schedule(self, device_index, due, action):
+        k = device_index % len(self.publishers)
+        with self.schedule_locks[k]:
+            heapq.heappush(self.schedules[k], (due, next(self._seq), action, device_index))
+
+    def add_devices(self, count):
+        """Bring the fleet up to count devices, each starting with a boot message"""
+        now = time.monotonic()
+        for index in range(len(self.devices), count):
+            self.devices.append(Device(index, self.args, random.Random(self.rng.random())))
+            self.schedule(index, now + self.rng.uniform(0, 1), "boot")
+            self.schedule(index, now + self.rng.uniform(0, self.args.live_interval), "live")
+            self.schedule(index, now + self.rng.uniform(0, self.args.batch_interval), "batch")
+
+    def run_scheduler(self, k):
+        client, heap, lock = self.publishers[k], self.schedules[k], self.schedule_locks[k]
+        while not self.stopping.is_set():
+            with lock:
+                due = heap[0][0] if heap else None
+                if due is not None and due <= time.monotonic():
+                    _, _, action, index = heapq.heappop(heap)
+                else:
+                    action = None
+            if action is None:
+                time.sleep(min(0.01, max(0.0, due - time.monotonic())) if due else 0.01)
+                continue
+            getattr(self, f"send_{action}")(client, index)
+
+    def publish(self, client, topic, payload, qos=0):
+        client.publish(topic, payload, qos=qos)
+        with self.stats.lock:
+            self.stats.messages += 1
+
+    # --- device behaviour ---
+
+    def send_boot(self, client, index):
+        device = self.devices[index]
+        self.publish(client, f"gps/{device.id}/boot", json.dumps({"device_id": device.id}))
+
+    def send_live(self, client, index):
+        device = self.devices[index]
+        point = device.next_live_point()
+        timestamp = datetime.now(PKT).strftime('%Y-%m-%d %H:%M:%S')
+        stats = self.stats
+        with self.live_lock:
+            self.live_sent[(device.id, timestamp)] = (time.monotonic(), stats)
+        self.publish(client, f"live/gps/{device.id}", json.dumps({
+            "device_id": device.id, "driver_id": device.driver_id, "timestamp": timestamp,
+            "lat": point['lat'], "lon": point['lon'], "speed": point['speed'],
+        }))
+        with stats.lock:
+            stats.live_sent += 1
+        self.schedule(index, time.monotonic() + self.args.live_interval, "live")
+
+    def send_batch(self, client, index):
+        device = self.devices[index]
+        now = time.monotonic()
+        if device.awaiting is not None:
+            sent, stats = device.awaiting
+            if now - sent < self.args.confirm_timeout:
+                self.schedule(index, now + 1.0, "batch")  # a device uploads one trip at a time
+                return
+            device.awaiting = None
+            with stats.lock:
+                stats.timeouts += 1
+
+        trip = device.next_trip()
+        if self.args.chunks:
+            self.upload_chunks(client, device, trip)
+        else:
+            self.upload_points(client, device, trip)
+        with self.stats.lock:
+            self.stats.sessions += 1
+        self.schedule(index, time.monotonic() + self.args.batch_interval, "batch")
+
+    def upload_points(self, client, device, trip):
+        topic = f"gps/{device.id}/batch"
+        base = {"device_id": device.id, "driver_id": device.driver_id}
+        self.publish(client, topic, json.dumps({**base, "time": "START"}), qos=1)
+        for point in trip:
+            self.publish(client, topic, json.dumps({**base, "time": point['timestamp'], "lat": point['lat'],
+                                                   "lon": point['lon'], "speed": point['speed']}), qos=1)
+        device.awaiting = (time.monotonic(), self.stats)
+        self.publish(client, topic, json.dumps({**base, "time": "END"}), qos=1)
+
+    def upload_chunks(self, client, device, trip):
+        topic = f"gps/{device.id}/chunk"
+        upload_id = next(device.upload_ids)
+        size = self.args.chunk_points
+        parts = [trip[i:i + size] for i in range(0, len(trip), size)] or [[]]
+        for seq, part in enumerate(parts):
+            last = seq == len(parts) - 1
+            payload = encode(device.driver_id, upload_id, seq, [parse_timestamp(p['timestamp']) for p in part],
+                             [p['lat'] for p in part], [p['lon'] for p in part], [p['speed'] for p in part],
+                             first=seq == 0, last=last)
+            if last:
+                device.awaiting = (time.monotonic(), self.stats)
+            self.publish(client, topic, payload, qos=1)
+
+    # --- measurements ---
+
+    def on_confirmation(self, client, userdata, msg):
+        received = time.monotonic()
+        device_id = msg.topic.split("/")[1]
+        index = self.device_index(device_id)
+        if index is None:
+            return
+        device = self.devices[index]
+        awaiting, device.awaiting = device.awaiting, None
+        if awaiting is None:
+            return  # a late answer to a session already counted as timed out
+        sent, stats = awaiting
+        try:
+            ok = json.loads(msg.payload.decode()).get("status") == "success"
+        except ValueError:
+            ok = False
+        with stats.lock:
+            stats.confirmations.append(received - sent)
+            stats.confirm_errors += not ok
+
+    def device_index(self, device_id):
+        if not device_id.startswith(self.args.prefix):
+            return None
+        try:
+            index = int(device_id[len(self.args.prefix):])
+        except ValueError:
+            return None
+        return index if index < len(self.devices) else None
+
+    def on_live_rows(self, rows):
+        """GPSData_live rows (vehicle_id, driver_id, timestamp, ...) were just written"""
+        written = time.monotonic()
+        with self.live_lock:
+            observed = [self.live_sent.pop((row[0], row[2]), None) for row in rows]
+        for entry in observed:
+            if entry is not None:
+                sent, stats = entry
+                with stats.lock:
+                    stats.live_lags.append(written - sent)
+
+    # --- ramp ---
+
+    def run_step(self, devices, seconds, pressure=None):
+        step = self.stats = StepStats(devices)
+        self.add_devices(devices)
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+            if pressure is not None:
+                step.pressure_max = max(step.pressure_max, pressure())
+        step.duration = time.monotonic() - step.started
+        self.stats = StepStats(devices)  # traffic while draining is not part of the step
+
+        # Let the step's uploads and live points land: up to the confirmation timeout for
+        # the uploads, and at least the lag SLO so a point still in the flush is not lost
+        started = time.monotonic()
+        while time.monotonic() - started < self.args.confirm_timeout:
+            if time.monotonic() - started >= self.args.lag_slo and not self.awaiting(step):
+                break
+            time.sleep(0.1)
+        for device in self.awaiting(step):
+            device.awaiting = None
+            step.timeouts += 1
+        with self.live_lock:
+            # Points of this step that were never written count as lost
+            self.live_sent = {key: entry for key, entry in self.live_sent.items() if entry[1] is not step}
+        return step
+
+    def awaiting(self, step):
+        return [d for d in self.devices if d.awaiting is not None and d.awaiting[1] is step]
+
+    def start(self):
+        self.wait_connected()
+        for k in range(len(self.publishers)):
+            threading.Thread(target=self.run_scheduler, args=(k,), name=f"fleet-{k}", daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        for client in [self.subscriber] + self.publishers:
+            client.disconnect()
+            client.loop_stop()
+
+
+def healthy(summary, args, live_measured):
+    """(ok, reasons) for one step's summary"""
+    reasons = []
+    if summary["timeouts"]:
+        reasons.append(f"{summary['timeouts']} confirmation timeouts")
+    if summary["confirm_errors"]:
+        reasons.append(f"{summary['confirm_errors']} error confirmations")
+    if summary["confirm_p99_ms"] is not None and summary["confirm_p99_ms"] > args.confirm_slo * 1000:
+        reasons.append(f"confirmation p99 {summary['confirm_p99_ms']:.0f} ms")
+    if live_measured and summary["live_sent"]:
+        if summary["live_lag_p99_ms"] is not None and summary["live_lag_p99_ms"] > args.lag_slo * 1000:
+            reasons.append(f"live lag p99 {summary['live_lag_p99_ms']:.0f} ms")
+        loss = 1 - summary["live_written"] / summary["live_sent"]
+        if loss > args.max_live_loss:
+            reasons.append(f"{loss:.1%} of live points not written")
+    return not reasons, reasons
+
+
+def start_server(args, on_live_rows):
+    """Run the ingest side in this process; returns the server module"""
+    os.environ["MQTT_HOST"] = args.host
+    os.environ["MQTT_PORT"] = str(args.port)
+    standins.prepare_environment()
+    import server
+
+    if args.serve == "stub":
+        standins.install(server, db_latency=args.db_latency, overpass_latency=args.overpass_latency,
+                         publisher=False)
+
+    # Observe the live writes whatever the database is: wrap the buffer's flush callback
+    write_rows = server.live_buffer._write_rows
+
+    def write_and_observe(rows):
+        write_rows(rows)
+        on_live_rows(rows)
+
+    server.live_buffer._write_rows = write_and_observe
+    server.start_mqtt()
+    deadline = time.monotonic() + 10
+    while not server.mqtt_client.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)  # let the subscriptions settle before the first device boots
+    return server
+
+
+def server_snapshot(server):
+    if server is None:
+        return None
+    admission = server.admission.stats()
+    return {
+        "dispatch_depth": server.message_dispatcher.depth(),
+        "live_buffer_depth": server.live_buffer.depth(),
+        "shed_rate_limited": admission["shed_rate_limited"],
+        "shed_over_high_water": admission["shed_over_high_water"],
+        "shed_superseded": admission["shed_superseded"],
+        "confirmations_awaiting_ack": server.publish_status()["awaiting_ack"],
+    }
+
+
+def report(summaries):
+    header = (f"{'devices':>7} {'msg/s':>8} {'sessions':>8} {'timeouts':>8} {'conf p50':>9} {'conf p99':>9} "
+              f"{'live p50':>9} {'live p99':>9} {'live lost':>9} {'pressure':>8}  verdict")
+    print(header)
+    print("-" * len(header))
+    for s in summaries:
+        lost = f"{1 - s['live_written'] / s['live_sent']:.1%}" if s["live_sent"] and s["live_measured"] else "-"
+
+        def ms(value):
+            return f"{value:.0f}" if value is not None else "-"
+
+        print(f"{s['devices']:>7} {s['messages_per_sec']:>8.0f} {s['sessions']:>8} {s['timeouts']:>8} "
+              f"{ms(s['confirm_p50_ms']):>9} {ms(s['confirm_p99_ms']):>9} {ms(s['live_lag_p50_ms']):>9} "
+              f"{ms(s['live_lag_p99_ms']):>9} {lost:>9} {s['ingest_pressure_max']:>8.2f}  "
+              f"{'ok' if s['healthy'] else 'SATURATED: ' + '; '.join(s['reasons'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--serve", choices=("stub", "postgres", "none"), default="stub",
+                        help="run the server in this process on stand-ins or Postgres, or measure an external one")
+    parser.add_argument("--ramp", default=",".join(map(str, DEFAULT_RAMP)), help="comma-separated device counts")
+    parser.add_argument("--step-seconds", type=float, default=60.0)
+    parser.add_argument("--keep-going", action="store_true", help="run the whole ramp past the saturation point")
+    parser.add_argument("--connections", type=int, default=8, help="MQTT connections the devices are spread over")
+    parser.add_argument("--prefix", default="LOAD-", help="device id prefix")
+    parser.add_argument("--live-interval", type=float, default=1.0, help="seconds between live points per device")
+    parser.add_argument("--batch-interval", type=float, default=60.0, help="seconds between trip uploads per device")
+    parser.add_argument("--batch-points", type=int, default=300)
+    parser.add_argument("--timestamp-format", choices=("pkt", "iso", "mixed"), default="pkt")
+    parser.add_argument("--chunks", action="store_true", help="upload trips as compact chunks instead of JSON points")
+    parser.add_argument("--chunk-points", type=int, default=500)
+    parser.add_argument("--confirm-timeout", type=float, default=30.0, help="seconds a device waits for a confirmation")
+    parser.add_argument("--confirm-slo", type=float, default=5.0, help="p99 confirmation latency limit in seconds")
+    parser.add_argument("--lag-slo", type=float, default=2.0, help="p99 live insert lag limit in seconds")
+    parser.add_argument("--max-live-loss", type=float, default=0.01, help="share of live points allowed to go missing")
+    parser.add_argument("--db-latency", type=float, default=0.001, help="stub: seconds per SQL statement")
+    parser.add_argument("--overpass-latency", type=float, default=0.0, help="stub: seconds per Overpass request")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save", help="write the step results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.live_interval < 1.0:
+        parser.error("--live-interval below 1 s would repeat timestamps, which the server drops as duplicates")
+    if args.chunks and args.timestamp_format != "pkt":
+        parser.error("--chunks carries PKT epochs; use --timestamp-format pkt")
+    ramp = [int(n) for n in args.ramp.split(",") if n]
+
+    fleet = Fleet(args)
+    server = start_server(args, fleet.on_live_rows) if args.serve != "none" else None
+    live_measured = server is not None
+    fleet.start()
+
+    summaries = []
+    saturation = None
+    try:
+        for devices in ramp:
+            print(f"… {devices} devices for {args.step_seconds:.0f} s", flush=True)
+            stats = fleet.run_step(devices, args.step_seconds, server.ingest_pressure if server else None)
+            summary = stats.summary(server_snapshot(server))
+            summary["live_measured"] = live_measured
+            summary["healthy"], summary["reasons"] = healthy(summary, args, live_measured)
+            summaries.append(summary)
+            if not summary["healthy"] and saturation is None:
+                saturation = devices
+                if not args.keep_going:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.stop()
+
+    print()
+    report(summaries)
+    capacity = max((s["devices"] for s in summaries if s["healthy"] and (saturation is None or s["devices"] < saturation)),
+                   default=None)
+    if saturation is None:
+        print(f"\nNo saturation up to {summaries[-1]['devices'] if summaries else 0} devices")
+    else:
+        print(f"\nSaturated at {saturation} devices; last healthy step: {capacity or 'none'}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "saturation": saturation, "capacity": capacity, "steps": summaries},
+                      f, indent=2, default=str)
+        print(f"Saved results to {args.save}")
+
+
+if __name__ == '__main__':
+    main()
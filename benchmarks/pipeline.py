@@ -0,0 +1,173 @@
+"""Micro-benchmarks of the batch pipeline stages, offline.
+
+    python -m benchmarks.pipeline
+    python -m benchmarks.pipeline --sizes 100,1000 --stages detect_harsh_events,smooth_speeds
+    python -m benchmarks.pipeline --save benchmarks/baselines/my-laptop.json
+    python -m benchmarks.pipeline --compare benchmarks/baselines/reference.json --fail-on-regression
+
+Each stage runs on a synthetic trip of every size, repeated until --min-time has
+passed (at least --min-runs times).  The report gives points/sec at the median run
+and the p50/p99 run time.  Postgres, Overpass and the MQTT client are replaced by the
+stand-ins in benchmarks/standins.py; the road-type cache starts cold for every run.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks import standins
+from benchmarks.trips import synthetic_trip
+
+standins.prepare_environment()
+import server  # noqa: E402  (needs the environment above)
+from event_sink import EventSink  # noqa: E402
+
+DEFAULT_SIZES = (100, 1000, 10000, 100000)
+
+
+def _iso_timestamps(points):
+    return [p['timestamp'] for p in points if 'T' in p['timestamp']] or [p['timestamp'] for p in points]
+
+
+# name -> (prepare(points) -> state, setup(state) before each run, run(state))
+STAGES = {
+    "smooth_speeds": (
+        lambda points: [p['speed'] for p in points],
+        None,
+        lambda speeds: server.smooth_speeds(speeds),
+    ),
+    "detect_harsh_events": (
+        lambda points: points,
+        None,
+        lambda points: server.detect_harsh_events(points, "BENCH-V", "BENCH-D", sink=EventSink()),
+    ),
+    "calculate_distance_and_check_events": (
+        lambda points: points,
+        lambda points: standins.reset_road_cache(server),
+        lambda points: server.calculate_distance_and_check_events(points, "BENCH-V", "BENCH-D", sink=EventSink()),
+    ),
+    "convert_to_pkt": (
+        _iso_timestamps,
+        None,
+        lambda timestamps: [server.convert_to_pkt(t) for t in timestamps],
+    ),
+    "save_gps_data_to_db": (
+        lambda points: points,
+        lambda points: standins.install(server),
+        lambda points: server.save_gps_data_to_db("BENCH-V", "BENCH-D", points),
+    ),
+}
+
+
+def measure(stage, points, min_time, min_runs, max_runs):
+    prepare, setup, run = STAGES[stage]
+    state = prepare(points)
+    if setup is not None:
+        setup(state)
+    run(state)  # warm-up: imports, caches and first-call allocations
+    gc.collect()
+    durations = []
+    started = time.perf_counter()
+    while len(durations) < min_runs or (time.perf_counter() - started < min_time and len(durations) < max_runs):
+        if setup is not None:
+            setup(state)
+        t0 = time.perf_counter()
+        run(state)
+        durations.append(time.perf_counter() - t0)
+    p50, p99 = np.percentile(durations, [50, 99])
+    items = len(state) if hasattr(state, '__len__') else len(points)
+    return {
+        "runs": len(durations),
+        "p50_ms": round(p50 * 1000, 4),
+        "p99_ms": round(p99 * 1000, 4),
+        "points_per_sec": round(items / p50, 1) if p50 > 0 else None,
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} CPUs)",
+    }
+
+
+def report(results, baseline=None, threshold=10.0):
+    """Print the results table; returns the (stage, size) pairs slower than the baseline by threshold %"""
+    regressions = []
+    header = f"{'stage':<38} {'points':>8} {'runs':>5} {'p50 ms':>11} {'p99 ms':>11} {'points/s':>13}"
+    print(header + (f" {'vs base':>9}" if baseline else ""))
+    print("-" * (len(header) + (10 if baseline else 0)))
+    for stage, sizes in results.items():
+        for size, r in sizes.items():
+            line = (f"{stage:<38} {size:>8} {r['runs']:>5} {r['p50_ms']:>11.3f} {r['p99_ms']:>11.3f} "
+                    f"{r['points_per_sec'] or 0:>13,.0f}")
+            base = (baseline or {}).get(stage, {}).get(size)
+            if base:
+                change = (r['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100 if base['p50_ms'] else 0.0
+                line += f" {change:>+8.1f}%"
+                if change > threshold:
+                    line += "  REGRESSION"
+                    regressions.append((stage, size))
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated trip sizes in points")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stage names")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to keep repeating each case")
+    parser.add_argument("--min-runs", type=int, default=3)
+    parser.add_argument("--max-runs", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save", help="write the results as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the p50 times against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="p50 slowdown in %% that counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages {unknown}; choose from {list(STAGES)}")
+
+    standins.install(server)
+    results = {stage: {} for stage in stages}
+    for size in sizes:
+        points = synthetic_trip(size, seed=args.seed)
+        for stage in stages:
+            results[stage][str(size)] = measure(stage, points, args.min_time, args.min_runs, args.max_runs)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"meta": metadata(), "results": results}, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Shared-subscription self-test: several ingest consumers against a real MQTT broker.
+
+    python -m benchmarks.shared_subscriptions
+    python -m benchmarks.shared_subscriptions --consumers 3 --devices 50 --host mqtt.internal
+
+Starts --consumers ingest processes the way ingest.py runs them in production
+(INGEST_SHARE_GROUP, INGEST_SHARDS, INGEST_SHARD_INDEX), each on the stand-ins of
+benchmarks/standins.py, then publishes boots, live points and JSON batch sessions for
+--devices devices.  Every message carries a probe id; each consumer reports the probes
+its dispatcher handed to process_message.  The test passes when
+
+  * every boot and live message was handled exactly once across all consumers
+    (a broker without shared subscriptions delivers them to every consumer)
+  * every batch message was handled exactly once, by the consumer whose shard owns
+    the device (crc32(device_id) % INGEST_SHARDS)
+  * every session got its success confirmation on device/<id>/confirmation
+
+Needs a broker with shared subscriptions ($share), e.g. `mosquitto -p 1883` (1.6+).
+Exits non-zero on failure, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict
+
+import paho.mqtt.client as mqtt
+
+from benchmarks import standins
+from benchmarks.trips import synthetic_trip
+
+
+def consumer(args):
+    """One ingest process; prints "ready" and then one JSON line per handled message"""
+    standins.prepare_environment()
+    import server
+
+    standins.install(server, publisher=False)
+    out_lock = threading.Lock()
+    handle = server.message_dispatcher._handler
+
+    def handle_and_report(topic, data, device_id):
+        probe = data.get("probe") if isinstance(data, dict) else None
+        if probe is not None:
+            with out_lock:
+                print(json.dumps({"probe": probe, "topic": topic}), flush=True)
+        return handle(topic, data, device_id)
+
+    server.message_dispatcher._handler = handle_and_report
+    server.start_mqtt()
+    deadline = time.monotonic() + 10
+    while not server.mqtt_client.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)  # let the subscriptions settle
+    print("ready" if server.mqtt_client.is_connected() else "unconnected", flush=True)
+    sys.stdin.read()  # until the parent closes the pipe
+    server.mqtt_client.disconnect()
+    server.mqtt_client.loop_stop()
+
+
+def spawn_consumers(args, group):
+    processes = []
+    for index in range(args.consumers):
+        env = dict(os.environ,
+                   MQTT_HOST=args.host, MQTT_PORT=str(args.port), MQTT_CLIENT_ID=f"{group}-{index}",
+                   INGEST_SHARE_GROUP=group, INGEST_SHARDS=str(args.consumers), INGEST_SHARD_INDEX=str(index),
+                   INGEST_BATCH_ROUTING="shard", ADMISSION_BURST="100000", ADMISSION_RATE="100000")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.shared_subscriptions", "--consumer"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True))
+    return processes
+
+
+class Observations:
+    """Probe -> consumer indexes that handled it, plus confirmations per device"""
+
+    def __init__(self):
+        self.handled = defaultdict(list)
+        self.confirmations = Counter()
+        self.changed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def read(self, index, process, ready):
+        for line in process.stdout:
+            line = line.strip()
+            if line in ("ready", "unconnected"):
+                ready[index] = line == "ready"
+                continue
+            try:
+                probe = json.loads(line)["probe"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            with self.lock:
+                self.handled[probe].append(index)
+                self.changed = time.monotonic()
+
+    def on_confirmation(self, client, userdata, msg):
+        try:
+            ok = json.loads(msg.payload.decode()).get("status") == "success"
+        except ValueError:
+            ok = False
+        if ok:
+            with self.lock:
+                self.confirmations[msg.topic.split("/")[1]] += 1
+                self.changed = time.monotonic()
+
+
+def publish_traffic(client, args):
+    """Publish the test traffic; returns {probe: (kind, device_id)} and the devices' session counts"""
+    sent = {}
+    sessions = Counter()
+    for d in range(args.devices):
+        device_id = f"{args.prefix}{d:05d}"
+        driver_id = str(1 + d % 2)
+        base = {"device_id": device_id, "driver_id": driver_id}
+
+        probe = f"boot-{device_id}"
+        sent[probe] = ("boot", device_id)
+        client.publish(f"gps/{device_id}/boot", json.dumps({**base, "probe": probe}), qos=1)
+
+        for k, point in enumerate(synthetic_trip(args.live, seed=d)):
+            probe = f"live-{device_id}-{k}"
+            sent[probe] = ("live", device_id)
+            client.publish(f"live/gps/{device_id}", json.dumps({
+                **base, "probe": probe, "timestamp": point['timestamp'],
+                "lat": point['lat'], "lon": point['lon'], "speed": point['speed']}), qos=1)
+
+        topic = f"gps/{device_id}/batch"
+        for s in range(args.sessions):
+            trip = synthetic_trip(args.batch_points, seed=1000 * d + s)
+            messages = ([{"time": "START"}]
+                        + [{"time": p['timestamp'], "lat": p['lat'], "lon": p['lon'], "speed": p['speed']}
+                           for p in trip]
+                        + [{"time": "END"}])
+            for k, message in enumerate(messages):
+                probe = f"batch-{device_id}-{s}-{k}"
+                sent[probe] = ("batch", device_id)
+                client.publish(topic, json.dumps({**base, **message, "probe": probe}), qos=1)
+            sessions[device_id] += 1
+    return sent, sessions
+
+
+def check(sent, sessions, observations, consumers):
+    """Failure messages (empty when the run passed) and per-consumer message counts"""
+    failures = []
+    per_consumer = Counter()
+    with observations.lock:
+        handled = dict(observations.handled)
+        confirmations = Counter(observations.confirmations)
+
+    counts = Counter()
+    for probe, (kind, device_id) in sent.items():
+        by = handled.get(probe, [])
+        per_consumer.update(by)
+        if len(by) != 1:
+            counts[(kind, "missing" if not by else "duplicated")] += 1
+            continue
+        owner = zlib.crc32(device_id.encode("utf-8")) % consumers
+        if kind == "batch" and by[0] != owner:
+            counts[(kind, "off-shard")] += 1
+    for (kind, problem), n in sorted(counts.items()):
+        failures.append(f"{n} {kind} messages {problem}")
+
+    unconfirmed = sum(max(0, n - confirmations[device_id]) for device_id, n in sessions.items())
+    if unconfirmed:
+        failures.append(f"{unconfirmed} sessions without a success confirmation")
+    return failures, per_consumer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--consumers", type=int, default=2, help="ingest processes sharing the subscriptions")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--live", type=int, default=20, help="live points per device")
+    parser.add_argument("--sessions", type=int, default=2, help="batch sessions per device")
+    parser.add_argument("--batch-points", type=int, default=50)
+    parser.add_argument("--prefix", default="SHARE-", help="device id prefix")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds without progress that end the run")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--consumer", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.consumer:
+        return consumer(args)
+    if args.consumers < 2:
+        parser.error("--consumers must be at least 2")
+
+    group = f"selftest-{uuid.uuid4().hex[:8]}"
+    observations = Observations()
+    processes = spawn_consumers(args, group)
+    ready = [None] * len(processes)
+    for index, process in enumerate(processes):
+        threading.Thread(target=observations.read, args=(index, process, ready), daemon=True).start()
+
+    client = mqtt.Client(client_id=f"{group}-devices", clean_session=True)
+    client.max_queued_messages_set(0)
+    client.on_connect = lambda c, u, f, rc: c.subscribe("device/+/confirmation", qos=1)
+    client.on_message = observations.on_confirmation
+    try:
+        client.connect(args.host, args.port, 60)
+        client.loop_start()
+        deadline = time.monotonic() + 20
+        while None in ready or not client.is_connected():
+            if time.monotonic() > deadline or any(p.poll() is not None for p in processes):
+                raise SystemExit(f"Consumers or the test client could not connect to {args.host}:{args.port}")
+            time.sleep(0.05)
+        if not all(ready):
+            raise SystemExit(f"A consumer could not connect to {args.host}:{args.port}")
+
+        print(f"… {args.consumers} consumers in share group {group}, {args.devices} devices", flush=True)
+        started = time.monotonic()
+        sent, sessions = publish_traffic(client, args)
+        observations.changed = time.monotonic()
+        while time.monotonic() - observations.changed < args.settle:
+            if time.monotonic() - started > args.timeout:
+                break
+            time.sleep(0.1)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        for process in processes:
+            process.stdin.close()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    failures, per_consumer = check(sent, sessions, observations, args.consumers)
+    kinds = Counter(kind for kind, _ in sent.values())
+    print(f"sent: {kinds['boot']} boot, {kinds['live']} live, {kinds['batch']} batch messages, "
+          f"{sum(sessions.values())} sessions")
+    print("handled per consumer: " + ", ".join(f"#{k}: {per_consumer[k]}" for k in range(args.consumers)))
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+    print("ok: every message handled exactly once, batch sessions on their owning shard")
+
+
+if __name__ == '__main__':
+    main()
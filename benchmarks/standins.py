@@ -0,0 +1,238 @@
+"""In-process stand-ins for Postgres, Overpass, the MQTT client and the reference data.
+
+install() swaps them into the server module so the real pipeline code runs offline:
+the DB-API connections go through the real ConnectionPool and psycopg2's
+execute_values, and duplicates are resolved like the unique indexes do.  Latencies
+can be added to model a remote database or the public Overpass API.
+"""
+import itertools
+import os
+import threading
+import time
+import zlib
+from collections import namedtuple
+from types import SimpleNamespace
+
+HIGHWAY_TAGS = ("motorway", "trunk", "primary", "secondary", "residential", "service", "unclassified")
+
+PublishResult = namedtuple("PublishResult", "rc mid")
+
+
+def prepare_environment():
+    """Environment for importing server without a spool directory, cache file or log noise"""
+    os.environ.setdefault("SESSION_SPOOL_DIR", "")
+    os.environ.setdefault("ROAD_CACHE_PATH", "")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+class FakeDatabase:
+    """Tables as key sets; an INSERT reports only rows whose key was not stored yet"""
+
+    def __init__(self, statement_latency=0.0):
+        self.statement_latency = statement_latency
+        self.lock = threading.Lock()
+        self.gpsdata = set()
+        self.gpsdata_live = set()
+        self.events = set()
+        self.mileage = {}
+        self.statements = 0
+        self.rows_written = 0
+        self.live_rows = 0
+        self.on_live_rows = None  # callback(rows) after a GPSData_live insert, for lag measurements
+
+    def connect(self):
+        return FakeConnection(self)
+
+    def insert(self, sql, rows):
+        if b"GPSData_live" in sql:
+            table, key = self.gpsdata_live, lambda r: tuple(r[:3])
+        elif b"GPSData" in sql:
+            table, key = self.gpsdata, lambda r: tuple(r[:3])
+        elif b"events" in sql:
+            table, key = self.events, lambda r: (r[0], r[1], r[2], r[5], round(r[3], 4), round(r[4], 4))
+        else:
+            return len(rows)
+        inserted = 0
+        with self.lock:
+            for row in rows:
+                k = key(row)
+                if k not in table:
+                    table.add(k)
+                    inserted += 1
+            self.rows_written += inserted
+            if table is self.gpsdata_live:
+                self.live_rows += inserted
+        if table is self.gpsdata_live and self.on_live_rows is not None:
+            self.on_live_rows(rows)
+        return inserted
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._pending = []
+        self._result = []
+        self.rowcount = -1
+
+    def mogrify(self, template, args):
+        self._pending.append(args)
+        return repr(args).encode()
+
+    def execute(self, sql, params=None):
+        db = self.connection.db
+        if db.statement_latency:
+            time.sleep(db.statement_latency)
+        db.statements += 1
+        if isinstance(sql, str):
+            sql = sql.encode()
+        statement = sql.lstrip().upper()
+        if statement.startswith(b"INSERT"):
+            rows, self._pending = (self._pending or [params]), []
+            inserted = db.insert(sql, rows)
+            self._result = [(1,)] * inserted
+            self.rowcount = inserted
+        elif statement.startswith(b"UPDATE") and b"TOTAL_MILAGE" in statement:
+            distance, vehicle_id = params
+            with db.lock:
+                db.mileage[vehicle_id] = db.mileage.get(vehicle_id, 0.0) + distance
+            self._result, self.rowcount = [], 1
+        elif statement.startswith(b"SELECT"):
+            self._result, self.rowcount = [(0,)], 1  # no existing duplicates for the COUNT(*) checks
+        else:
+            self._result, self.rowcount = [], 0
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+
+    def close(self):
+        pass
+
+
+class FakeOverpass:
+    """requests.post replacement answering every query with a highway derived from the location"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+
+    def post(self, url, data=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        tag = HIGHWAY_TAGS[zlib.crc32(data.encode() if isinstance(data, str) else data) % len(HIGHWAY_TAGS)]
+        return SimpleNamespace(status_code=200, json=lambda: {"elements": [{"tags": {"highway": tag}}]})
+
+
+class FakePublisher:
+    """paho-style client that acknowledges every publish immediately"""
+
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self.published = 0
+        self._mids = itertools.count(1)
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        mid = next(self._mids)
+        if self.on_publish is not None:
+            # Runs after publish_async has recorded the mid, as paho's callback would
+            threading.Timer(0, self.on_publish, (self, None, mid)).start()
+        return PublishResult(0, mid)
+
+
+class FakeReferenceData:
+    """Every vehicle and driver exists; speed limits come from a fixed table"""
+
+    SPEED_LIMITS = {"Motorway": 120.0, "Expressways": 100.0, "National Highways": 80.0, "Other Roads": 50.0}
+
+    def vehicle_exists(self, vehicle_id):
+        return True
+
+    def driver_exists(self, driver_id):
+        return True
+
+    def speed_limit(self, vehicle_id, road_type):
+        return self.SPEED_LIMITS.get(road_type)
+
+    def drivers(self):
+        return [("1", "Driver One"), ("2", "Driver Two")]
+
+    def start(self):
+        pass
+
+    def stats(self):
+        return {"stand_in": True}
+
+
+class FakeNotificationFeed:
+    """No vehicle has pending notifications"""
+
+    def deliver(self, device_id, force=False):
+        return False
+
+    def acknowledge(self, device_id, version):
+        pass
+
+    def post(self, message, vehicle_id=None, unit=None, push=True):
+        return []
+
+    def pending_count(self):
+        return 0
+
+    def start(self):
+        pass
+
+    def stats(self):
+        return {"stand_in": True}
+
+
+def install(server, db_latency=0.0, overpass_latency=0.0, publisher=True):
+    """Point the server module at fresh stand-ins; returns them as a namespace"""
+    from db_pool import ConnectionPool
+    from road_cache import RoadTypeCache
+
+    db = FakeDatabase(db_latency)
+    overpass = FakeOverpass(overpass_latency)
+    server.db_pool = ConnectionPool(db.connect, minconn=1, maxconn=10)
+    server.reference_data = FakeReferenceData()
+    server.notification_feed = FakeNotificationFeed()
+    server.requests = SimpleNamespace(post=overpass.post)
+    server.road_type_cache = RoadTypeCache(db_path=None)
+    server.schema_status.clear()
+    stand_ins = SimpleNamespace(db=db, overpass=overpass, publisher=None)
+    if publisher:
+        stand_ins.publisher = server.mqtt_client = FakePublisher(server.on_publish)
+    return stand_ins
+
+
+def reset_road_cache(server):
+    """A cold road-type cache, so each run pays for its lookups"""
+    from road_cache import RoadTypeCache
+    server.road_type_cache = RoadTypeCache(db_path=None)
@@ -0,0 +1,82 @@
+"""Synthetic trips shaped like what the devices upload.
+
+Speed follows drive phases (pull away, cruise at a road's typical speed, slow down,
+stop at junctions) with sensor noise and occasional hard-braking and hard-acceleration
+spikes.  Positions integrate the speed along a wandering heading and get GPS jitter.
+Timestamps come as PKT wall-clock strings, as ISO-8601 UTC strings, or mixed in runs
+of points, since both reach save_gps_data_to_db.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+
+PKT = pytz.timezone('Asia/Karachi')
+START = (33.6844, 73.0479)  # Islamabad
+METERS_PER_DEG_LAT = 111_320.0
+CRUISE_SPEEDS = (40.0, 60.0, 80.0, 110.0)  # km/h: town, arterial, highway, motorway
+
+
+def speed_profile(n, rng, spike_every=400):
+    """Speeds in km/h for n one-second samples"""
+    speeds = np.empty(n)
+    speed = 0.0
+    target = rng.choice(CRUISE_SPEEDS)
+    phase_left = 0
+    for i in range(n):
+        if phase_left <= 0:
+            # Next phase: mostly cruising, sometimes a stop or a change of road
+            roll = rng.random()
+            if roll < 0.15:
+                target = 0.0
+            elif roll < 0.4:
+                target = rng.choice(CRUISE_SPEEDS)
+            phase_left = int(rng.integers(20, 180))
+        phase_left -= 1
+        step = float(np.clip(target - speed, -6.0, 4.0))  # gentle braking and acceleration, km/h per second
+        speed = max(0.0, speed + step + rng.normal(0.0, 1.2))
+        speeds[i] = speed
+
+    # Harsh events: a sudden drop or jump of 15-30 km/h that recovers over a few seconds
+    spikes = rng.choice(n, size=max(1, n // spike_every), replace=False) if n > 10 else []
+    for i in spikes:
+        delta = rng.uniform(15.0, 30.0) * (-1 if rng.random() < 0.6 else 1)
+        for k in range(min(4, n - i)):
+            speeds[i + k] = max(0.0, speeds[i + k] + delta * (1 - k / 4))
+    return speeds
+
+
+def track(speeds, rng, jitter_m=4.0, start=START):
+    """Latitudes and longitudes following the speeds along a slowly turning heading"""
+    heading = np.cumsum(rng.normal(0.0, 0.05, len(speeds))) + rng.uniform(0, 2 * np.pi)
+    step_m = speeds / 3.6
+    north = np.cumsum(step_m * np.cos(heading)) + rng.normal(0.0, jitter_m, len(speeds))
+    east = np.cumsum(step_m * np.sin(heading)) + rng.normal(0.0, jitter_m, len(speeds))
+    lats = start[0] + north / METERS_PER_DEG_LAT
+    lons = start[1] + east / (METERS_PER_DEG_LAT * np.cos(np.radians(start[0])))
+    return lats, lons
+
+
+def timestamps(n, started, timestamp_format="mixed", run=250):
+    """n one-second timestamps; 'pkt', 'iso' or 'mixed' (alternating runs of `run` points)"""
+    result = []
+    for i in range(n):
+        moment = started + timedelta(seconds=i)
+        iso = timestamp_format == "iso" or (timestamp_format == "mixed" and (i // run) % 2 == 1)
+        if iso:
+            result.append(moment.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        else:
+            result.append(moment.strftime('%Y-%m-%d %H:%M:%S'))
+    return result
+
+
+def synthetic_trip(n, seed=0, timestamp_format="mixed", jitter_m=4.0, started=None):
+    """A trip of n points as the list of dicts the batch pipeline consumes"""
+    rng = np.random.default_rng(seed)
+    speeds = speed_profile(n, rng)
+    lats, lons = track(speeds, rng, jitter_m)
+    started = started or PKT.localize(datetime(2024, 3, 4, 8, 0, 0)) + timedelta(hours=seed % 24)
+    return [
+        {'timestamp': timestamp, 'lat': float(lat), 'lon': float(lon), 'speed': round(float(speed), 2)}
+        for timestamp, lat, lon, speed in zip(timestamps(n, started, timestamp_format), lats, lons, speeds)
+    ]
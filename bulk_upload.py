@@ -0,0 +1,109 @@
+"""Incremental parsing of bulk trip uploads.
+
+The body is NDJSON (one {"timestamp", "lat", "lon", "speed"} object per line) or CSV
+with a header row naming the same columns, optionally gzip-compressed.  It is read as
+a stream, one line at a time, so memory does not grow with the size of the upload.
+"""
+import csv
+import gzip
+import io
+import json
+
+FORMATS = ("ndjson", "csv")
+GZIP_MAGIC = b"\x1f\x8b"
+TIMESTAMP_FIELDS = ("timestamp", "time")
+
+
+class UploadError(ValueError):
+    """Raised when an upload body cannot be read at all"""
+
+
+class _ReadAdapter(io.RawIOBase):
+    """Raw stream over any object with read(), so it can be buffered and peeked"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _buffered(stream):
+    if isinstance(stream, io.BufferedReader):
+        return stream
+    if not isinstance(stream, io.RawIOBase):
+        stream = _ReadAdapter(stream)
+    return io.BufferedReader(stream, 64 * 1024)
+
+
+def open_body(stream, content_encoding=None):
+    """Buffered binary stream of the decoded body, gunzipping it when it is compressed"""
+    body = _buffered(stream)
+    if (content_encoding or "").lower() == "gzip" or body.peek(2)[:2] == GZIP_MAGIC:
+        body = io.BufferedReader(gzip.GzipFile(fileobj=body, mode="rb"), 64 * 1024)
+    return body
+
+
+def detect_format(body, content_type=None):
+    """'csv' or 'ndjson' from the content type, else from the first byte of the body"""
+    content_type = (content_type or "").lower()
+    if "csv" in content_type:
+        return "csv"
+    if "ndjson" in content_type or "jsonl" in content_type or "json-seq" in content_type:
+        return "ndjson"
+    try:
+        head = body.peek(64).lstrip()
+    except (OSError, EOFError) as e:
+        raise UploadError(f"unreadable body: {e}")
+    return "ndjson" if head[:1] == b"{" else "csv"
+
+
+def iter_points(body, fmt):
+    """Yield (line_number, point) where point has 'time', 'lat', 'lon', 'speed', or None for a bad line"""
+    if fmt not in FORMATS:
+        raise UploadError(f"unknown format {fmt!r}, expected one of {FORMATS}")
+    text = io.TextIOWrapper(body, encoding="utf-8", errors="replace", newline="")
+    try:
+        if fmt == "ndjson":
+            yield from _iter_ndjson(text)
+        else:
+            yield from _iter_csv(text)
+    except (OSError, EOFError, csv.Error) as e:
+        raise UploadError(f"unreadable body: {e}")
+
+
+def _point(record):
+    timestamp = next((record[f] for f in TIMESTAMP_FIELDS if record.get(f) not in (None, "")), None)
+    if timestamp is None or any(record.get(f) in (None, "") for f in ("lat", "lon", "speed")):
+        return None
+    return {"time": str(timestamp).strip(), "lat": record["lat"], "lon": record["lon"], "speed": record["speed"]}
+
+
+def _iter_ndjson(text):
+    for line_number, line in enumerate(text, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None
+            continue
+        yield line_number, _point(record) if isinstance(record, dict) else None
+
+
+def _iter_csv(text):
+    reader = csv.DictReader(text)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    missing = [f for f in ("lat", "lon", "speed") if f not in reader.fieldnames]
+    if missing or not any(f in reader.fieldnames for f in TIMESTAMP_FIELDS):
+        raise UploadError(f"CSV header must name timestamp, lat, lon and speed columns, got {reader.fieldnames}")
+    for record in reader:
+        yield reader.line_num, _point(record)
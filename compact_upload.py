@@ -0,0 +1,135 @@
+"""Compact binary batch chunks, published on gps/<device_id>/chunk.
+
+One message carries a whole run of points instead of one JSON message per point.
+
+    header   <2sBBIIHB  magic b"GC", version, flags, upload_id, seq, count, driver_id length
+             driver_id  UTF-8
+    body     (zlib-compressed when FLAG_ZLIB is set)
+             <qii       base epoch, base lat and base lon in 1e-7 degrees
+             count x <u2  seconds since the previous point (the first is relative to the base)
+             count x <i4  latitude delta, 1e-7 degrees
+             count x <i4  longitude delta, 1e-7 degrees
+             count x <u2  speed, 0.01 km/h
+
+Epochs are PKT wall-clock seconds since 1970, the same form the JSON path stores after
+convert_to_pkt.  upload_id identifies one trip upload and seq numbers its chunks from
+0, so a re-sent chunk can be recognised and ignored.  FLAG_FIRST opens the session
+like START and FLAG_LAST closes it like END.
+"""
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b"GC"
+VERSION = 1
+FLAG_ZLIB = 1
+FLAG_FIRST = 2
+FLAG_LAST = 4
+
+HEADER = struct.Struct("<2sBBIIHB")
+BASE = struct.Struct("<qii")
+COLUMNS = (("dt", "<u2"), ("dlat", "<i4"), ("dlon", "<i4"), ("speed", "<u2"))
+POINT_BYTES = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+COORD_SCALE = 1e7
+SPEED_SCALE = 100.0
+MAX_BODY_BYTES = BASE.size + 0xFFFF * POINT_BYTES
+
+Chunk = namedtuple("Chunk", "upload_id seq first last driver_id epochs lats lons speeds")
+
+
+class ChunkError(ValueError):
+    """Raised for a chunk that is malformed or fails validation"""
+
+
+def _header(payload):
+    if len(payload) < HEADER.size:
+        raise ChunkError("truncated header")
+    magic, version, flags, upload_id, seq, count, driver_len = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ChunkError("not a version 1 chunk")
+    if len(payload) < HEADER.size + driver_len:
+        raise ChunkError("truncated driver_id")
+    driver_id = bytes(payload[HEADER.size:HEADER.size + driver_len]).decode("utf-8", "replace").strip()
+    return flags, upload_id, seq, count, driver_id, HEADER.size + driver_len
+
+
+def peek(payload):
+    """(upload_id, seq, flags, driver_id) from the header alone"""
+    flags, upload_id, seq, _, driver_id, _ = _header(payload)
+    return upload_id, seq, flags, driver_id
+
+
+def decode(payload):
+    """Decode and validate a chunk into NumPy columns"""
+    flags, upload_id, seq, count, driver_id, body_offset = _header(payload)
+    if not driver_id:
+        raise ChunkError("missing driver_id")
+
+    body = bytes(payload[body_offset:])
+    if flags & FLAG_ZLIB:
+        inflater = zlib.decompressobj()
+        try:
+            body = inflater.decompress(body, MAX_BODY_BYTES)
+        except zlib.error as e:
+            raise ChunkError(f"bad zlib body: {e}")
+        if inflater.unconsumed_tail:
+            raise ChunkError("compressed body is too large")
+        if not inflater.eof:
+            raise ChunkError("truncated zlib body")
+    if len(body) != BASE.size + count * POINT_BYTES:
+        raise ChunkError(f"body is {len(body)} bytes, expected {BASE.size + count * POINT_BYTES} for {count} points")
+
+    base_epoch, base_lat, base_lon = BASE.unpack_from(body, 0)
+    columns = {}
+    offset = BASE.size
+    for name, dtype in COLUMNS:
+        columns[name] = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+        offset += count * np.dtype(dtype).itemsize
+
+    epochs = base_epoch + np.cumsum(columns["dt"], dtype=np.int64)
+    lats = (base_lat + np.cumsum(columns["dlat"], dtype=np.int64)) / COORD_SCALE
+    lons = (base_lon + np.cumsum(columns["dlon"], dtype=np.int64)) / COORD_SCALE
+    speeds = columns["speed"] / SPEED_SCALE
+
+    # Same checks as validate_batch_gps_data, over the whole chunk at once
+    bad = (lats < -90) | (lats > 90)
+    if bad.any():
+        raise ChunkError(f"invalid latitude at point {int(np.argmax(bad))}: {lats[bad][0]}")
+    bad = (lons < -180) | (lons > 180)
+    if bad.any():
+        raise ChunkError(f"invalid longitude at point {int(np.argmax(bad))}: {lons[bad][0]}")
+    if count and epochs[0] < 0:
+        raise ChunkError(f"invalid base timestamp: {base_epoch}")
+
+    return Chunk(upload_id, seq, bool(flags & FLAG_FIRST), bool(flags & FLAG_LAST), driver_id,
+                 epochs, lats, lons, speeds)
+
+
+def encode(driver_id, upload_id, seq, epochs, lats, lons, speeds, first=False, last=False, compress=True):
+    """Build a chunk; the reference encoder for firmware and load tools"""
+    epochs = np.asarray(epochs, dtype=np.int64)
+    lat_e7 = np.rint(np.asarray(lats, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    lon_e7 = np.rint(np.asarray(lons, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    count = len(epochs)
+    if count > 0xFFFF:
+        raise ChunkError(f"too many points for one chunk: {count}")
+
+    base = (int(epochs[0]), int(lat_e7[0]), int(lon_e7[0])) if count else (0, 0, 0)
+    dt = np.diff(epochs, prepend=base[0])
+    if (dt < 0).any() or (dt > 0xFFFF).any():
+        raise ChunkError("timestamps must be non-decreasing with gaps under 65536 s")
+    body = BASE.pack(*base) + b"".join((
+        dt.astype("<u2").tobytes(),
+        np.diff(lat_e7, prepend=base[1]).astype("<i4").tobytes(),
+        np.diff(lon_e7, prepend=base[2]).astype("<i4").tobytes(),
+        np.clip(np.rint(np.asarray(speeds, dtype=np.float64) * SPEED_SCALE), 0, 0xFFFF).astype("<u2").tobytes(),
+    ))
+
+    flags = (FLAG_FIRST if first else 0) | (FLAG_LAST if last else 0)
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_ZLIB
+    driver = driver_id.encode("utf-8")
+    return HEADER.pack(MAGIC, VERSION, flags, upload_id, seq, count, len(driver)) + driver + body
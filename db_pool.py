@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of Postgres connections created by a connect() callable.
+
+    Connections are health-checked on checkout, rolled back on check-in if a
+    transaction was left open, and discarded when broken.  The pool is shared by
+    the paho network thread, the cleanup thread and the Flask request threads.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=30.0,
+                 health_check_interval=30.0, max_idle=300.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: min={minconn}, max={maxconn}")
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_idle = max_idle
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (conn, last_used) - most recently used on the right
+        self._size = 0
+        self._pid = os.getpid()
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+
+    def _reset_after_fork(self):
+        # Connections inherited from a parent process (gunicorn --preload) must not be shared
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._size = 0
+
+    def warm(self):
+        """Open connections until minconn are idle"""
+        while True:
+            with self._cond:
+                self._reset_after_fork()
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._created += 1
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _checkout(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                self._reset_after_fork()
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created += 1
+            elif not self._healthy(conn, last_used):
+                self._discard(conn)
+                continue
+
+            wait = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._wait_total += wait
+                if waited:
+                    self._waits += 1
+                if wait > self._wait_max:
+                    self._wait_max = wait
+            return conn
+
+    def _checkin(self, conn):
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        now = time.monotonic()
+        stale = []
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.append((conn, now))
+            # Trim connections beyond minconn that have sat unused for too long
+            while len(self._idle) > self.minconn and now - self._idle[0][1] > self.max_idle:
+                stale.append(self._idle.popleft()[0])
+                self._size -= 1
+                self._discarded += 1
+            self._cond.notify()
+        for old in stale:
+            try:
+                old.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; uncommitted work is rolled back when it is returned"""
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self._checkin(conn)
+
+    @contextmanager
+    def cursor(self, commit=False):
+        """Borrow a connection and yield a cursor on it, committing on success if asked"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                if commit:
+                    conn.commit()
+            finally:
+                cursor.close()
+
+    def closeall(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "wait_total_s": round(self._wait_total, 3),
+                "connections_created": self._created,
+                "connections_discarded": self._discarded,
+            }
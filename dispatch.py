@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised by OrderedDispatcher.submit when the queue stays full past the timeout"""
+
+
+class _StageStats:
+    __slots__ = ("count", "errors", "wait_total", "wait_max", "run_total", "run_max", "run_last")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        self.run_last = 0.0
+
+    def record(self, wait, run, failed):
+        self.count += 1
+        self.errors += failed
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += run
+        self.run_max = max(self.run_max, run)
+        self.run_last = run
+
+    def as_dict(self):
+        return {
+            "processed": self.count,
+            "errors": self.errors,
+            "queue_wait_avg_ms": round(self.wait_total / self.count * 1000, 2) if self.count else 0.0,
+            "queue_wait_max_ms": round(self.wait_max * 1000, 2),
+            "run_avg_ms": round(self.run_total / self.count * 1000, 2) if self.count else 0.0,
+            "run_max_ms": round(self.run_max * 1000, 2),
+            "run_last_ms": round(self.run_last * 1000, 2),
+        }
+
+
+class OrderedDispatcher:
+    """Bounded worker pool that runs items with the same key strictly in submission order.
+
+    Each key has its own FIFO.  A key is handed to at most one worker at a time, and
+    after each item it goes to the back of the ready line, so one busy device cannot
+    hold a worker while other devices wait.
+    """
+
+    def __init__(self, handler, workers=4, max_queue=10000, name="dispatch"):
+        self._handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.name = name
+
+        self._cond = threading.Condition(threading.Lock())
+        self._not_full = threading.Condition(self._cond)
+        self._queues = {}  # key -> deque of (enqueued_at, stage, args)
+        self._ready = deque()  # keys with queued items that no worker holds
+        self._busy = set()
+        self._depth = 0
+        self._max_depth = 0
+        self._rejected = 0
+        self._threads = []
+        self._stages = {}
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, key, stage, *args, timeout=None):
+        """Queue handler(*args) under key; waits up to timeout for space, then raises QueueFull"""
+        if not self._threads:
+            self.start()
+        with self._cond:
+            if self._depth >= self.max_queue:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._depth >= self.max_queue:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._rejected += 1
+                        raise QueueFull(f"{self.name} queue full ({self.max_queue} items)")
+                    self._not_full.wait(remaining)
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append((time.monotonic(), stage, args))
+            if len(queue) == 1 and key not in self._busy:
+                self._ready.append(key)
+            self._depth += 1
+            if self._depth > self._max_depth:
+                self._max_depth = self._depth
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                self._busy.add(key)
+                enqueued_at, stage, args = self._queues[key].popleft()
+
+            started = time.monotonic()
+            failed = False
+            try:
+                self._handler(*args)
+            except Exception as e:
+                failed = True
+                log.error(f"❌ {self.name} worker error for {key}: {e}")
+            finished = time.monotonic()
+
+            with self._cond:
+                self._busy.discard(key)
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._queues[key]
+                self._depth -= 1
+                self._not_full.notify()
+
+                stats = self._stages.get(stage)
+                if stats is None:
+                    stats = self._stages[stage] = _StageStats()
+                stats.record(started - enqueued_at, finished - started, failed)
+
+    def depth(self):
+        return self._depth
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queue_depth": self._depth,
+                "queue_depth_max": self._max_depth,
+                "queue_capacity": self.max_queue,
+                "active_keys": len(self._queues),
+                "busy_keys": len(self._busy),
+                "rejected": self._rejected,
+                "stages": {stage: stats.as_dict() for stage, stats in sorted(self._stages.items())},
+            }
+
+
+class AsyncOrderedDispatcher:
+    """OrderedDispatcher for coroutine handlers on one event loop.
+
+    The same per-key FIFO and ready line, served by `concurrency` tasks, so at most that
+    many handlers are in flight.  submit() is awaited and suspends the caller while the
+    queue is full, which pushes back on the MQTT reader instead of growing memory.
+    """
+
+    def __init__(self, handler, concurrency=64, max_queue=10000, name="dispatch"):
+        self._handler = handler
+        self.workers = concurrency
+        self.max_queue = max_queue
+        self.name = name
+
+        self._cond = None  # asyncio.Condition, created on the loop by start()
+        self._queues = {}
+        self._ready = deque()
+        self._busy = set()
+        self._depth = 0
+        self._max_depth = 0
+        self._rejected = 0
+        self._tasks = []
+        self._stages = {}
+
+    def start(self):
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.ensure_future(self._run()) for _ in range(self.workers)]
+
+    async def submit(self, key, stage, *args, timeout=None):
+        """Queue handler(*args) under key; waits up to timeout for space, then raises QueueFull"""
+        if not self._tasks:
+            self.start()
+        async with self._cond:
+            if self._depth >= self.max_queue:
+                try:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self._depth < self.max_queue), timeout)
+                except asyncio.TimeoutError:
+                    self._rejected += 1
+                    raise QueueFull(f"{self.name} queue full ({self.max_queue} items)")
+
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append((time.monotonic(), stage, args))
+            if len(queue) == 1 and key not in self._busy:
+                self._ready.append(key)
+            self._depth += 1
+            if self._depth > self._max_depth:
+                self._max_depth = self._depth
+            self._cond.notify_all()
+
+    async def _run(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._ready)
+                key = self._ready.popleft()
+                self._busy.add(key)
+                enqueued_at, stage, args = self._queues[key].popleft()
+
+            started = time.monotonic()
+            failed = False
+            try:
+                await self._handler(*args)
+            except Exception as e:
+                failed = True
+                log.error(f"❌ {self.name} task error for {key}: {e}")
+            finished = time.monotonic()
+
+            async with self._cond:
+                self._busy.discard(key)
+                if self._queues[key]:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._depth -= 1
+                self._cond.notify_all()
+
+                stats = self._stages.get(stage)
+                if stats is None:
+                    stats = self._stages[stage] = _StageStats()
+                stats.record(started - enqueued_at, finished - started, failed)
+
+    async def join(self):
+        """Wait until every queued item has been handled"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._depth == 0)
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def depth(self):
+        return self._depth
+
+    def stats(self):
+        # Read from the status thread without the loop's lock; every field is a plain snapshot
+        return {
+            "workers": self.workers,
+            "queue_depth": self._depth,
+            "queue_depth_max": self._max_depth,
+            "queue_capacity": self.max_queue,
+            "active_keys": len(self._queues),
+            "busy_keys": len(self._busy),
+            "rejected": self._rejected,
+            "stages": {stage: stats.as_dict() for stage, stats in sorted(list(self._stages.items()))},
+        }
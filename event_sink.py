@@ -0,0 +1,61 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+import psycopg2.extras
+
+LOCATION_QUANTUM = Decimal("0.0001")  # ~11 m, the tolerance the old ABS() duplicate check used
+
+# Unique key the database uses to reject duplicate events; quantize() mirrors it in memory
+EVENTS_UNIQUE_INDEX_DDL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS events_dedupe_uidx
+    ON events (vehicle_id, driver_id, timestamp, event_type,
+               (round(lat::numeric, 4)), (round(lon::numeric, 4)))
+"""
+
+
+def quantize(coordinate):
+    """Round a coordinate the way round(x::numeric, 4) does in Postgres"""
+    return Decimal(str(coordinate)).quantize(LOCATION_QUANTUM, rounding=ROUND_HALF_UP)
+
+
+class EventSink:
+    """Collects the events of one batch, drops duplicates and writes them in one statement"""
+
+    def __init__(self, page_size=1000):
+        self.page_size = page_size
+        self._events = {}
+        self.duplicates = 0
+        self.inserted = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, vehicle_id, driver_id, timestamp, lat, lon, event_type):
+        """Queue an event; returns False if the same event is already queued"""
+        key = (vehicle_id, driver_id, timestamp, event_type, quantize(lat), quantize(lon))
+        if key in self._events:
+            self.duplicates += 1
+            return False
+        self._events[key] = (vehicle_id, driver_id, timestamp, lat, lon, event_type)
+        return True
+
+    def rows(self):
+        return list(self._events.values())
+
+    def flush(self, cursor):
+        """Insert all queued events, letting events_dedupe_uidx reject ones already stored.
+
+        Returns (inserted, duplicates) where duplicates counts both in-batch repeats and
+        events that were already in the table.  The caller commits.
+        """
+        rows = self.rows()
+        if rows:
+            inserted = psycopg2.extras.execute_values(cursor, """
+                INSERT INTO events (vehicle_id, driver_id, timestamp, lat, lon, event_type)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            """, rows, page_size=self.page_size, fetch=True)
+            self.inserted += len(inserted)
+            self.duplicates += len(rows) - len(inserted)
+        self._events.clear()
+        return self.inserted, self.duplicates
@@ -0,0 +1,124 @@
+"""Vectorized great-circle and ellipsoidal distances for whole GPS sessions.
+
+All functions take latitude/longitude in degrees and return kilometres.  A session
+of N points is handled in one NumPy pass, giving N - 1 segment distances.
+"""
+import os
+
+import numpy as np
+from geopy.distance import geodesic
+
+# geopy's mean earth radius, so haversine results line up with geopy.distance.great_circle
+EARTH_RADIUS_KM = 6371.009
+
+# WGS-84 ellipsoid (geopy's default for geodesic)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+MODES = ("haversine", "ellipsoidal")
+DISTANCE_MODE = os.getenv("DISTANCE_MODE", "ellipsoidal")
+# Maximum allowed deviation from geopy.geodesic per segment in ellipsoidal mode, in metres
+DISTANCE_TOLERANCE_M = float(os.getenv("DISTANCE_TOLERANCE_M", "0.001"))
+VINCENTY_MAX_ITERATIONS = 200
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Spherical distance between paired coordinates"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((lon2 - lon1) / 2)
+    h = sin_dlat * sin_dlat + np.cos(lat1) * np.cos(lat2) * sin_dlon * sin_dlon
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def vincenty_km(lat1, lon1, lat2, lon2, tolerance_m=DISTANCE_TOLERANCE_M, max_iterations=VINCENTY_MAX_ITERATIONS):
+    """Vincenty inverse distance on WGS-84 between paired coordinates.
+
+    Pairs for which the iteration does not converge (nearly antipodal points) are
+    computed with geopy's Karney geodesic instead, so every result is within
+    tolerance_m of geopy.distance.geodesic.
+    """
+    lat1 = np.asarray(lat1, dtype=np.float64)
+    lon1 = np.asarray(lon1, dtype=np.float64)
+    lat2 = np.asarray(lat2, dtype=np.float64)
+    lon2 = np.asarray(lon2, dtype=np.float64)
+
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+    # A change in lambda of this many radians moves the result by at most ~tolerance_m
+    lambda_tolerance = tolerance_m / WGS84_A
+
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(U1), np.cos(U1)
+    sin_u2, cos_u2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha * sin_alpha
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m * cos_2sigma_m)))
+            converged = np.abs(lam - lam_prev) < lambda_tolerance
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (a * a - b * b) / (b * b)
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m * cos_2sigma_m)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma * sin_sigma) * (-3 + 4 * cos_2sigma_m * cos_2sigma_m)))
+        meters = b * A * (sigma - delta_sigma)
+
+    bad = ~converged | ~np.isfinite(meters)
+    if bad.any():
+        meters = np.array(meters, dtype=np.float64, copy=True)
+        for idx in zip(*np.nonzero(bad)):
+            meters[idx] = geodesic((lat1[idx], lon1[idx]), (lat2[idx], lon2[idx])).meters
+    return meters / 1000.0
+
+
+def segment_distances_km(lats, lons, mode=None, tolerance_m=None):
+    """Distances between consecutive points of a session (length N - 1)"""
+    mode = mode or DISTANCE_MODE
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if lats.shape != lons.shape or lats.ndim != 1:
+        raise ValueError("lats and lons must be 1-D arrays of equal length")
+    if len(lats) < 2:
+        return np.zeros(0, dtype=np.float64)
+
+    if mode == "haversine":
+        return haversine_km(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    if mode == "ellipsoidal":
+        tolerance_m = DISTANCE_TOLERANCE_M if tolerance_m is None else tolerance_m
+        return vincenty_km(lats[:-1], lons[:-1], lats[1:], lons[1:], tolerance_m=tolerance_m)
+    raise ValueError(f"Unknown distance mode: {mode} (expected one of {MODES})")
+
+
+def path_distance_km(lats, lons, mode=None, tolerance_m=None):
+    """Per-segment distances and their total for a session"""
+    segments = segment_distances_km(lats, lons, mode=mode, tolerance_m=tolerance_m)
+    return segments, float(segments.sum())
+
+
+def max_deviation_from_geopy_m(lats, lons, mode=None, tolerance_m=None):
+    """Largest per-segment difference from geopy.geodesic in metres, for validating a mode"""
+    segments = segment_distances_km(lats, lons, mode=mode, tolerance_m=tolerance_m)
+    worst = 0.0
+    for i, distance in enumerate(segments):
+        expected = geodesic((lats[i], lons[i]), (lats[i + 1], lons[i + 1])).kilometers
+        worst = max(worst, abs(distance - expected) * 1000.0)
+    return worst
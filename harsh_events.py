@@ -0,0 +1,138 @@
+"""Vectorized harsh braking / acceleration detection over a whole trip.
+
+Timestamps are parsed once into an epoch array, speeds are median-smoothed with a
+rolling window, and the 1 s, 2 s and 3 s acceleration windows are evaluated as
+NumPy array expressions.  Detections come back as a compact structured array.
+"""
+import json
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+PKT = pytz.timezone('Asia/Karachi')
+EPOCH = datetime(1970, 1, 1)
+
+HARSH_BRAKE = 0
+HARSH_ACCELERATION = 1
+EVENT_TYPES = ('harsh_brake', 'harsh_acceleration')
+
+# One row per detection: point index, EVENT_TYPES code, window length in points
+EVENT_DTYPE = np.dtype([('index', np.int32), ('event', np.int8), ('window', np.int8)])
+
+
+@dataclass(frozen=True)
+class HarshEventProfile:
+    """Acceleration thresholds in km/h per second for each look-back window"""
+    brake_1s: float = -15.0
+    accel_1s: float = 19.0
+    brake_2s: float = -13.5  # ~ -27 km/h over 2s
+    accel_2s: float = 13.5  # ~ +27 km/h over 2s
+    brake_3s: float = -13.3  # ~ -40 km/h over 3s
+    accel_3s: float = 11.7  # ~ +35 km/h over 3s
+    min_speed: float = 10.0  # ignore parking/creep when both speeds are below this
+    smoothing_window: int = 3
+
+    @classmethod
+    def from_json(cls, text):
+        """Profile with the fields given in a JSON object overriding the defaults"""
+        overrides = json.loads(text) if text else {}
+        known = {f.name for f in fields(cls)}
+        unknown = set(overrides) - known
+        if unknown:
+            raise ValueError(f"Unknown harsh event profile fields: {sorted(unknown)}")
+        return cls(**overrides)
+
+
+DEFAULT_PROFILE = HarshEventProfile()
+
+
+def _parse_one(timestamp):
+    dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        # Same wall-clock frame as convert_to_pkt uses for stored timestamps
+        dt = dt.astimezone(PKT).replace(tzinfo=None)
+    return (dt - EPOCH).total_seconds()
+
+
+def parse_timestamps(timestamps):
+    """Epoch seconds for each timestamp string; NaN where a value cannot be parsed"""
+    if not any('T' in t or 'Z' in t for t in timestamps):
+        try:
+            return np.array(timestamps, dtype='datetime64[s]').astype(np.int64).astype(np.float64)
+        except ValueError:
+            pass
+
+    epochs = np.empty(len(timestamps), dtype=np.float64)
+    for i, timestamp in enumerate(timestamps):
+        try:
+            epochs[i] = _parse_one(timestamp)
+        except (ValueError, TypeError, AttributeError):
+            epochs[i] = np.nan
+    return epochs
+
+
+def rolling_median(speeds, window_size=3):
+    """Centred median filter that shrinks the window at the edges (like statistics.median on slices)"""
+    speeds = np.asarray(speeds, dtype=np.float64)
+    n = len(speeds)
+    if n < window_size:
+        return speeds.copy()
+
+    half_window = window_size // 2
+    width = 2 * half_window + 1
+    smoothed = np.empty(n, dtype=np.float64)
+    if n >= width:
+        smoothed[half_window:n - half_window] = np.median(
+            np.lib.stride_tricks.sliding_window_view(speeds, width), axis=1)
+    for i in list(range(min(half_window, n))) + list(range(max(half_window, n - half_window), n)):
+        smoothed[i] = np.median(speeds[max(0, i - half_window):min(n, i + half_window + 1)])
+    return smoothed
+
+
+def _window_events(events, valid, accel, brake_threshold, accel_threshold, window):
+    brake = valid & (accel <= brake_threshold)
+    harsh_accel = valid & ~brake & (accel >= accel_threshold)
+    for mask, code in ((brake, HARSH_BRAKE), (harsh_accel, HARSH_ACCELERATION)):
+        index = np.nonzero(mask)[0] + window
+        chunk = np.empty(len(index), dtype=EVENT_DTYPE)
+        chunk['index'] = index
+        chunk['event'] = code
+        chunk['window'] = window
+        events.append(chunk)
+
+
+def detect(epochs, speeds, profile=DEFAULT_PROFILE):
+    """Detect harsh events; returns an EVENT_DTYPE array ordered by point then window"""
+    speeds = np.asarray(speeds, dtype=np.float64)
+    epochs = np.asarray(epochs, dtype=np.float64)
+    n = len(speeds)
+    if n < 2:
+        return np.empty(0, dtype=EVENT_DTYPE)
+
+    smoothed = rolling_median(speeds, profile.smoothing_window)
+    current = smoothed[1:]
+
+    # Points i = 1..n-1 that are evaluated at all
+    moving = ~((current < profile.min_speed) & (smoothed[:-1] < profile.min_speed))
+    dt1 = epochs[1:] - epochs[:-1]
+    # An unparseable timestamp is treated as a 1 s interval for the 1 s window only
+    dt1 = np.where(np.isnan(dt1), 1.0, dt1)
+    active = moving & (dt1 > 0)
+
+    events = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        _window_events(events, active, (current - smoothed[:-1]) / dt1,
+                       profile.brake_1s, profile.accel_1s, 1)
+        for window, brake_threshold, accel_threshold in ((2, profile.brake_2s, profile.accel_2s),
+                                                         (3, profile.brake_3s, profile.accel_3s)):
+            if n <= window:
+                break
+            delta = epochs[window:] - epochs[:-window]
+            valid = active[window - 1:] & (delta > 0)
+            accel = (smoothed[window:] - smoothed[:-window]) / delta
+            _window_events(events, valid, accel, brake_threshold, accel_threshold, window)
+
+    result = np.concatenate(events)
+    return result[np.lexsort((result['window'], result['index']))]
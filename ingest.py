@@ -0,0 +1,57 @@
+"""Ingest process: MQTT subscriptions and GPS processing without the web server.
+
+gunicorn only serves the Flask app, so the web dyno never subscribes to anything.
+Run this next to it (see Procfile) and scale it out with
+
+    INGEST_SHARE_GROUP=gps-ingest INGEST_SHARDS=<n> python ingest.py
+
+Live and boot messages are split between the processes by the shared subscription.
+Batch sessions stay on the process that owns the device (see INGEST_BATCH_ROUTING in
+server.py).  Set INGEST_STATUS_PORT to serve this process's status endpoints
+(/sessions, /dispatch, /live_buffer, /mqtt_status); the web dyno answers them with 404
+as it ingests nothing.  /positions covers the whole fleet in every process, through
+the latest_positions table.
+
+`python -m benchmarks.shared_subscriptions` checks a broker against this setup: two
+such processes must handle every message exactly once, batches on the owning shard.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+
+import server
+
+log = logging.getLogger("ingest")
+
+
+def main():
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        log.info(f"🛑 Ingest process received signal {signum}, shutting down")
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    log.info(f"🚀 Starting MQTT ingest {server.MQTT_CLIENT_ID} "
+             f"(shard {server.INGEST_SHARD_INDEX + 1}/{server.INGEST_SHARDS}, "
+             f"batch routing {server.INGEST_BATCH_ROUTING})")
+    server.start_mqtt()
+
+    status_port = os.getenv("INGEST_STATUS_PORT")
+    if status_port:
+        threading.Thread(target=server.app.run, kwargs={"host": "0.0.0.0", "port": int(status_port)},
+                         daemon=True).start()
+
+    stopped.wait()
+    server.mqtt_client.disconnect()
+    server.mqtt_client.loop_stop()
+    # atexit flushes the live write buffer and closes the session spool
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
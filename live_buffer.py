@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class LiveWriteBuffer:
+    """Write-behind buffer for live GPS points.
+
+    submit() only deduplicates against the last timestamp seen for the device/driver
+    and appends to a bounded queue, so the MQTT thread never waits on Postgres.  A
+    flusher thread hands rows to write_rows() in batches of up to max_batch, as soon
+    as a batch is full or the oldest queued row is max_delay seconds old.  When the
+    queue is full the oldest rows are dropped - newer positions supersede them.
+    """
+
+    max_split_writes = 64
+
+    def __init__(self, write_rows, max_batch=500, max_delay=0.2, max_pending=50000):
+        self._write_rows = write_rows
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = deque()  # (enqueued_at, row)
+        self._last_timestamp = {}  # (device_id, driver_id) -> timestamp
+        self._thread = None
+        self._stopping = False
+
+        self._accepted = 0
+        self._duplicates = 0
+        self._dropped = 0
+        self._failed = 0
+        self._flushed = 0
+        self._batches = 0
+        self._max_depth = 0
+        self._flush_total = 0.0
+        self._flush_max = 0.0
+        self._flush_last = 0.0
+        self._lag_max = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="live-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, device_id, driver_id, timestamp, lat, lon, speed):
+        """Queue a live point; returns 'queued', 'duplicate' or 'stopped'"""
+        if self._thread is None:
+            self.start()
+        key = (device_id, driver_id)
+        with self._cond:
+            if self._stopping:
+                return "stopped"
+            if self._last_timestamp.get(key) == timestamp:
+                self._duplicates += 1
+                return "duplicate"
+            self._last_timestamp[key] = timestamp
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self._dropped += 1
+            self._pending.append((time.monotonic(), (device_id, driver_id, timestamp, lat, lon, speed)))
+            self._accepted += 1
+            depth = len(self._pending)
+            if depth > self._max_depth:
+                self._max_depth = depth
+            if depth == 1 or depth >= self.max_batch:
+                self._wake()
+        return "queued"
+
+    def _wake(self):
+        self._cond.notify()
+
+    def _pop_batch(self):
+        """A batch that is due, else (None, seconds until one can be), under the lock"""
+        if not self._pending:
+            return None, None
+        age = time.monotonic() - self._pending[0][0]
+        if self._stopping or len(self._pending) >= self.max_batch or age >= self.max_delay:
+            count = min(len(self._pending), self.max_batch)
+            return [self._pending.popleft() for _ in range(count)], None
+        return None, self.max_delay - age
+
+    def _take_batch(self):
+        """Wait for a full batch or for the oldest row to reach max_delay; None once stopped and drained"""
+        with self._cond:
+            while True:
+                batch, wait = self._pop_batch()
+                if batch is not None:
+                    return batch
+                if self._stopping:
+                    return None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        rows = [row for _, row in batch]
+        try:
+            self._write_rows(rows)
+            failed = 0
+        except Exception as e:
+            log.warning(f"⚠️ Flushing {len(rows)} live GPS points failed, retrying in halves: {e}")
+            failed = self._write_halves(rows)
+        self._record_flush(batch, failed, started)
+
+    def _write_halves(self, rows):
+        """Retry a failed batch in halves (see _split_retry); returns the rows dropped"""
+        retry = _split_retry(rows, self.max_split_writes)
+        try:
+            part = next(retry)
+            while True:
+                try:
+                    self._write_rows(part)
+                    error = None
+                except Exception as e:
+                    error = e
+                part = retry.send(error)
+        except StopIteration as done:
+            return done.value
+
+    def _record_flush(self, batch, failed, started):
+        finished = time.monotonic()
+        elapsed = finished - started
+        with self._cond:
+            self._flushed += len(batch) - failed
+            self._failed += failed
+            self._batches += 1
+            self._flush_total += elapsed
+            self._flush_last = elapsed
+            self._flush_max = max(self._flush_max, elapsed)
+            self._lag_max = max(self._lag_max, finished - batch[0][0])
+
+    def close(self, timeout=10.0):
+        """Stop accepting points and flush everything still queued"""
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "queue_depth_max": self._max_depth,
+                "queue_capacity": self.max_pending,
+                "max_batch": self.max_batch,
+                "max_delay_ms": round(self.max_delay * 1000, 1),
+                "accepted": self._accepted,
+                "duplicates": self._duplicates,
+                "dropped_overflow": self._dropped,
+                "flushed_rows": self._flushed,
+                "failed_rows": self._failed,
+                "batches": self._batches,
+                "flush_last_ms": round(self._flush_last * 1000, 2),
+                "flush_avg_ms": round(self._flush_total / self._batches * 1000, 2) if self._batches else 0.0,
+                "flush_max_ms": round(self._flush_max * 1000, 2),
+                "insert_lag_max_ms": round(self._lag_max * 1000, 2),
+                "devices_tracked": len(self._last_timestamp),
+            }
+
+
+class AsyncLiveWriteBuffer(LiveWriteBuffer):
+    """LiveWriteBuffer whose flusher is a task on the running event loop.
+
+    write_rows is a coroutine function.  submit() stays synchronous and is meant to be
+    called from the loop; the lock it takes is never held across an await.
+    """
+
+    def __init__(self, write_rows, max_batch=500, max_delay=0.2, max_pending=50000):
+        super().__init__(write_rows, max_batch, max_delay, max_pending)
+        self._loop = None
+        self._event = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            self._thread = self._loop.create_task(self._run_async())
+
+    def _wake(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def _run_async(self):
+        while True:
+            with self._cond:
+                batch, wait = self._pop_batch()
+                if batch is None and self._stopping:
+                    return
+                self._event.clear()
+            if batch is None:
+                try:
+                    await asyncio.wait_for(self._event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            started = time.monotonic()
+            rows = [row for _, row in batch]
+            try:
+                await self._write_rows(rows)
+                failed = 0
+            except Exception as e:
+                log.warning(f"⚠️ Flushing {len(rows)} live GPS points failed, retrying in halves: {e}")
+                failed = await self._write_halves_async(rows)
+            self._record_flush(batch, failed, started)
+
+    async def _write_halves_async(self, rows):
+        """_write_halves with the writes awaited"""
+        retry = _split_retry(rows, self.max_split_writes)
+        try:
+            part = next(retry)
+            while True:
+                try:
+                    await self._write_rows(part)
+                    error = None
+                except Exception as e:
+                    error = e
+                part = retry.send(error)
+        except StopIteration as done:
+            return done.value
+
+    async def aclose(self, timeout=10.0):
+        """Stop accepting points and flush everything still queued"""
+        with self._cond:
+            self._stopping = True
+            task = self._thread
+        if task is None:
+            return
+        self._event.set()
+        try:
+            await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"⚠️ Live write buffer still had {len(self._pending)} points after {timeout}s")
+        self._thread = None
+
+    def close(self, timeout=10.0):
+        # The loop is gone by the time atexit runs; aclose() is the shutdown path
+        with self._cond:
+            self._stopping = True
+
+
+def _split_retry(rows, max_writes):
+    """Retry plan for a failed batch: halves it until the failing rows are isolated.
+
+    A generator shared by the sync and async buffers: it yields each part to write and
+    is sent the exception that write raised, or None.  It returns the rows dropped.  At
+    most max_writes writes are spent, and the retry stops once two single rows failed
+    before any write succeeded, so an unreachable database does not turn one failed
+    flush into hundreds.
+    """
+    failed = writes = 0
+    written = False
+    parts = _halves(rows)
+    while parts:
+        part = parts.pop()
+        if writes >= max_writes:
+            failed += len(part)
+            continue
+        writes += 1
+        error = yield part
+        if error is None:
+            written = True
+        elif len(part) > 1:
+            parts += _halves(part)
+        else:
+            failed += 1
+            log.error(f"❌ Dropping live GPS point {part[0]}: {error}")
+            if not written and failed >= 2:
+                # Nothing has gone through at all: the database, not a row, is the problem
+                failed += sum(len(p) for p in parts)
+                parts = []
+    if failed:
+        log.error(f"❌ Dropped {failed} of {len(rows)} live GPS points")
+    return failed
+
+
+def _halves(rows):
+    """The two halves of rows, ordered so that pop() returns the first half"""
+    middle = len(rows) // 2
+    return [rows[middle:], rows[:middle]]
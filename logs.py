@@ -0,0 +1,171 @@
+"""Logging setup shared by the web and ingest processes.
+
+Loggers hand records to a bounded queue (QueueHandler) and return at once; a
+listener thread writes them to stderr and into a ring buffer of LogEntry tuples
+that the / page reads.  When the queue is full records are dropped and counted
+rather than making a hot path wait.
+
+Levels are set per logger with LOG_LEVELS, e.g. "server=INFO,server.points=WARNING,
+dispatch=DEBUG", on top of LOG_LEVEL for everything else.  Per-point lines go to the
+"server.points" logger, which passes at most LOG_POINT_RATE records per second.
+"""
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+POINTS_LOGGER = "server.points"
+
+LogEntry = namedtuple("LogEntry", "created level logger device_id message")
+
+# Device whose message is being handled, stamped on every record logged meanwhile
+current_device = contextvars.ContextVar("current_device", default=None)
+
+
+@contextmanager
+def device_context(device_id):
+    token = current_device.set(device_id)
+    try:
+        yield
+    finally:
+        current_device.reset(token)
+
+
+class _DeviceFilter(logging.Filter):
+    def filter(self, record):
+        if getattr(record, "device_id", None) is None:
+            record.device_id = current_device.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `rate` records per second; the rest are counted as suppressed"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.suppressed = 0
+        self._window = 0
+        self._passed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        window = int(time.monotonic())
+        with self._lock:
+            if window != self._window:
+                self._window = window
+                self._passed = 0
+            if self._passed < self.rate:
+                self._passed += 1
+                return True
+            self.suppressed += 1
+            return False
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records as LogEntry tuples"""
+
+    def __init__(self, capacity=2000):
+        super().__init__()
+        self._entries = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self._entries.append(LogEntry(record.created, record.levelno, record.name,
+                                      getattr(record, "device_id", None), record.getMessage()))
+
+    def query(self, min_level=logging.NOTSET, device_id=None, limit=50):
+        """The newest `limit` entries at or above min_level (for device_id, if given), oldest first"""
+        self.acquire()
+        try:
+            entries = list(self._entries)
+        finally:
+            self.release()
+        found = []
+        for entry in reversed(entries):
+            if entry.level >= min_level and (device_id is None or entry.device_id == device_id):
+                found.append(entry)
+                if len(found) >= limit:
+                    break
+        found.reverse()
+        return found
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def parse_levels(spec):
+    """{"logger": level} from "name=LEVEL,name=LEVEL" """
+    levels = {}
+    for part in (spec or "").split(","):
+        name, _, level = part.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class _LogSystem:
+    def __init__(self):
+        self.ring = None
+        self.queue_handler = None
+        self.points_filter = None
+        self.listener = None
+
+    def stats(self):
+        return {
+            "buffered": len(self.ring) if self.ring else 0,
+            "dropped_queue_full": self.queue_handler.dropped if self.queue_handler else 0,
+            "point_lines_suppressed": self.points_filter.suppressed if self.points_filter else 0,
+        }
+
+
+log_system = _LogSystem()
+
+
+def configure(level="INFO", levels=None, capacity=2000, queue_size=10000, point_rate=5.0):
+    """Install the queue handler on the root logger once; returns the ring buffer"""
+    if log_system.ring is not None:
+        return log_system.ring
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = _DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(_DeviceFilter())
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    ring = RingBufferHandler(capacity)
+    listener = logging.handlers.QueueListener(log_queue, console, ring, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for name, name_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(name_level)
+    points_filter = RateLimitFilter(point_rate)
+    logging.getLogger(POINTS_LOGGER).addFilter(points_filter)
+
+    log_system.ring = ring
+    log_system.queue_handler = queue_handler
+    log_system.points_filter = points_filter
+    log_system.listener = listener
+    return ring
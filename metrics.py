@@ -0,0 +1,135 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Stage timers are histograms of wall-clock seconds labelled by stage, recorded with
+the @timed decorator or the timer() context manager.  Gauges are read from
+callbacks when /metrics is scraped, so they cost nothing in between.  Every process
+(each gunicorn worker, each ingest process) reports only its own numbers.
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+
+# Upper bounds in seconds, from sub-millisecond cache hits to multi-second batch saves
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "gps_"
+
+
+class _Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "errors", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, failed=False):
+        i = bisect.bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+            self.errors += failed
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count, self.errors
+
+
+class Registry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._stages = {}
+        self._gauges = []  # (name, help, callback, label)
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        histogram = self._stages.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(name, _Histogram(self.buckets))
+        return histogram
+
+    def observe(self, stage, seconds, failed=False):
+        self.stage(stage).observe(seconds, failed)
+
+    def gauge(self, name, help_text, callback, label="name"):
+        """Register callback() -> number, or -> {label value: number} for a labelled gauge"""
+        self._gauges.append((name, help_text, callback, label))
+
+    def timed(self, stage):
+        """Decorator recording each call's duration under stage; exceptions count as errors"""
+        histogram = self.stage(stage)
+
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    histogram.observe(time.perf_counter() - started, failed)
+            return wrapper
+        return decorate
+
+    def timer(self, stage):
+        return _Timer(self.stage(stage))
+
+    def render(self):
+        lines = [
+            f"# HELP {PREFIX}stage_seconds Time spent in each processing stage",
+            f"# TYPE {PREFIX}stage_seconds histogram",
+        ]
+        errors = []
+        for stage, histogram in sorted(list(self._stages.items())):
+            counts, total, count, failed = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{PREFIX}stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{PREFIX}stage_seconds_count{{stage="{stage}"}} {count}')
+            errors.append(f'{PREFIX}stage_errors_total{{stage="{stage}"}} {failed}')
+        lines += [f"# HELP {PREFIX}stage_errors_total Stage calls that raised",
+                  f"# TYPE {PREFIX}stage_errors_total counter"] + errors
+
+        for name, help_text, callback, label in self._gauges:
+            try:
+                value = callback()
+            except Exception:
+                continue
+            lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} gauge"]
+            if isinstance(value, dict):
+                for key, v in sorted(value.items()):
+                    lines.append(f'{PREFIX}{name}{{{label}="{key}"}} {v}')
+            else:
+                lines.append(f"{PREFIX}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, exc_type is not None)
+        return False
+
+
+registry = Registry()
+timed = registry.timed
+timer = registry.timer
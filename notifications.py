@@ -0,0 +1,431 @@
+import bisect
+import json
+import logging
+import select
+import threading
+import time
+
+from psycopg2 import extensions
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "notifications_changed"
+
+# Installed by the server's ensure_schema().  seq orders notifications and is what the
+# devices acknowledge; notification_cursors keeps the highest seq each device acknowledged.
+# Existing rows are numbered by created_at (ctid breaks ties), not in physical order.
+SCHEMA_DDL = """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = current_schema() AND table_name = 'notifications'
+                         AND column_name = 'seq') THEN
+            ALTER TABLE notifications ADD COLUMN seq BIGINT;
+            UPDATE notifications n SET seq = o.rn
+            FROM (SELECT ctid, ROW_NUMBER() OVER (ORDER BY created_at, ctid) AS rn FROM notifications) o
+            WHERE n.ctid = o.ctid;
+            CREATE SEQUENCE IF NOT EXISTS notifications_seq_seq OWNED BY notifications.seq;
+            PERFORM setval('notifications_seq_seq', COALESCE((SELECT MAX(seq) FROM notifications), 0) + 1, false);
+            ALTER TABLE notifications
+                ALTER COLUMN seq SET DEFAULT nextval('notifications_seq_seq'),
+                ALTER COLUMN seq SET NOT NULL;
+        END IF;
+    END $$;
+    CREATE INDEX IF NOT EXISTS notifications_seq_idx ON notifications (seq);
+    CREATE INDEX IF NOT EXISTS notifications_vehicle_seq_idx ON notifications (vehicle_id, seq);
+    CREATE TABLE IF NOT EXISTS notification_cursors (
+        device_id TEXT PRIMARY KEY,
+        acked_seq BIGINT NOT NULL,
+        acked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+# One NOTIFY per INSERT statement, so a unit-wide fan-out wakes the listeners once
+TRIGGER_DDL = f"""
+    CREATE OR REPLACE FUNCTION notify_notifications_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS notifications_inserted ON notifications;
+    CREATE TRIGGER notifications_inserted
+        AFTER INSERT ON notifications
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_notifications_changed();
+"""
+
+REFRESH_PAGE_SIZE = 5000
+# A seq is taken at INSERT but visible only at COMMIT, so overlapping inserts can show a
+# higher seq before a lower one.  Seqs missing below the high-water mark are re-read on
+# every refresh until they appear or GAP_TIMEOUT seconds pass (a rolled-back insert
+# never fills its gap).  At startup the last STARTUP_GAP_WINDOW seqs are checked.
+GAP_TIMEOUT = 60.0
+MAX_GAPS = 10000
+STARTUP_GAP_WINDOW = 1000
+
+
+class NotificationFeed:
+    """Per-device delta delivery of the notifications table.
+
+    Every device has a delivery cursor, the highest seq it acknowledged on
+    gps/<id>/notifications/ack.  The feed keeps, per vehicle, only the notifications
+    above that cursor (at most max_pending) and publishes them retained on
+    device/<id>/notifications, so a reconnecting device gets its pending notifications
+    from the broker without a database query.  A state already published is not sent
+    again.
+
+    New rows are found with one query for everything above the highest seq seen plus
+    the seqs still missing below it, run on a NOTIFY from the insert trigger and every
+    poll_interval seconds, and pushed to the devices that owns(device_id) says this
+    process is responsible for.  The payload's version, which the device acknowledges,
+    is the newest pending seq below the first missing one: a late row can still arrive
+    under a higher seq already sent, so those items are sent but stay pending until a
+    later version covers them.  Devices de-duplicate items by seq.
+    """
+
+    def __init__(self, pool, publish, listen_connect=None, poll_interval=30.0, max_pending=100,
+                 owns=lambda device_id: True):
+        self._pool = pool
+        self._publish = publish  # publish(topic, payload) -> bool
+        self._listen_connect = listen_connect
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        self._owns = owns
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.RLock()
+        self._pending = {}  # vehicle_id -> [(seq, created_at, message)] above the cursor, oldest first
+        self._cursors = {}  # vehicle_id -> highest acknowledged seq
+        self._published = {}  # vehicle_id -> (version, since) last published
+        self._high_water = None  # highest seq seen by refresh()
+        self._gaps = {}  # seq missing below the high-water mark -> monotonic time first missed
+
+        self._loads = 0
+        self._refreshes = 0
+        self._refresh_errors = 0
+        self._last_refresh_ms = None
+        self._new_rows = 0
+        self._late_rows = 0
+        self._expired_gaps = 0
+        self._published_count = 0
+        self._unchanged = 0
+        self._acks = 0
+        self._stale_acks = 0
+        self._posted = 0
+        self._notifications = 0
+        self._listening = False
+        self._thread = None
+
+    # ------------------ loading ------------------
+
+    def _load(self, vehicle_id):
+        """Cursor and pending notifications of a vehicle not seen by this process yet"""
+        with self._pool.cursor() as cursor:
+            cursor.execute("SELECT acked_seq FROM notification_cursors WHERE device_id = %s", (vehicle_id,))
+            row = cursor.fetchone()
+            acked = row.acked_seq if row else 0
+            cursor.execute("""
+                SELECT seq, message, created_at FROM notifications
+                WHERE vehicle_id = %s AND seq > %s
+                ORDER BY seq DESC
+                LIMIT %s
+            """, (vehicle_id, acked, self.max_pending))
+            rows = cursor.fetchall()
+        with self._lock:
+            if vehicle_id not in self._pending:
+                self._cursors[vehicle_id] = acked
+                self._pending[vehicle_id] = [_entry(r) for r in reversed(rows)]
+                self._loads += 1
+
+    def _ensure_loaded(self, vehicle_id):
+        if vehicle_id not in self._pending:
+            if self._high_water is None:
+                # Set the mark first, so rows inserted after this load are merged by refresh()
+                self.refresh("initial")
+            self._load(vehicle_id)
+
+    def refresh(self, reason="manual"):
+        """Pick up notifications inserted since the last refresh and push them"""
+        with self._refresh_lock:
+            started = time.monotonic()
+            with self._lock:
+                stable_before = self._stable()
+            try:
+                changed = self._fetch_new()
+            except Exception:
+                with self._lock:
+                    self._refresh_errors += 1
+                raise
+            with self._lock:
+                self._refreshes += 1
+                self._last_refresh_ms = round((time.monotonic() - started) * 1000, 2)
+                stable = self._stable()
+                # A filled or expired gap raises the version of queues that were held below it
+                held = [v for v, p in self._pending.items()
+                        if p and p[-1][0] > (stable_before or 0)] if stable != stable_before else []
+        if changed:
+            log.info(f"🔔 {sum(changed.values())} new notifications for {len(changed)} vehicles ({reason})")
+        for vehicle_id in set(changed).union(held):
+            if self._owns(vehicle_id):
+                self.deliver(vehicle_id)
+        return changed
+
+    def _fetch_new(self):
+        """{vehicle_id: new rows} above the high-water mark or in its gaps, merged into the loaded queues"""
+        changed = {}
+        with self._pool.cursor() as cursor:
+            if self._high_water is None:
+                # First refresh: queues are loaded per vehicle on demand, so only the mark and
+                # the seqs missing just below it are needed
+                cursor.execute("""
+                    SELECT seq FROM notifications
+                    WHERE seq > (SELECT COALESCE(MAX(seq), 0) FROM notifications) - %s
+                    ORDER BY seq
+                """, (STARTUP_GAP_WINDOW,))
+                rows = cursor.fetchall()
+                with self._lock:
+                    self._high_water = max(0, rows[0].seq - 1) if rows else 0
+                    for r in rows:
+                        self._advance(r.seq)
+                return changed
+            self._expire_gaps()
+            while True:
+                with self._lock:
+                    gaps = sorted(self._gaps)
+                cursor.execute("""
+                    SELECT vehicle_id, seq, message, created_at FROM notifications
+                    WHERE seq > %s OR seq = ANY(%s)
+                    ORDER BY seq
+                    LIMIT %s
+                """, (self._high_water, gaps, REFRESH_PAGE_SIZE))
+                rows = cursor.fetchall()
+                for r in rows:
+                    vehicle_id = str(r.vehicle_id).strip()
+                    changed[vehicle_id] = changed.get(vehicle_id, 0) + 1
+                    with self._lock:
+                        if self._gaps.pop(r.seq, None) is not None:
+                            self._late_rows += 1
+                        else:
+                            self._advance(r.seq)
+                        self._merge(vehicle_id, _entry(r))
+                if len(rows) < REFRESH_PAGE_SIZE:
+                    break
+        self._new_rows += sum(changed.values())
+        return changed
+
+    def _advance(self, seq):
+        """Move the high-water mark to seq, remembering the seqs it skips; caller holds _lock"""
+        now = time.monotonic()
+        for missing in range(max(self._high_water + 1, seq - MAX_GAPS), seq):
+            self._gaps[missing] = now
+        if len(self._gaps) > MAX_GAPS:
+            for missing in sorted(self._gaps)[:len(self._gaps) - MAX_GAPS]:
+                del self._gaps[missing]
+        self._high_water = max(self._high_water, seq)
+
+    def _expire_gaps(self):
+        cutoff = time.monotonic() - GAP_TIMEOUT
+        with self._lock:
+            expired = [seq for seq, missed in self._gaps.items() if missed < cutoff]
+            for seq in expired:
+                del self._gaps[seq]
+            self._expired_gaps += len(expired)
+
+    def _merge(self, vehicle_id, entry):
+        """Insert a new row into a loaded queue in seq order; caller holds _lock"""
+        pending = self._pending.get(vehicle_id)
+        # Vehicles not loaded yet get the row with their first load
+        if pending is None or entry[0] <= self._cursors.get(vehicle_id, 0):
+            return
+        i = bisect.bisect_left(pending, entry)
+        if i < len(pending) and pending[i][0] == entry[0]:
+            return  # already read by _load()
+        pending.insert(i, entry)
+        del pending[:-self.max_pending]
+
+    def _stable(self):
+        """Highest seq below which no row can still appear; caller holds _lock"""
+        if self._high_water is None:
+            return None
+        return min(self._gaps) - 1 if self._gaps else self._high_water
+
+    # ------------------ delivery ------------------
+
+    def state(self, vehicle_id):
+        """(version, since, pending entries) of a vehicle"""
+        vehicle_id = str(vehicle_id).strip()
+        self._ensure_loaded(vehicle_id)
+        with self._lock:
+            since = self._cursors.get(vehicle_id, 0)
+            pending = list(self._pending.get(vehicle_id, ()))
+            return self._version(since, pending), since, pending
+
+    def _version(self, since, pending):
+        """Newest pending seq a device may acknowledge; caller holds _lock"""
+        stable = self._stable()
+        return max((seq for seq, _, _ in pending if stable is None or seq <= stable), default=since)
+
+    def deliver(self, device_id, force=False):
+        """Publish the device's pending notifications unless that state was already published"""
+        device_id = str(device_id).strip()
+        self._ensure_loaded(device_id)
+        with self._lock:
+            since = self._cursors.get(device_id, 0)
+            pending = list(self._pending.get(device_id, ()))
+            version = self._version(since, pending)
+            published = (version, since, tuple(seq for seq, _, _ in pending))
+            if not force and self._published.get(device_id) == published:
+                self._unchanged += 1
+                return True
+            # Serialised under the lock so an older state can never overwrite a newer retained one
+            payload = json.dumps({
+                "version": version,
+                "since": since,
+                "count": len(pending),
+                "items": [{"seq": seq, "created_at": created_at, "message": message}
+                          for seq, created_at, message in pending],
+                # Newest first, as the full-history payload was
+                "notifications": "\n".join(message for _, _, message in reversed(pending)),
+            })
+            sent = self._publish(f"device/{device_id}/notifications", payload)
+            if sent:
+                self._published[device_id] = published
+                self._published_count += 1
+        if sent:
+            log.info(f"📤 Sent {len(pending)} pending notifications to {device_id} (version {version})")
+        else:
+            log.error(f"❌ Failed to send notifications to {device_id}")
+        return sent
+
+    def acknowledge(self, device_id, version):
+        """Move the device's cursor to version and republish what is still pending"""
+        device_id = str(device_id).strip()
+        version = int(version)
+        self._ensure_loaded(device_id)
+        if version <= self._cursors.get(device_id, 0):
+            with self._lock:
+                self._stale_acks += 1
+            return False
+        with self._pool.cursor(commit=True) as cursor:
+            cursor.execute("""
+                INSERT INTO notification_cursors (device_id, acked_seq) VALUES (%s, %s)
+                ON CONFLICT (device_id) DO UPDATE
+                SET acked_seq = GREATEST(notification_cursors.acked_seq, EXCLUDED.acked_seq), acked_at = now()
+            """, (device_id, version))
+        with self._lock:
+            self._cursors[device_id] = max(self._cursors.get(device_id, 0), version)
+            self._pending[device_id] = [e for e in self._pending.get(device_id, ()) if e[0] > version]
+            self._acks += 1
+        log.info(f"✅ {device_id} acknowledged notifications up to {version}")
+        if self._owns(device_id):
+            self.deliver(device_id)
+        return True
+
+    def post(self, message, vehicle_id=None, unit=None, push=True):
+        """Insert a notification for one vehicle or every vehicle of a unit; returns the vehicle ids.
+
+        With push=False only the insert happens and the trigger's NOTIFY leaves delivery
+        to the processes that hold the MQTT connection.
+        """
+        if (vehicle_id is None) == (unit is None):
+            raise ValueError("give either vehicle_id or unit")
+        with self._pool.cursor(commit=True) as cursor:
+            if unit is not None:
+                cursor.execute("""
+                    INSERT INTO notifications (vehicle_id, message, created_at)
+                    SELECT id, %s, now() FROM vehicles WHERE unit = %s
+                    RETURNING vehicle_id
+                """, (message, unit))
+            else:
+                cursor.execute("""
+                    INSERT INTO notifications (vehicle_id, message, created_at)
+                    VALUES (%s, %s, now())
+                    RETURNING vehicle_id
+                """, (vehicle_id, message))
+            vehicles = [str(r.vehicle_id).strip() for r in cursor.fetchall()]
+        with self._lock:
+            self._posted += len(vehicles)
+        if push:
+            # Push now rather than waiting for the NOTIFY round trip
+            self.refresh("post")
+        return vehicles
+
+    def pending_count(self):
+        with self._lock:
+            return sum(len(p) for p in self._pending.values())
+
+    # ------------------ change detection ------------------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name="notifications", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            conn = None
+            try:
+                if self._listen_connect is None:
+                    raise RuntimeError("no LISTEN connection configured")
+                conn = self._listen_connect()
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                self._listening = True
+                # Rows inserted while we were not listening would otherwise wait for the poll
+                self.refresh("listen_start")
+                while True:
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        self.refresh("poll")
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        self._notifications += len(conn.notifies)
+                        conn.notifies.clear()
+                        self.refresh("notify")
+            except Exception as e:
+                self._listening = False
+                log.warning(f"⚠️ Notification listener unavailable, polling instead: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                deadline = time.monotonic() + 60.0
+                while time.monotonic() < deadline:
+                    time.sleep(max(0.0, min(self.poll_interval, deadline - time.monotonic())))
+                    try:
+                        self.refresh("poll")
+                    except Exception as refresh_error:
+                        log.error(f"❌ Notification refresh failed: {refresh_error}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "vehicles_loaded": len(self._pending),
+                "pending": sum(len(p) for p in self._pending.values()),
+                "high_water": self._high_water,
+                "open_gaps": len(self._gaps),
+                "late_rows": self._late_rows,
+                "expired_gaps": self._expired_gaps,
+                "max_pending": self.max_pending,
+                "poll_interval": self.poll_interval,
+                "listening": self._listening,
+                "notifications": self._notifications,
+                "loads": self._loads,
+                "refreshes": self._refreshes,
+                "refresh_errors": self._refresh_errors,
+                "last_refresh_ms": self._last_refresh_ms,
+                "new_rows": self._new_rows,
+                "posted": self._posted,
+                "published": self._published_count,
+                "unchanged_skipped": self._unchanged,
+                "acks": self._acks,
+                "stale_acks": self._stale_acks,
+            }
+
+
+def _entry(row):
+    created_at = row.created_at.isoformat() if hasattr(row.created_at, "isoformat") else row.created_at
+    return row.seq, created_at, (row.message or "").strip()
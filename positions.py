@@ -0,0 +1,217 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+log = logging.getLogger(__name__)
+
+# Installed by the server's ensure_schema(): the newest fix per vehicle, written by every
+# ingest process's live flush and read by every process that serves /positions
+SCHEMA_DDL = """
+    CREATE TABLE IF NOT EXISTS latest_positions (
+        vehicle_id TEXT PRIMARY KEY,
+        driver_id TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        lat DOUBLE PRECISION NOT NULL,
+        lon DOUBLE PRECISION NOT NULL,
+        speed DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS latest_positions_updated_at_idx ON latest_positions (updated_at);
+"""
+
+
+def upsert_sql(values="%s"):
+    """Upsert of (vehicle_id, driver_id, timestamp, lat, lon, speed) rows keeping the newest fix;
+    values is the VALUES placeholder, "%s" for execute_values"""
+    return f"""
+        INSERT INTO latest_positions AS p (vehicle_id, driver_id, timestamp, lat, lon, speed)
+        VALUES {values}
+        ON CONFLICT (vehicle_id) DO UPDATE
+        SET driver_id = EXCLUDED.driver_id, timestamp = EXCLUDED.timestamp, lat = EXCLUDED.lat,
+            lon = EXCLUDED.lon, speed = EXCLUDED.speed, updated_at = now()
+        WHERE length(EXCLUDED.timestamp) <> length(p.timestamp) OR EXCLUDED.timestamp > p.timestamp
+    """
+
+
+def is_newer(timestamp, current):
+    """Whether a fix at timestamp replaces one at current; differently formatted timestamps always do"""
+    return len(timestamp) != len(current) or timestamp > current
+
+
+def newest_rows(rows):
+    """The newest of the live rows (vehicle_id, driver_id, timestamp, lat, lon, speed) per vehicle"""
+    newest = {}
+    for vehicle_id, driver_id, timestamp, lat, lon, speed in rows:
+        timestamp = str(timestamp)
+        kept = newest.get(vehicle_id)
+        if kept is None or is_newer(timestamp, kept[2]):
+            newest[vehicle_id] = (vehicle_id, driver_id, timestamp, lat, lon, speed)
+    return list(newest.values())
+
+
+class Position:
+    """Last known fix of one device"""
+    __slots__ = ("device_id", "driver_id", "timestamp", "lat", "lon", "speed", "version", "cell", "updated_at")
+
+    def as_dict(self):
+        return {
+            "device_id": self.device_id,
+            "driver_id": self.driver_id,
+            "timestamp": self.timestamp,
+            "lat": self.lat,
+            "lon": self.lon,
+            "speed": self.speed,
+            "version": self.version,
+        }
+
+
+class LatestPositionStore:
+    """Latest position per device, indexed on a lat/lon grid for bounding-box queries.
+
+    Every update bumps a store-wide version; the device order is kept by version so
+    "changed since version N" only walks the devices that actually changed.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self._lock = threading.Lock()
+        self._positions = OrderedDict()  # device_id -> Position, oldest version first
+        self._cells = {}  # (row, col) -> set of device_ids
+        self._version = 0
+
+    def __len__(self):
+        return len(self._positions)
+
+    @property
+    def version(self):
+        return self._version
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def update(self, device_id, driver_id, timestamp, lat, lon, speed):
+        """Record a fix unless the device already has a newer one; returns the new version or None"""
+        cell = self._cell(lat, lon)
+        with self._lock:
+            position = self._positions.get(device_id)
+            if position is None:
+                position = Position()
+                position.device_id = device_id
+                position.cell = None
+            elif not is_newer(timestamp, position.timestamp):
+                return None
+
+            if position.cell != cell:
+                if position.cell is not None:
+                    members = self._cells[position.cell]
+                    members.discard(device_id)
+                    if not members:
+                        del self._cells[position.cell]
+                self._cells.setdefault(cell, set()).add(device_id)
+                position.cell = cell
+
+            self._version += 1
+            position.driver_id = driver_id
+            position.timestamp = timestamp
+            position.lat = lat
+            position.lon = lon
+            position.speed = speed
+            position.version = self._version
+            position.updated_at = time.time()
+            self._positions[device_id] = position
+            self._positions.move_to_end(device_id)
+            return self._version
+
+    def query(self, bbox=None, since=None):
+        """(version, positions) for all devices, or those inside bbox and/or changed after `since`.
+
+        bbox is (min_lat, min_lon, max_lat, max_lon).
+        """
+        with self._lock:
+            if since is not None:
+                candidates = []
+                for position in reversed(self._positions.values()):
+                    if position.version <= since:
+                        break
+                    candidates.append(position)
+                candidates.reverse()
+            elif bbox is not None:
+                candidates = self._in_cells(bbox)
+            else:
+                candidates = list(self._positions.values())
+
+            if bbox is not None:
+                min_lat, min_lon, max_lat, max_lon = bbox
+                candidates = [p for p in candidates
+                              if min_lat <= p.lat <= max_lat and min_lon <= p.lon <= max_lon]
+            return self._version, [p.as_dict() for p in candidates]
+
+    def _in_cells(self, bbox):
+        min_lat, min_lon, max_lat, max_lon = bbox
+        row0, col0 = self._cell(min_lat, min_lon)
+        row1, col1 = self._cell(max_lat, max_lon)
+        # A huge box covers more grid cells than there are occupied ones
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self._cells):
+            return [self._positions[d] for cell, members in self._cells.items()
+                    if row0 <= cell[0] <= row1 and col0 <= cell[1] <= col1 for d in members]
+        found = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                for device_id in self._cells.get((row, col), ()):
+                    found.append(self._positions[device_id])
+        return found
+
+
+class PositionSync:
+    """Merges the latest_positions table into a LatestPositionStore.
+
+    Every ingest process writes its devices' fixes to the table, so the web dyno and
+    each shard can serve the whole fleet.  sync() reads only the rows updated since the
+    last read, at most once per interval, and serves from memory in between.  Rows of
+    the last `lookback` seconds are read again because concurrent flushes can commit out
+    of order; the store ignores fixes it already has.
+    """
+
+    def __init__(self, pool, store, interval=1.0, lookback=2.0, available=lambda: True):
+        self._pool = pool
+        self._store = store
+        self.interval = interval
+        self.lookback = lookback
+        self._available = available
+        self._lock = threading.Lock()
+        self._last_sync = 0.0
+        self._updated_at = None  # newest updated_at read so far, from the database clock
+
+    def sync(self):
+        """Read the table if the last read is older than interval; never raises"""
+        if not self._lock.acquire(blocking=False):
+            return  # another request is reading it right now
+        try:
+            now = time.monotonic()
+            if now - self._last_sync < self.interval or not self._available():
+                return
+            self._last_sync = now
+            with self._pool.cursor() as cursor:
+                if self._updated_at is None:
+                    cursor.execute("""
+                        SELECT vehicle_id, driver_id, timestamp, lat, lon, speed, updated_at
+                        FROM latest_positions
+                    """)
+                else:
+                    cursor.execute("""
+                        SELECT vehicle_id, driver_id, timestamp, lat, lon, speed, updated_at
+                        FROM latest_positions
+                        WHERE updated_at > %s
+                    """, (self._updated_at - timedelta(seconds=self.lookback),))
+                rows = cursor.fetchall()
+            for r in rows:
+                self._store.update(str(r.vehicle_id).strip(), r.driver_id, r.timestamp, r.lat, r.lon, r.speed)
+                if self._updated_at is None or r.updated_at > self._updated_at:
+                    self._updated_at = r.updated_at
+        except Exception as e:
+            log.warning(f"⚠️ Could not read latest_positions: {e}")
+        finally:
+            self._lock.release()
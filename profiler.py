@@ -0,0 +1,133 @@
+"""On-demand sampling profiler for every thread of the process.
+
+While a profile runs, a sampler thread reads sys._current_frames() every interval and
+counts each thread's stack.  Nothing is installed in between: no tracing hooks, no
+signal handlers, no thread, so an idle profiler costs nothing.
+
+Results come out as collapsed stacks ("thread;outer;...;inner count" per line), the
+input format of flamegraph.pl, speedscope and inferno, or as a per-thread summary.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Stack counts of one profiling run"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()  # (thread name, frame labels root first) -> samples
+        self.samples = 0
+        self.started = time.time()
+        self.duration = 0.0
+        self.sampling_time = 0.0  # time the sampler itself spent, to judge its overhead
+
+    def collapsed(self):
+        """flamegraph.pl input, one "thread;frame;...;frame count" line per distinct stack"""
+        lines = []
+        for (thread, frames), count in self.stacks.most_common():
+            name = thread.replace(";", "_").replace(" ", "_")
+            lines.append(";".join((name,) + frames) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=15):
+        """Samples per thread with the frames that were on top of its stack most often"""
+        threads = {}
+        for (thread, frames), count in self.stacks.items():
+            entry = threads.setdefault(thread, {"samples": 0, "self": Counter(), "total": Counter()})
+            entry["samples"] += count
+            if frames:
+                entry["self"][frames[-1]] += count
+            for frame in set(frames):
+                entry["total"][frame] += count
+        return {
+            "started": self.started,
+            "duration_seconds": round(self.duration, 3),
+            "interval_ms": round(self.interval * 1000, 3),
+            "samples": self.samples,
+            "sampler_overhead_pct": round(self.sampling_time / self.duration * 100, 2) if self.duration else 0.0,
+            "threads": {
+                thread: {
+                    "samples": entry["samples"],
+                    "share_pct": round(entry["samples"] / self.samples * 100, 1) if self.samples else 0.0,
+                    "top_self": [{"frame": f, "samples": c} for f, c in entry["self"].most_common(top)],
+                    "top_total": [{"frame": f, "samples": c} for f, c in entry["total"].most_common(top)],
+                } for thread, entry in sorted(threads.items(), key=lambda item: -item[1]["samples"])
+            },
+        }
+
+
+class SamplingProfiler:
+    def __init__(self, max_seconds=60.0, max_depth=128):
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._running = False
+        self.runs = 0
+
+    def run(self, seconds, interval=0.005, exclude=()):
+        """Sample all threads for `seconds` and return the Profile; blocks the caller meanwhile"""
+        with self._lock:
+            if self._running:
+                raise ProfilerBusy("a profile is already running")
+            self._running = True
+        try:
+            profile = Profile(interval)
+            sampler = threading.Thread(target=self._sample, name="profiler",
+                                       args=(profile, min(seconds, self.max_seconds), exclude), daemon=True)
+            sampler.start()
+            sampler.join()
+            self.runs += 1
+            return profile
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _sample(self, profile, seconds, exclude):
+        own = threading.get_ident()
+        skip = set(exclude) | {own}
+        labels = {}  # code object -> label, so each distinct frame is formatted once
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_sample = started
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident in skip:
+                    continue
+                frames = []
+                while frame is not None and len(frames) < self.max_depth:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    frames.append(label)
+                    frame = frame.f_back
+                frames.reverse()
+                profile.stacks[(names.get(ident, f"thread-{ident}"), tuple(frames))] += 1
+            profile.samples += 1
+            profile.sampling_time += time.perf_counter() - now
+            next_sample += profile.interval
+            delay = next_sample - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.perf_counter()
+        profile.duration = time.perf_counter() - started
+
+    def stats(self):
+        return {"running": self._running, "runs": self.runs, "max_seconds": self.max_seconds}
@@ -0,0 +1,251 @@
+import logging
+import os
+import select
+import threading
+import time
+
+from psycopg2 import extensions
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "reference_data_changed"
+
+# Installed by the server's ensure_schema(); fires NOTIFY when settings, vehicle ids or
+# driver ids/names change.  Mileage updates on vehicles deliberately do not fire it.
+TRIGGER_DDL = f"""
+    CREATE OR REPLACE FUNCTION notify_reference_data_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS settings_reference_data_changed ON settings;
+    CREATE TRIGGER settings_reference_data_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON settings
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_reference_data_changed();
+
+    DROP TRIGGER IF EXISTS vehicles_reference_data_changed ON vehicles;
+    CREATE TRIGGER vehicles_reference_data_changed
+        AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF id ON vehicles
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_reference_data_changed();
+
+    DROP TRIGGER IF EXISTS drivers_reference_data_changed ON drivers;
+    CREATE TRIGGER drivers_reference_data_changed
+        AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF id, name ON drivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_reference_data_changed();
+"""
+
+
+class ReferenceDataCache:
+    """In-memory copy of the settings, vehicles and drivers tables.
+
+    The tables are loaded in bulk and swapped in atomically.  A background thread
+    LISTENs for change notifications and reloads on demand; it also reloads every
+    refresh_interval seconds so the cache converges even without the triggers.
+    IDs that are not in the snapshot are checked against the database once and
+    then remembered as unknown for negative_ttl seconds.
+    """
+
+    def __init__(self, pool, listen_connect=None, refresh_interval=300.0, negative_ttl=60.0):
+        self._pool = pool
+        self._listen_connect = listen_connect
+        self.refresh_interval = refresh_interval
+        self.negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.RLock()
+        self._vehicles = None  # id -> (id, ba_number, make)
+        self._drivers = None  # id -> (id, name)
+        self._speed_limits = None  # (vehicle_id, road_type) -> km/h
+        self._unknown_vehicles = {}  # id -> expiry
+        self._unknown_drivers = {}
+
+        self._version = 0
+        self._loaded_at = None
+        self._last_reload_ms = None
+        self._last_reason = None
+        self._reloads = 0
+        self._reload_errors = 0
+        self._notifications = 0
+        self._listening = False
+        self._hits = 0
+        self._misses = 0
+        self._thread = None
+        self._thread_pid = None
+
+    # ------------------ loading ------------------
+
+    def reload(self, reason="manual"):
+        """Fetch all three tables and swap them in"""
+        with self._reload_lock:
+            started = time.monotonic()
+            try:
+                with self._pool.cursor() as cursor:
+                    cursor.execute("SELECT id, ba_number, make FROM vehicles")
+                    vehicles = {str(r.id).strip(): (r.id, r.ba_number, r.make) for r in cursor.fetchall()}
+                    cursor.execute("SELECT id, name FROM drivers")
+                    drivers = {str(r.id).strip(): (r.id, r.name) for r in cursor.fetchall()}
+                    cursor.execute("SELECT vehicle_id, road_type, speed_limit FROM settings")
+                    speed_limits = {(str(r.vehicle_id).strip(), r.road_type): float(r.speed_limit)
+                                    for r in cursor.fetchall()}
+            except Exception:
+                with self._lock:
+                    self._reload_errors += 1
+                raise
+
+            with self._lock:
+                self._vehicles = vehicles
+                self._drivers = drivers
+                self._speed_limits = speed_limits
+                self._unknown_vehicles = {}
+                self._unknown_drivers = {}
+                self._version += 1
+                self._reloads += 1
+                self._loaded_at = time.time()
+                self._last_reload_ms = round((time.monotonic() - started) * 1000, 2)
+                self._last_reason = reason
+            log.info(f"🔄 Reference data reloaded ({reason}): {len(vehicles)} vehicles, {len(drivers)} drivers, "
+                     f"{len(speed_limits)} speed limits in {self._last_reload_ms} ms")
+
+    def _ensure_loaded(self):
+        # Processes that never call start() (the gunicorn workers) still get invalidation
+        if self._thread_pid != os.getpid():
+            self.start()
+        if self._vehicles is None:
+            with self._reload_lock:
+                if self._vehicles is None:
+                    self.reload("initial")
+
+    # ------------------ lookups ------------------
+
+    def _exists(self, key, table, snapshot, unknown):
+        key = str(key).strip()
+        if key in snapshot:
+            self._hits += 1
+            return True
+        expiry = unknown.get(key)
+        if expiry is not None and expiry > time.monotonic():
+            self._hits += 1
+            return False
+
+        # Not in the snapshot: it may have been added since the last reload
+        self._misses += 1
+        with self._pool.cursor() as cursor:
+            if table == "vehicles":
+                cursor.execute("SELECT id, ba_number, make FROM vehicles WHERE id = %s", (key,))
+                row = cursor.fetchone()
+                value = (row.id, row.ba_number, row.make) if row else None
+            else:
+                cursor.execute("SELECT id, name FROM drivers WHERE id = %s", (key,))
+                row = cursor.fetchone()
+                value = (row.id, row.name) if row else None
+        with self._lock:
+            if value is None:
+                unknown[key] = time.monotonic() + self.negative_ttl
+                return False
+            snapshot[key] = value
+            return True
+
+    def vehicle_exists(self, vehicle_id):
+        self._ensure_loaded()
+        return self._exists(vehicle_id, "vehicles", self._vehicles, self._unknown_vehicles)
+
+    def driver_exists(self, driver_id):
+        self._ensure_loaded()
+        return self._exists(driver_id, "drivers", self._drivers, self._unknown_drivers)
+
+    def speed_limit(self, vehicle_id, road_type):
+        """Configured limit for the vehicle on this road type, or None if not set"""
+        self._ensure_loaded()
+        return self._speed_limits.get((str(vehicle_id).strip(), road_type))
+
+    def drivers(self):
+        """(id, name) for every driver"""
+        self._ensure_loaded()
+        return list(self._drivers.values())
+
+    # ------------------ invalidation ------------------
+
+    def start(self):
+        with self._reload_lock:
+            # A watcher inherited from a parent process (gunicorn --preload) did not survive the fork
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                self._listening = False
+                self._thread = threading.Thread(target=self._watch, name="reference-data", daemon=True)
+                self._thread.start()
+
+    def _watch(self):
+        while True:
+            conn = None
+            try:
+                if self._listen_connect is None:
+                    raise RuntimeError("no LISTEN connection configured")
+                conn = self._listen_connect()
+                conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                self._listening = True
+                # Changes made while we were not listening would otherwise be missed
+                self.reload("listen_start")
+                while True:
+                    if select.select([conn], [], [], self._poll_timeout()) == ([], [], []):
+                        if self._stale():
+                            self.reload("refresh_interval")
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        tables = sorted({n.payload for n in conn.notifies})
+                        self._notifications += len(conn.notifies)
+                        conn.notifies.clear()
+                        self.reload(f"notify:{','.join(tables)}")
+            except Exception as e:
+                self._listening = False
+                log.warning(f"⚠️ Reference data listener unavailable, polling instead: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                # Version poll: reload on the refresh interval until LISTEN works again
+                deadline = time.monotonic() + min(self.refresh_interval, 60.0)
+                while time.monotonic() < deadline:
+                    time.sleep(max(0.0, min(5.0, deadline - time.monotonic())))
+                    if self._stale():
+                        try:
+                            self.reload("refresh_interval")
+                        except Exception as reload_error:
+                            log.error(f"❌ Reference data reload failed: {reload_error}")
+
+    def _stale(self):
+        return self._loaded_at is None or time.time() - self._loaded_at >= self.refresh_interval
+
+    def _poll_timeout(self):
+        if self._loaded_at is None:
+            return 1.0
+        return max(1.0, self.refresh_interval - (time.time() - self._loaded_at))
+
+    def stats(self):
+        with self._lock:
+            loaded = self._vehicles is not None
+            return {
+                "loaded": loaded,
+                "version": self._version,
+                "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._loaded_at)) if loaded else None,
+                "age_seconds": round(time.time() - self._loaded_at, 1) if loaded else None,
+                "refresh_interval": self.refresh_interval,
+                "last_reload_ms": self._last_reload_ms,
+                "last_reload_reason": self._last_reason,
+                "reloads": self._reloads,
+                "reload_errors": self._reload_errors,
+                "listening": self._listening,
+                "notifications": self._notifications,
+                "vehicles": len(self._vehicles) if loaded else 0,
+                "drivers": len(self._drivers) if loaded else 0,
+                "speed_limits": len(self._speed_limits) if loaded else 0,
+                "unknown_vehicles": len(self._unknown_vehicles),
+                "unknown_drivers": len(self._unknown_drivers),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
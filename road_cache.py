@@ -0,0 +1,219 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# Rough per-entry overhead of the OrderedDict node and value tuple, in bytes
+ENTRY_OVERHEAD = 120
+
+
+class _Flight:
+    """An upstream lookup in progress that other callers for the same key wait on"""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class RoadTypeCache:
+    """Bounded LRU/TTL cache for road-type lookups with single-flight loading.
+
+    Entries live in memory up to max_entries / max_bytes and, when db_path is set,
+    in a SQLite file that every gunicorn worker shares and that survives restarts.
+    Negative results (no road found, upstream errors) expire after negative_ttl.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=32 * 1024 * 1024, ttl=7 * 24 * 3600,
+                 negative_ttl=300, db_path=None, load_timeout=30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db_path = db_path
+        self.load_timeout = load_timeout
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at, negative, size)
+        self._bytes = 0
+        self._inflight = {}
+        self._local = threading.local()
+        self._writes = 0
+
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._loads = 0
+        self._coalesced = 0
+        self._store_errors = 0
+
+        if db_path:
+            try:
+                self._store().execute("""
+                    CREATE TABLE IF NOT EXISTS road_types (
+                        key TEXT PRIMARY KEY,
+                        road_type TEXT NOT NULL,
+                        expires_at REAL NOT NULL,
+                        negative INTEGER NOT NULL
+                    )
+                """)
+            except sqlite3.Error as e:
+                log.error(f"❌ Road cache store disabled ({db_path}): {e}")
+                self.db_path = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ------------------ on-disk store ------------------
+
+    def _store(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _store_get(self, key):
+        try:
+            row = self._store().execute(
+                "SELECT road_type, expires_at, negative FROM road_types WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            self._store_errors += 1
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        return row
+
+    def _store_put(self, key, value, expires_at, negative):
+        try:
+            conn = self._store()
+            conn.execute("INSERT OR REPLACE INTO road_types (key, road_type, expires_at, negative) VALUES (?, ?, ?, ?)",
+                         (key, value, expires_at, int(negative)))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                conn.execute("DELETE FROM road_types WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error:
+            self._store_errors += 1
+
+    # ------------------ memory tier ------------------
+
+    def _remember(self, key, value, expires_at, negative):
+        size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[3]
+            self._entries[key] = (value, expires_at, negative, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[3]
+                self._evictions += 1
+
+    def get(self, key):
+        """Cached road type for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self._bytes -= entry[3]
+                self._expirations += 1
+
+        if self.db_path:
+            row = self._store_get(key)
+            if row is not None:
+                self._remember(key, row[0], row[1], bool(row[2]))
+                with self._lock:
+                    self._disk_hits += 1
+                return row[0]
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, key, value, negative=False):
+        expires_at = time.time() + (self.negative_ttl if negative else self.ttl)
+        self._remember(key, value, expires_at, negative)
+        if self.db_path:
+            self._store_put(key, value, expires_at, negative)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value or call loader() -> (value, negative) once per key.
+
+        Concurrent callers for a key that is already being loaded wait for that load
+        instead of issuing their own upstream request.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            # A load for this key may have completed since the miss above
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            if flight.event.wait(self.load_timeout) and flight.error is None:
+                return flight.value
+            if flight.error is not None:
+                raise flight.error
+            raise TimeoutError(f"Timed out waiting for road type lookup of {key}")
+
+        try:
+            with self._lock:
+                self._loads += 1
+            value, negative = loader()
+            self.put(key, value, negative)
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_ratio": round((self._hits + self._disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "upstream_loads": self._loads,
+                "coalesced_lookups": self._coalesced,
+                "inflight": len(self._inflight),
+                "store": self.db_path,
+                "store_errors": self._store_errors,
+            }
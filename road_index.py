@@ -0,0 +1,282 @@
+"""Offline nearest-road lookup over a local OSM extract.
+
+Highway ways are split into straight segments and bucketed into a uniform lat/lon
+grid.  Each segment is registered in every cell it passes within `radius_m` of, so a
+lookup only has to scan the segments of the query's own cell.  A built index is a
+directory of .npy arrays that is memory-mapped on load, so workers start instantly
+and share the pages through the OS cache.
+
+Build one with:
+
+    python road_index.py build pakistan-highways.geojson road_index/
+    python road_index.py build pakistan-latest.osm.pbf road_index/   # needs `osmium`
+"""
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+METERS_PER_DEG_LAT = 110574.0
+METERS_PER_DEG_LON = 111320.0
+DEFAULT_CELL_DEG = 0.005  # ~550 m
+DEFAULT_RADIUS_M = 20.0  # same search radius as the Overpass around:20 query
+
+ARRAY_NAMES = ("lat1", "lon1", "lat2", "lon2", "highway", "cell_keys", "cell_offsets", "cell_segments")
+
+
+class RoadIndex:
+    """Grid of highway segments answering "which road is this point on" queries"""
+
+    def __init__(self, arrays, meta):
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+        self.tags = meta["tags"]
+        self.cell_deg = meta["cell_deg"]
+        self.radius_m = meta["radius_m"]
+        self.n_cols = meta["n_cols"]
+        self.bounds = tuple(meta["bounds"])  # (min_lat, min_lon, max_lat, max_lon)
+
+    def __len__(self):
+        return len(self.highway)
+
+    # ------------------ building ------------------
+
+    @classmethod
+    def from_ways(cls, ways, cell_deg=DEFAULT_CELL_DEG, radius_m=DEFAULT_RADIUS_M):
+        """Build from an iterable of (highway_tag, [(lon, lat), ...]) polylines"""
+        tags = []
+        tag_codes = {}
+        lat1, lon1, lat2, lon2, codes = [], [], [], [], []
+        for highway_tag, coords in ways:
+            if not highway_tag or len(coords) < 2:
+                continue
+            code = tag_codes.get(highway_tag)
+            if code is None:
+                code = tag_codes[highway_tag] = len(tags)
+                tags.append(highway_tag)
+            for (x1, y1), (x2, y2) in zip(coords[:-1], coords[1:]):
+                lat1.append(y1)
+                lon1.append(x1)
+                lat2.append(y2)
+                lon2.append(x2)
+                codes.append(code)
+
+        arrays = {
+            "lat1": np.asarray(lat1, dtype=np.float64),
+            "lon1": np.asarray(lon1, dtype=np.float64),
+            "lat2": np.asarray(lat2, dtype=np.float64),
+            "lon2": np.asarray(lon2, dtype=np.float64),
+            "highway": np.asarray(codes, dtype=np.int16),
+        }
+        n_cols = int(math.ceil(360.0 / cell_deg)) + 1
+        arrays.update(_grid(arrays, cell_deg, radius_m, n_cols))
+
+        if len(codes):
+            bounds = [
+                float(min(arrays["lat1"].min(), arrays["lat2"].min())),
+                float(min(arrays["lon1"].min(), arrays["lon2"].min())),
+                float(max(arrays["lat1"].max(), arrays["lat2"].max())),
+                float(max(arrays["lon1"].max(), arrays["lon2"].max())),
+            ]
+        else:
+            bounds = [0.0, 0.0, 0.0, 0.0]
+        meta = {"tags": tags, "cell_deg": cell_deg, "radius_m": radius_m, "n_cols": n_cols, "bounds": bounds}
+        return cls(arrays, meta)
+
+    @classmethod
+    def from_geojson(cls, path, **kwargs):
+        """Build from a GeoJSON FeatureCollection of LineString/MultiLineString highway ways"""
+        with open(path, encoding="utf-8") as f:
+            collection = json.load(f)
+        return cls.from_ways(_geojson_ways(collection), **kwargs)
+
+    @classmethod
+    def from_pbf(cls, path, **kwargs):
+        """Build from an OSM .pbf extract (requires the optional `osmium` package)"""
+        try:
+            import osmium
+        except ImportError:
+            raise ImportError("Building from .pbf needs the 'osmium' package (pip install osmium)")
+
+        ways = []
+
+        class HighwayHandler(osmium.SimpleHandler):
+            def way(self, w):
+                highway_tag = w.tags.get("highway")
+                if not highway_tag:
+                    return
+                try:
+                    ways.append((highway_tag, [(n.lon, n.lat) for n in w.nodes]))
+                except osmium.InvalidLocationError:
+                    pass
+
+        HighwayHandler().apply_file(path, locations=True)
+        return cls.from_ways(ways, **kwargs)
+
+    @classmethod
+    def from_extract(cls, path, **kwargs):
+        if path.endswith(".pbf"):
+            return cls.from_pbf(path, **kwargs)
+        return cls.from_geojson(path, **kwargs)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        meta = {"tags": self.tags, "cell_deg": self.cell_deg, "radius_m": self.radius_m,
+                "n_cols": self.n_cols, "bounds": list(self.bounds)}
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Open a saved index; arrays are memory-mapped unless mmap=False"""
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode) for name in ARRAY_NAMES}
+        return cls(arrays, meta)
+
+    # ------------------ queries ------------------
+
+    def covers(self, lat, lon):
+        min_lat, min_lon, max_lat, max_lon = self.bounds
+        return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+    def _cell_key(self, lat, lon):
+        row = np.floor((np.asarray(lat) + 90.0) / self.cell_deg).astype(np.int64)
+        col = np.floor((np.asarray(lon) + 180.0) / self.cell_deg).astype(np.int64)
+        return row * self.n_cols + col
+
+    def _cell_segments(self, key):
+        pos = np.searchsorted(self.cell_keys, key)
+        if pos >= len(self.cell_keys) or self.cell_keys[pos] != key:
+            return None
+        return self.cell_segments[self.cell_offsets[pos]:self.cell_offsets[pos + 1]]
+
+    def nearest_highway(self, lat, lon, max_distance_m=None):
+        """OSM highway tag of the closest segment within max_distance_m, or None"""
+        max_distance_m = self.radius_m if max_distance_m is None else min(max_distance_m, self.radius_m)
+        segments = self._cell_segments(int(self._cell_key(lat, lon)))
+        if segments is None or len(segments) == 0:
+            return None
+        distances = _point_segment_distances_m(
+            np.array([lat]), np.array([lon]),
+            self.lat1[segments], self.lon1[segments], self.lat2[segments], self.lon2[segments])[0]
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance_m:
+            return None
+        return self.tags[self.highway[segments[best]]]
+
+    def nearest_highways(self, lats, lons, max_distance_m=None):
+        """Vectorized nearest_highway for a whole trip; returns a list of tags (or None)"""
+        max_distance_m = self.radius_m if max_distance_m is None else min(max_distance_m, self.radius_m)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = [None] * len(lats)
+        if not len(lats):
+            return result
+
+        keys = self._cell_key(lats, lons)
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        for i, key in enumerate(unique_keys):
+            segments = self._cell_segments(int(key))
+            if segments is None or len(segments) == 0:
+                continue
+            point_idx = order[bounds[i]:bounds[i + 1]]
+            distances = _point_segment_distances_m(
+                lats[point_idx], lons[point_idx],
+                self.lat1[segments], self.lon1[segments], self.lat2[segments], self.lon2[segments])
+            best = np.argmin(distances, axis=1)
+            best_distance = distances[np.arange(len(point_idx)), best]
+            for p, seg, distance in zip(point_idx, best, best_distance):
+                if distance <= max_distance_m:
+                    result[p] = self.tags[self.highway[segments[seg]]]
+        return result
+
+
+def _grid(arrays, cell_deg, radius_m, n_cols):
+    """CSR mapping from grid cell key to the segments within radius_m of that cell"""
+    lat1, lon1, lat2, lon2 = arrays["lat1"], arrays["lon1"], arrays["lat2"], arrays["lon2"]
+    if not len(lat1):
+        return {
+            "cell_keys": np.zeros(0, dtype=np.int64),
+            "cell_offsets": np.zeros(1, dtype=np.int64),
+            "cell_segments": np.zeros(0, dtype=np.int32),
+        }
+
+    pad_lat = radius_m / METERS_PER_DEG_LAT
+    max_abs_lat = np.minimum(np.maximum(np.abs(lat1), np.abs(lat2)), 89.0)
+    pad_lon = radius_m / (METERS_PER_DEG_LON * np.cos(np.radians(max_abs_lat)))
+
+    r0 = np.floor((np.minimum(lat1, lat2) - pad_lat + 90.0) / cell_deg).astype(np.int64)
+    r1 = np.floor((np.maximum(lat1, lat2) + pad_lat + 90.0) / cell_deg).astype(np.int64)
+    c0 = np.floor((np.minimum(lon1, lon2) - pad_lon + 180.0) / cell_deg).astype(np.int64)
+    c1 = np.floor((np.maximum(lon1, lon2) + pad_lon + 180.0) / cell_deg).astype(np.int64)
+
+    widths = c1 - c0 + 1
+    counts = (r1 - r0 + 1) * widths
+    segment_ids = np.repeat(np.arange(len(lat1), dtype=np.int32), counts)
+    local = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(r0, counts) + local // np.repeat(widths, counts)
+    cols = np.repeat(c0, counts) + local % np.repeat(widths, counts)
+    keys = rows * n_cols + cols
+
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    cell_keys, starts = np.unique(keys, return_index=True)
+    return {
+        "cell_keys": cell_keys.astype(np.int64),
+        "cell_offsets": np.append(starts, len(keys)).astype(np.int64),
+        "cell_segments": segment_ids[order],
+    }
+
+
+def _point_segment_distances_m(lats, lons, lat1, lon1, lat2, lon2):
+    """Distance matrix (points x segments) in metres using a local equirectangular projection"""
+    lats = lats[:, None]
+    lons = lons[:, None]
+    kx = METERS_PER_DEG_LON * np.cos(np.radians(lats))
+    ax = (lon1[None, :] - lons) * kx
+    ay = (lat1[None, :] - lats) * METERS_PER_DEG_LAT
+    dx = (lon2 - lon1)[None, :] * kx
+    dy = (lat2 - lat1)[None, :] * METERS_PER_DEG_LAT
+    length_sq = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length_sq > 0, -(ax * dx + ay * dy) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(ax + t * dx, ay + t * dy)
+
+
+def _geojson_ways(collection):
+    features = collection.get("features", []) if collection.get("type") == "FeatureCollection" else [collection]
+    for feature in features:
+        properties = feature.get("properties") or {}
+        highway_tag = properties.get("highway") or (properties.get("tags") or {}).get("highway")
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "LineString":
+            yield highway_tag, geometry["coordinates"]
+        elif geometry.get("type") == "MultiLineString":
+            for line in geometry["coordinates"]:
+                yield highway_tag, line
+
+
+def main(argv):
+    if len(argv) < 3 or argv[0] != "build":
+        print("Usage: python road_index.py build <extract.geojson|extract.osm.pbf> <output_dir> "
+              "[cell_deg] [radius_m]")
+        return 2
+    cell_deg = float(argv[3]) if len(argv) > 3 else DEFAULT_CELL_DEG
+    radius_m = float(argv[4]) if len(argv) > 4 else DEFAULT_RADIUS_M
+    index = RoadIndex.from_extract(argv[1], cell_deg=cell_deg, radius_m=radius_m)
+    index.save(argv[2])
+    print(f"✅ Built road index with {len(index)} segments in {len(index.cell_keys)} cells -> {argv[2]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
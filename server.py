@@ -1,5 +1,6 @@
 from flask import Flask, request, jsonify
 import psycopg2
+import psycopg2.extras
 import os
 import json
 import paho.mqtt.client as mqtt
@@ -8,33 +9,116 @@ import time
 from datetime import datetime, timedelta
 import pytz
 import requests
-from geopy.distance import geodesic
-import statistics
-from collections import deque
-import sys
+import numpy as np
+import atexit
+import functools
+import html
+import hmac
+import logging
+import socket
+import zlib
+from db_pool import ConnectionPool
+from geodistance import path_distance_km
+from road_index import RoadIndex
+from road_cache import RoadTypeCache
+from reference_data import ReferenceDataCache, TRIGGER_DDL as REFERENCE_DATA_TRIGGER_DDL
+from notifications import NotificationFeed, SCHEMA_DDL as NOTIFICATION_SCHEMA_DDL, \
+    TRIGGER_DDL as NOTIFICATION_TRIGGER_DDL
+import harsh_events
+from event_sink import EventSink, EVENTS_UNIQUE_INDEX_DDL
+from live_buffer import LiveWriteBuffer
+from positions import LatestPositionStore, PositionSync, SCHEMA_DDL as POSITIONS_SCHEMA_DDL, newest_rows, \
+    upsert_sql as positions_upsert_sql
+from dispatch import OrderedDispatcher, QueueFull
+from admission import AdmissionController, COLLAPSIBLE_STAGES
+from session_store import BatchSession, SessionStore, parse_timestamp
+from session_spool import SessionSpool
+from trip_stream import TripStream
+import compact_upload
+import bulk_upload
+import logs
+import metrics
+from profiler import SamplingProfiler, ProfilerBusy
+from logs import device_context
+
+log = logging.getLogger("server")
+points_log = logging.getLogger(logs.POINTS_LOGGER)  # per-point lines, rate-limited
 
 app = Flask(__name__)
-data_sessions = {}
+# In-flight batch sessions, buffered column-wise with memory caps and heap-driven expiry
+data_sessions = SessionStore(
+    ttl=float(os.getenv("SESSION_TTL", "3600")),
+    max_session_bytes=int(os.getenv("SESSION_MAX_BYTES", str(16 * 1024 * 1024))),
+    max_total_bytes=int(os.getenv("SESSIONS_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+# Batch sessions of one device must always land in the same ingest process.  With
+# INGEST_BATCH_ROUTING=shard every process sees all batch topics and keeps the devices
+# whose crc32 falls in its shard; with "shared" the broker's shared-subscription
+# strategy has to be sticky per topic (e.g. EMQX hash_topic).
+INGEST_SHARE_GROUP = os.getenv("INGEST_SHARE_GROUP", "")
+INGEST_BATCH_ROUTING = os.getenv("INGEST_BATCH_ROUTING", "shard")
+INGEST_SHARDS = int(os.getenv("INGEST_SHARDS", "1"))
+
+def default_shard_index():
+    """Shard from the Heroku dyno name ("ingest.1", "ingest.2", ...), else 0"""
+    dyno = os.getenv("DYNO", "")
+    suffix = dyno.rsplit(".", 1)[-1]
+    return int(suffix) - 1 if "." in dyno and suffix.isdigit() else 0
+
+INGEST_SHARD_INDEX = int(os.getenv("INGEST_SHARD_INDEX") or default_shard_index())
+
+# On-disk log of the same sessions, replayed by start_mqtt() after a crash or restart
+SESSION_SPOOL_DIR = os.getenv("SESSION_SPOOL_DIR", "session_spool")
+if SESSION_SPOOL_DIR and INGEST_SHARDS > 1:
+    # Shards sharing a disk must not recover each other's sessions
+    SESSION_SPOOL_DIR = os.path.join(SESSION_SPOOL_DIR, f"shard-{INGEST_SHARD_INDEX}")
+session_spool = SessionSpool(
+    SESSION_SPOOL_DIR,
+    sync_every=int(os.getenv("SESSION_SPOOL_SYNC_EVERY", "64")),
+    sync_interval=float(os.getenv("SESSION_SPOOL_SYNC_MS", "200")) / 1000.0,
+) if SESSION_SPOOL_DIR else None
+if session_spool:
+    atexit.register(session_spool.close)
 PKT = pytz.timezone('Asia/Karachi')
 
-road_type_cache = {}
-
-# ------------------ LOG CAPTURE ------------------
-logs_buffer = deque(maxlen=500)  # store last 500 logs
-
-class LogCapture:
-    def write(self, message):
-        if message.strip():
-            logs_buffer.append(message.strip())
-        sys.__stdout__.write(message)  # still print to console
-    def flush(self):
-        pass
-
-# Redirect stdout & stderr
-sys.stdout = LogCapture()
-sys.stderr = LogCapture()
+# Shared across workers and restarts through the SQLite file at ROAD_CACHE_PATH
+road_type_cache = RoadTypeCache(
+    max_entries=int(os.getenv("ROAD_CACHE_MAX_ENTRIES", "100000")),
+    max_bytes=int(os.getenv("ROAD_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttl=float(os.getenv("ROAD_CACHE_TTL", str(7 * 24 * 3600))),
+    negative_ttl=float(os.getenv("ROAD_CACHE_NEGATIVE_TTL", "300")),
+    db_path=os.getenv("ROAD_CACHE_PATH", "road_type_cache.sqlite3") or None,
+)
+
+def load_road_index():
+    """Open the prebuilt offline road index named by ROAD_INDEX_PATH, if any"""
+    path = os.getenv("ROAD_INDEX_PATH")
+    if not path:
+        return None
+    try:
+        index = RoadIndex.load(path)
+        log.info(f"✅ Loaded offline road index with {len(index)} segments from {path}")
+        return index
+    except Exception as e:
+        log.error(f"❌ Error loading road index from {path}: {e}")
+        return None
+
+road_index = load_road_index()
+
+# Thresholds for detect_harsh_events; override fields with a JSON object, e.g. {"brake_1s": -14}
+harsh_event_profile = harsh_events.HarshEventProfile.from_json(os.getenv("HARSH_EVENT_PROFILE", ""))
+
+# ------------------ LOGGING ------------------
+# Queue-based so logging never blocks a worker; the / page reads the ring buffer
+log_ring = logs.configure(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    levels=os.getenv("LOG_LEVELS", ""),
+    capacity=int(os.getenv("LOG_BUFFER_SIZE", "2000")),
+    point_rate=float(os.getenv("LOG_POINT_RATE", "5")),
+)
 # -------------------------------------------------
 
+@metrics.timed("db_connect")
 def get_db_connection():
     return psycopg2.connect(
         host=os.getenv("DB_HOST"),
@@ -42,61 +126,133 @@ def get_db_connection():
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         port=os.getenv("DB_PORT", "5432"),
-        sslmode=os.getenv("DB_SSLMODE", "require")  # enforce SSL for Render
+        sslmode=os.getenv("DB_SSLMODE", "require"),  # enforce SSL for Render
+        cursor_factory=psycopg2.extras.NamedTupleCursor  # rows support r.id / r.name access
     )
 
+# Shared by the paho network thread, the cleanup thread and the Flask workers
+db_pool = ConnectionPool(
+    get_db_connection,
+    minconn=int(os.getenv("DB_POOL_MIN", "1")),
+    maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    health_check_interval=float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30")),
+)
+
+GPS_BULK_INSERT = os.getenv("GPS_BULK_INSERT", "1") == "1"
+GPS_INSERT_PAGE_SIZE = int(os.getenv("GPS_INSERT_PAGE_SIZE", "1000"))
+
+# Idempotent DDL the ingest path relies on, applied once per process
+SCHEMA_STATEMENTS = {
+    # Lets batch inserts resolve duplicate points server-side with ON CONFLICT
+    "gpsdata_unique": """
+        CREATE UNIQUE INDEX IF NOT EXISTS gpsdata_vehicle_driver_ts_uidx
+        ON GPSData (vehicle_id, driver_id, timestamp)
+    """,
+    # Lets live write-behind flushes skip points already stored
+    "gpsdata_live_unique": """
+        CREATE UNIQUE INDEX IF NOT EXISTS gpsdata_live_vehicle_driver_ts_uidx
+        ON GPSData_live (vehicle_id, driver_id, timestamp)
+    """,
+    # Quantized-location key that replaces the ABS() range scan for event duplicates
+    "events_unique": EVENTS_UNIQUE_INDEX_DDL,
+    # NOTIFY on settings/vehicles/drivers changes so the reference cache reloads
+    "reference_data_triggers": REFERENCE_DATA_TRIGGER_DDL,
+    # seq column and delivery cursors for delta notification delivery
+    "notification_cursors": NOTIFICATION_SCHEMA_DDL,
+    # NOTIFY on notification inserts so they are pushed without waiting for the poll
+    "notification_triggers": NOTIFICATION_TRIGGER_DDL,
+    # Newest fix per vehicle, so /positions covers the whole fleet in every process
+    "latest_positions": POSITIONS_SCHEMA_DDL,
+}
+schema_status = {}
+schema_lock = threading.Lock()
+
+# settings, vehicles and drivers served from memory, invalidated by LISTEN/NOTIFY
+reference_data = ReferenceDataCache(
+    db_pool,
+    listen_connect=get_db_connection,
+    refresh_interval=float(os.getenv("REFERENCE_REFRESH_INTERVAL", "300")),
+    negative_ttl=float(os.getenv("REFERENCE_NEGATIVE_TTL", "60")),
+)
+
+# Pending notifications per vehicle, published retained as deltas above each device's cursor
+notification_feed = NotificationFeed(
+    db_pool,
+    publish=lambda topic, payload: publish_async(topic, payload, retain=True).rc == mqtt.MQTT_ERR_SUCCESS,
+    listen_connect=get_db_connection,
+    poll_interval=float(os.getenv("NOTIFICATION_POLL_INTERVAL", "30")),
+    max_pending=int(os.getenv("NOTIFICATION_MAX_PENDING", "100")),
+    owns=lambda device_id: owns_device(device_id),
+)
+
+def ensure_schema():
+    """Apply SCHEMA_STATEMENTS once and return which of them are in place"""
+    with schema_lock:
+        if schema_status:
+            return schema_status
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                for name, statement in SCHEMA_STATEMENTS.items():
+                    try:
+                        cursor.execute(statement)
+                        conn.commit()
+                        schema_status[name] = True
+                    except Exception as e:
+                        conn.rollback()
+                        schema_status[name] = False
+                        log.warning(f"⚠️ Schema step '{name}' failed: {e}")
+                cursor.close()
+        except Exception as e:
+            log.error(f"❌ Error ensuring database schema: {e}")
+            schema_status.clear()
+        return schema_status
+
 def send_notifications(device_id):
+    """Publish the notifications device_id has not acknowledged yet, even if already sent"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        return notification_feed.deliver(device_id, force=True)
+    except Exception as e:
+        log.error(f"❌ Error sending notifications to {device_id}: {e}")
+        return False
 
-        # Fetch notifications for this specific vehicle ID
-        cursor.execute("""
-            SELECT message FROM notifications 
-            WHERE vehicle_id = %s 
-            ORDER BY created_at DESC
-        """, device_id)
+@metrics.timed("get_road_type_from_osm")
+def get_road_type_from_osm(lat, lon):
+    """Get road type from the offline index or OpenStreetMap Overpass API with caching"""
+    cache_key = f"{lat:.4f},{lon:.4f}"  # Round to ~11m precision for caching
 
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+    try:
+        return road_type_cache.get_or_load(cache_key, lambda: lookup_road_type(lat, lon))
+    except Exception as e:
+        log.error(f"❌ Error getting road type for {lat},{lon}: {e}")
+        return "Other Roads"
 
-        if rows:
-            # Join all notification messages with newlines
-            notification_text = '\n'.join([row.message.strip() for row in rows])
-            print(f"📤 Sending {len(rows)} notifications to device {device_id}")
-        else:
-            notification_text = ""
-            print(f"📤 No notifications found for device {device_id}")
+@metrics.timed("road_type_lookup")
+def lookup_road_type(lat, lon):
+    """Uncached road type lookup, returning (road_type, negative)"""
+    # Answer locally when the offline index covers this point
+    if road_index is not None and road_index.covers(lat, lon):
+        return map_highway_to_road_type(road_index.nearest_highway(lat, lon) or ''), False
 
-        # Send notifications to device
-        topic = f"device/{device_id}/notifications"
-        payload = json.dumps({"notifications": notification_text})
-        result = mqtt_client.publish(topic, payload, qos=1, retain=False)
+    try:
+        with metrics.timer("overpass_request"):
+            response = requests.post(OVERPASS_URL, data=overpass_query(lat, lon), timeout=10)
+        if response.status_code == 200:
+            return road_type_from_overpass(response.json())
 
-        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            print(f"✅ Notifications sent to {device_id}")
-            result.wait_for_publish(timeout=5)
-            return True
-        else:
-            print(f"❌ Failed to send notifications to {device_id}: RC={result.rc}")
-            return False
+        # Default to "Other Roads" on an API error; cached only briefly
+        return "Other Roads", True
 
     except Exception as e:
-        print(f"❌ Error sending notifications to {device_id}: {e}")
-        return False
+        log.error(f"❌ Error getting road type for {lat},{lon}: {e}")
+        return "Other Roads", True
 
-def get_road_type_from_osm(lat, lon):
-    """Get road type from OpenStreetMap Overpass API with caching"""
-    cache_key = f"{lat:.4f},{lon:.4f}"  # Round to ~11m precision for caching
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
 
-    if cache_key in road_type_cache:
-        return road_type_cache[cache_key]
-
-    try:
-        # Overpass API query to find nearest road
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        overpass_query = f"""
+def overpass_query(lat, lon):
+    """Overpass API query to find the nearest road"""
+    return f"""
         [out:json][timeout:10];
         (
           way["highway"](around:20,{lat},{lon});
@@ -104,30 +260,32 @@ def get_road_type_from_osm(lat, lon):
         out tags;
         """
 
-        response = requests.post(overpass_url, data=overpass_query, timeout=10)
-
-        if response.status_code == 200:
-            data = response.json()
-
-            if data['elements']:
-                # Get the first road found
-                highway_tag = data['elements'][0]['tags'].get('highway', '')
-
-                # Map OSM highway tags to our road categories
-                road_type = map_highway_to_road_type(highway_tag)
-
-                # Cache the result
-                road_type_cache[cache_key] = road_type
-                return road_type
-
-        # Default to "Other Roads" if no road found or API error
-        road_type_cache[cache_key] = "Other Roads"
-        return "Other Roads"
-
-    except Exception as e:
-        print(f"❌ Error getting road type for {lat},{lon}: {e}")
-        road_type_cache[cache_key] = "Other Roads"
-        return "Other Roads"
+def road_type_from_overpass(data):
+    """(road_type, negative) from an Overpass response"""
+    if data['elements']:
+        # Get the first road found
+        highway_tag = data['elements'][0]['tags'].get('highway', '')
+
+        # Map OSM highway tags to our road categories
+        return map_highway_to_road_type(highway_tag), False
+
+    # Default to "Other Roads" if no road found; cached only briefly
+    return "Other Roads", True
+
+def get_road_types_for_points(lats, lons):
+    """Road type for every point of a trip, batching lookups through the offline index"""
+    if road_index is None:
+        return [get_road_type_from_osm(lat, lon) for lat, lon in zip(lats, lons)]
+
+    road_types = [None] * len(lats)
+    covered = [i for i in range(len(lats)) if road_index.covers(lats[i], lons[i])]
+    highway_tags = road_index.nearest_highways(lats[covered], lons[covered])
+    for i, highway_tag in zip(covered, highway_tags):
+        road_types[i] = map_highway_to_road_type(highway_tag or '')
+    for i in range(len(lats)):
+        if road_types[i] is None:
+            road_types[i] = get_road_type_from_osm(lats[i], lons[i])
+    return road_types
 
 def map_highway_to_road_type(highway_tag):
     """Map OSM highway tags to our 4 road categories"""
@@ -148,23 +306,14 @@ def map_highway_to_road_type(highway_tag):
     # Everything else - local roads, residential, etc.
     return "Other Roads"
 
+@metrics.timed("get_speed_limit_for_vehicle")
 def get_speed_limit_for_vehicle(vehicle_id, road_type):
     """Get speed limit for a vehicle on a specific road type"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT speed_limit FROM settings 
-            WHERE vehicle_id = %s AND road_type = %s
-        """, vehicle_id, road_type)
-
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        speed_limit = reference_data.speed_limit(vehicle_id, road_type)
 
-        if result:
-            return float(result[0])
+        if speed_limit is not None:
+            return speed_limit
         else:
             # Default speed limits if not set in settings
             defaults = {
@@ -176,32 +325,28 @@ def get_speed_limit_for_vehicle(vehicle_id, road_type):
             return defaults.get(road_type, 50.0)
 
     except Exception as e:
-        print(f"❌ Error getting speed limit: {e}")
+        log.error(f"❌ Error getting speed limit: {e}")
         return 50.0  # Default fallback
 
 def check_event_exists(vehicle_id, driver_id, timestamp, lat, lon, event_type):
     """Check if an event already exists to prevent duplicates"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT COUNT(*) FROM events 
-            WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s 
-            AND ABS(lat - %s) < 0.0001 AND ABS(lon - %s) < 0.0001 
-            AND event_type = %s
-        """, vehicle_id, driver_id, timestamp, lat, lon, event_type)
-
-        count = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+        with db_pool.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) FROM events 
+                WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s 
+                AND ABS(lat - %s) < 0.0001 AND ABS(lon - %s) < 0.0001 
+                AND event_type = %s
+            """, (vehicle_id, driver_id, timestamp, lat, lon, event_type))
+            count = cursor.fetchone()[0]
 
         return count > 0
 
     except Exception as e:
-        print(f"❌ Error checking event existence: {e}")
+        log.error(f"❌ Error checking event existence: {e}")
         return False
 
+@metrics.timed("insert_event")
 def insert_event(vehicle_id, driver_id, timestamp, lat, lon, event_type):
     """Insert an event into the events table"""
     try:
@@ -209,208 +354,198 @@ def insert_event(vehicle_id, driver_id, timestamp, lat, lon, event_type):
         if check_event_exists(vehicle_id, driver_id, timestamp, lat, lon, event_type):
             return False
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            INSERT INTO events (vehicle_id, driver_id, timestamp, lat, lon, event_type)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, vehicle_id, driver_id, timestamp, lat, lon, event_type)
-
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_pool.cursor(commit=True) as cursor:
+            cursor.execute("""
+                INSERT INTO events (vehicle_id, driver_id, timestamp, lat, lon, event_type)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (vehicle_id, driver_id, timestamp, lat, lon, event_type))
 
-        print(f"✅ Event inserted: {event_type} for vehicle {vehicle_id}")
+        points_log.info("✅ Event inserted: %s for vehicle %s", event_type, vehicle_id)
         return True
 
     except Exception as e:
-        print(f"❌ Error inserting event: {e}")
+        log.error(f"❌ Error inserting event: {e}")
         return False
 
+def record_event(sink, vehicle_id, driver_id, timestamp, lat, lon, event_type):
+    """Queue an event on the batch's sink, or insert it directly when there is none"""
+    if sink is not None:
+        return sink.add(vehicle_id, driver_id, timestamp, lat, lon, event_type)
+    return insert_event(vehicle_id, driver_id, timestamp, lat, lon, event_type)
+
+@metrics.timed("event_flush")
+def flush_events(cursor, sink):
+    """Write a batch's queued events, returning (inserted, duplicates)"""
+    if ensure_schema().get("events_unique"):
+        return sink.flush(cursor)
+
+    # No unique index to lean on: fall back to checked single-row inserts
+    inserted = 0
+    for row in sink.rows():
+        if insert_event(*row):
+            inserted += 1
+    return inserted, sink.duplicates + len(sink) - inserted
+
 def smooth_speeds(speeds, window_size=3):
     """Apply median smoothing to speeds to reduce noise"""
     if len(speeds) < window_size:
         return speeds
+    return harsh_events.rolling_median(speeds, window_size).tolist()
 
-    smoothed = []
-    half_window = window_size // 2
-
-    for i in range(len(speeds)):
-        start = max(0, i - half_window)
-        end = min(len(speeds), i + half_window + 1)
-        window = speeds[start:end]
-        smoothed.append(statistics.median(window))
-
-    return smoothed
-
-def detect_harsh_events(gps_points, vehicle_id, driver_id):
+def detect_harsh_events(gps_points, vehicle_id, driver_id, profile=None, sink=None):
     """Detect harsh braking and acceleration events"""
     if len(gps_points) < 2:
         return
 
-    # Extract speeds and smooth them
-    speeds = [point['speed'] for point in gps_points]
-    smoothed_speeds = smooth_speeds(speeds)
-
-    events_detected = 0
+    # Parse every timestamp once and run all windows on arrays
+    timestamps = [point['timestamp'] for point in gps_points]
+    epochs = harsh_events.parse_timestamps(timestamps)
+    if np.isnan(epochs).any():
+        log.error(f"❌ Timestamp parse error for {int(np.isnan(epochs).sum())} points - assuming 1s intervals there")
+    speeds = np.fromiter((point['speed'] for point in gps_points), dtype=np.float64, count=len(gps_points))
 
-    for i in range(1, len(gps_points)):
-        current_speed = smoothed_speeds[i]
-        prev_speed = smoothed_speeds[i - 1]
-
-        # Skip if speed is too low (parking/creep)
-        if current_speed < 10 and prev_speed < 10:
-            continue
+    events = harsh_events.detect(epochs, speeds, profile or harsh_event_profile)
 
-        # Parse timestamps and calculate actual time_diff
-        try:
-            prev_time = datetime.strptime(gps_points[i - 1]['timestamp'], '%Y-%m-%d %H:%M:%S')
-            curr_time = datetime.strptime(gps_points[i]['timestamp'], '%Y-%m-%d %H:%M:%S')
-            time_diff = (curr_time - prev_time).total_seconds()
-            if time_diff <= 0:
-                continue  # Skip duplicates or invalid timestamps
-        except ValueError as e:
-            print(f"❌ Timestamp parse error: {e} - assuming 1s interval for this point")
-            time_diff = 1.0
-
-        speed_diff = current_speed - prev_speed
-        accel = speed_diff / time_diff  # Acceleration in km/h per second
-
-        point = gps_points[i]
+    for index, event, _ in events:
+        point = gps_points[index]
         timestamp = point['timestamp']
         if 'T' in timestamp or 'Z' in timestamp:
             timestamp = convert_to_pkt(timestamp)
+        record_event(sink, vehicle_id, driver_id, timestamp,
+                     point['lat'], point['lon'], harsh_events.EVENT_TYPES[event])
+
+    if len(events) > 0:
+        log.info(f"🚨 Detected {len(events)} harsh driving events")
 
-        # Check for harsh braking (adjusted for time_diff)
-        if accel <= -15:  # -15 km/h/s threshold
-            insert_event(vehicle_id, driver_id, timestamp,
-                         point['lat'], point['lon'], 'harsh_brake')
-            events_detected += 1
-
-        # Check for harsh acceleration
-        elif accel >= 19:  # +19 km/h/s threshold
-            insert_event(vehicle_id, driver_id, timestamp,
-                         point['lat'], point['lon'], 'harsh_acceleration')
-            events_detected += 1
-
-        curr_time = datetime.strptime(gps_points[i]['timestamp'], '%Y-%m-%d %H:%M:%S')
-
-        # Optional: Multi-second patterns with normalized accel
-        if i >= 2:
-            # 2-second window
-            time_i_minus_2 = datetime.strptime(gps_points[i - 2]['timestamp'], '%Y-%m-%d %H:%M:%S')
-            delta2 = (curr_time - time_i_minus_2).total_seconds()
-            if delta2 > 0:
-                two_sec_diff = current_speed - smoothed_speeds[i - 2]
-                accel2 = two_sec_diff / delta2
-                if accel2 <= -13.5:  # Adjusted threshold (~ -27 km/h over 2s)
-                    insert_event(vehicle_id, driver_id, timestamp,
-                                 point['lat'], point['lon'], 'harsh_brake')
-                    events_detected += 1
-                elif accel2 >= 13.5:  # Adjusted (~ +27 km/h over 2s)
-                    insert_event(vehicle_id, driver_id, timestamp,
-                                 point['lat'], point['lon'], 'harsh_acceleration')
-                    events_detected += 1
-
-        if i >= 3:
-            # 3-second window
-            time_i_minus_3 = datetime.strptime(gps_points[i - 3]['timestamp'], '%Y-%m-%d %H:%M:%S')
-            delta3 = (curr_time - time_i_minus_3).total_seconds()
-            if delta3 > 0:
-                three_sec_diff = current_speed - smoothed_speeds[i - 3]
-                accel3 = three_sec_diff / delta3
-                if accel3 <= -13.3:  # Adjusted (~ -40 km/h over 3s)
-                    insert_event(vehicle_id, driver_id, timestamp,
-                                 point['lat'], point['lon'], 'harsh_brake')
-                    events_detected += 1
-                elif accel3 >= 11.7:  # Adjusted (~ +35 km/h over 3s)
-                    insert_event(vehicle_id, driver_id, timestamp,
-                                 point['lat'], point['lon'], 'harsh_acceleration')
-                    events_detected += 1
-
-    if events_detected > 0:
-        print(f"🚨 Detected {events_detected} harsh driving events")
-
-def calculate_distance_and_check_events(gps_points, vehicle_id, driver_id):
+def calculate_distance_and_check_events(gps_points, vehicle_id, driver_id, sink=None):
     """Calculate distance traveled and check for speeding events"""
     if len(gps_points) < 2:
         return 0.0
 
-    total_distance = 0.0
-
-    # Calculate distance between consecutive points
-    for i in range(1, len(gps_points)):
-        prev_point = gps_points[i - 1]
-        curr_point = gps_points[i]
+    # Distances for the whole session in one vectorized call
+    lats = np.fromiter((point['lat'] for point in gps_points), dtype=np.float64, count=len(gps_points))
+    lons = np.fromiter((point['lon'] for point in gps_points), dtype=np.float64, count=len(gps_points))
+    with metrics.timer("geodesic_distance"):
+        _, total_distance = path_distance_km(lats, lons)
 
-        prev_lat, prev_lon = prev_point['lat'], prev_point['lon']
-        curr_lat, curr_lon = curr_point['lat'], curr_point['lon']
+    # Every point after the first is checked against the limit for its road
+    record_overspeed_events(sink, vehicle_id, driver_id, [point['timestamp'] for point in gps_points[1:]],
+                            lats[1:], lons[1:], [point['speed'] for point in gps_points[1:]])
 
-        # Calculate distance
-        distance = geodesic((prev_lat, prev_lon), (curr_lat, curr_lon)).kilometers
-        total_distance += distance
-
-        # Check for overspeeding at current point
-        curr_speed = curr_point['speed']
+    return total_distance
 
-        # Get road type for current point
-        road_type = get_road_type_from_osm(curr_lat, curr_lon)
+def record_overspeed_events(sink, vehicle_id, driver_id, timestamps, lats, lons, speeds):
+    """Check points against the speed limit of their road type"""
+    # Road type for every point, in one batch
+    road_types = get_road_types_for_points(lats, lons)
 
+    for i, curr_speed in enumerate(speeds):
         # Get speed limit for this vehicle and road type
-        speed_limit = get_speed_limit_for_vehicle(vehicle_id, road_type)
+        speed_limit = get_speed_limit_for_vehicle(vehicle_id, road_types[i])
 
         # Check if overspeeding
         if curr_speed > speed_limit:
-            timestamp = curr_point['timestamp']
+            timestamp = timestamps[i]
             if 'T' in timestamp or 'Z' in timestamp:
                 timestamp = convert_to_pkt(timestamp)
 
-            insert_event(vehicle_id, driver_id, timestamp,
-                         curr_lat, curr_lon, 'overspeeding')
-
-    return total_distance
+            record_event(sink, vehicle_id, driver_id, timestamp,
+                         float(lats[i]), float(lons[i]), 'overspeeding')
 
 def update_vehicle_mileage(vehicle_id, distance_km):
     """Update the total mileage of a vehicle"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            UPDATE vehicles 
-            SET total_milage = total_milage + %s 
-            WHERE id = %s
-        """, distance_km, vehicle_id)
-
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_pool.cursor(commit=True) as cursor:
+            cursor.execute("""
+                UPDATE vehicles 
+                SET total_milage = total_milage + %s 
+                WHERE id = %s
+            """, (distance_km, vehicle_id))
 
-        print(f"✅ Updated vehicle {vehicle_id} mileage by {distance_km:.2f} km")
+        log.info(f"✅ Updated vehicle {vehicle_id} mileage by {distance_km:.2f} km")
         return True
 
     except Exception as e:
-        print(f"❌ Error updating vehicle mileage: {e}")
+        log.error(f"❌ Error updating vehicle mileage: {e}")
         return False
 
 def send_driver_list(device_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM drivers")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
-
-        driver_list = [{"id": str(r.id), "name": r.name.strip()} for r in rows]
+        driver_list = [{"id": str(driver_id), "name": name.strip()} for driver_id, name in reference_data.drivers()]
         payload = json.dumps({"drivers": driver_list})
         topic = f"device/{device_id}/config"
-        mqtt_client.publish(topic, payload)
-        print(f"📤 Sent {len(driver_list)} drivers to {device_id}")
+        publish_async(topic, payload, qos=0)
+        log.info(f"📤 Sent {len(driver_list)} drivers to {device_id}")
     except Exception as e:
-        print(f"❌ Error sending driver list: {e}")
+        log.error(f"❌ Error sending driver list: {e}")
+
+# QoS 1 publishes awaiting PUBACK: mid -> (topic, sent_at)
+pending_publishes = {}
+# Acknowledgements that arrived before publish_async recorded their mid: mid -> acked_at
+early_acks = {}
+# QoS 0 publishes paho has not reported through on_publish yet: mid -> sent_at
+qos0_sent = {}
+publish_stats = {"sent": 0, "acked": 0, "ack_total": 0.0, "ack_max": 0.0}
+publish_lock = threading.RLock()
+
+def _record_ack(ack_time):
+    publish_stats["acked"] += 1
+    publish_stats["ack_total"] += ack_time
+    publish_stats["ack_max"] = max(publish_stats["ack_max"], ack_time)
+
+def publish_async(topic, payload, qos=1, retain=False):
+    """Queue a publish on the paho client without waiting for the broker's acknowledgement"""
+    # paho holds its message mutex while it calls on_publish, so publish() must not run
+    # under publish_lock: the two threads would wait on each other's lock
+    sent_at = time.monotonic()
+    result = mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        with publish_lock:
+            acked_at = early_acks.pop(result.mid, None)
+            if qos == 0:
+                # paho reports QoS 0 sends through on_publish too; whichever side runs
+                # second drops the mid, so it cannot match a later QoS 1 publish
+                if acked_at is None:
+                    qos0_sent[result.mid] = sent_at
+            else:
+                qos0_sent.pop(result.mid, None)
+                publish_stats["sent"] += 1
+                if acked_at is None:
+                    pending_publishes[result.mid] = (topic, sent_at)
+                else:
+                    _record_ack(acked_at - sent_at)
+    return result
+
+def on_publish(client, userdata, mid):
+    now = time.monotonic()
+    with publish_lock:
+        pending = pending_publishes.pop(mid, None)
+        if pending is not None:
+            _record_ack(now - pending[1])
+            return
+        if qos0_sent.pop(mid, None) is not None:
+            return
+        early_acks[mid] = now
+        # Publishes dropped before they were sent are never reported; forget them
+        for table in (early_acks, qos0_sent):
+            if len(table) > 1000:
+                for stale in [m for m, at in table.items() if now - at > 10]:
+                    del table[stale]
+
+def publish_status():
+    with publish_lock:
+        now = time.monotonic()
+        acked = publish_stats["acked"]
+        return {
+            "sent": publish_stats["sent"],
+            "acked": acked,
+            "awaiting_ack": len(pending_publishes),
+            "awaiting_ack_over_5s": sum(1 for _, sent_at in pending_publishes.values() if now - sent_at > 5),
+            "ack_avg_ms": round(publish_stats["ack_total"] / acked * 1000, 2) if acked else 0.0,
+            "ack_max_ms": round(publish_stats["ack_max"] * 1000, 2),
+        }
 
+@metrics.timed("send_confirmation")
 def send_confirmation(device_id, driver_id, status="success", message=""):
     topic = f"device/{device_id}/confirmation"
     payload = json.dumps({
@@ -419,15 +554,15 @@ def send_confirmation(device_id, driver_id, status="success", message=""):
         "message": message,
         "timestamp": datetime.now(PKT).isoformat()
     })
-    result = mqtt_client.publish(topic, payload, qos=1, retain=False)
+    result = publish_async(topic, payload)
     if result.rc == mqtt.MQTT_ERR_SUCCESS:
-        print(f"📤 Sent confirmation to {device_id}: {status} - {message}")
-        result.wait_for_publish(timeout=5)
+        log.info("📤 Sent confirmation to %s: %s - %s", device_id, status, message)
         return True
     else:
-        print(f"❌ Failed to send confirmation to {device_id}: RC={result.rc}")
+        log.error(f"❌ Failed to send confirmation to {device_id}: RC={result.rc}")
         return False
 
+@metrics.timed("validate_gps_data")
 def validate_gps_data(data):
     required_fields = ['driver_id', 'lat', 'lon', 'speed', 'timestamp', 'device_id']
     for field in required_fields:
@@ -442,8 +577,14 @@ def validate_gps_data(data):
         if speed < 0: return False, f"Invalid speed: {speed}"
     except:
         return False, "Invalid numeric values"
+    # Live rows are flushed in shared batches, so a timestamp Postgres rejects must not get that far
+    try:
+        datetime.fromisoformat(str(data['timestamp']).strip().replace('Z', '+00:00'))
+    except ValueError:
+        return False, f"Invalid timestamp: {data['timestamp']}"
     return True, "Valid"
 
+@metrics.timed("validate_batch_gps_data")
 def validate_batch_gps_data(data):
     required_fields = ['driver_id', 'lat', 'lon', 'speed', 'time', 'device_id']
     for field in required_fields:
@@ -463,22 +604,17 @@ def validate_batch_gps_data(data):
 def check_gps_data_exists(device_id, driver_id, timestamp, lat, lon, speed):
     """Check if GPS data point already exists in database"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT COUNT(*) FROM GPSData 
-            WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s 
-            AND ABS(lat - %s) < 0.000001 AND ABS(lon - %s) < 0.000001 AND ABS(speed - %s) < 0.01
-        """, device_id, driver_id, timestamp, lat, lon, speed)
-
-        count = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+        with db_pool.cursor() as cursor:
+            cursor.execute("""
+                SELECT COUNT(*) FROM GPSData 
+                WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s 
+                AND ABS(lat - %s) < 0.000001 AND ABS(lon - %s) < 0.000001 AND ABS(speed - %s) < 0.01
+            """, (device_id, driver_id, timestamp, lat, lon, speed))
+            count = cursor.fetchone()[0]
 
         return count > 0
     except Exception as e:
-        print(f"❌ Error checking GPS data existence: {e}")
+        log.error(f"❌ Error checking GPS data existence: {e}")
         return False
 
 def handle_live_gps_data(data):
@@ -491,192 +627,400 @@ def handle_live_gps_data(data):
         lon = float(data.get('lon', 0))
         speed = float(data.get('speed', 0))
 
-        print(
-            f"📡 Live GPS - Device: {device_id}, Driver: {driver_id}, Location: {lat:.6f},{lon:.6f}, Speed: {speed:.2f}")
+        points_log.info("📡 Live GPS - Device: %s, Driver: %s, Location: %.6f,%.6f, Speed: %.2f",
+                        device_id, driver_id, lat, lon, speed)
 
         is_valid, error_msg = validate_gps_data(data)
         if not is_valid:
-            print(f"❌ Invalid live GPS data: {error_msg}")
+            log.error(f"❌ Invalid live GPS data: {error_msg}")
             return False
 
         if not verify_device_exists(device_id):
-            print(f"⚠️ Live GPS: Device {device_id} not verified, but continuing...")
+            log.warning(f"⚠️ Live GPS: Device {device_id} not verified, but continuing...")
 
         if not verify_driver_exists(driver_id):
-            print(f"⚠️ Live GPS: Driver {driver_id} not verified, but continuing...")
+            log.warning(f"⚠️ Live GPS: Driver {driver_id} not verified, but continuing...")
 
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
+        # Queued for the write-behind flusher; duplicates are dropped in memory
+        result = live_buffer.submit(device_id, driver_id, timestamp, lat, lon, max(0.0, speed))
+        if result == "duplicate":
+            points_log.warning("⚠️ Live GPS data with same timestamp already exists, skipping")
+        elif result == "queued":
+            latest_positions.update(device_id, driver_id, timestamp, lat, lon, max(0.0, speed))
+        return result != "stopped"
 
-            # Check for duplicates in GPSData_live table
-            cursor.execute("""
-                SELECT COUNT(*) FROM GPSData_live 
-                WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s
-            """, device_id, driver_id, timestamp)
+    except Exception as e:
+        log.error(f"❌ Error handling live GPS data: {e}")
+        return False
 
-            existing_count = cursor.fetchone()[0]
-            if existing_count > 0:
-                print(f"⚠️ Live GPS data with same timestamp already exists, skipping")
-                cursor.close()
-                conn.close()
-                return True
+def write_live_rows(rows):
+    """Flush a batch of buffered live points to GPSData_live in one statement"""
+    conflict = "ON CONFLICT (vehicle_id, driver_id, timestamp) DO NOTHING" \
+        if ensure_schema().get("gpsdata_live_unique") else ""
+    with db_pool.cursor(commit=True) as cursor:
+        psycopg2.extras.execute_values(cursor, f"""
+            INSERT INTO GPSData_live (vehicle_id, driver_id, timestamp, lat, lon, speed)
+            VALUES %s
+            {conflict}
+        """, rows, page_size=len(rows))
+    publish_positions(rows)
+
+def publish_positions(rows):
+    """Upsert the newest fix per vehicle of a live flush into latest_positions; never raises,
+    the live points themselves are already stored"""
+    if not ensure_schema().get("latest_positions"):
+        return
+    try:
+        with db_pool.cursor(commit=True) as cursor:
+            psycopg2.extras.execute_values(cursor, positions_upsert_sql(), newest_rows(rows))
+    except Exception as e:
+        log.warning(f"⚠️ Could not update latest_positions: {e}")
+
+live_buffer = LiveWriteBuffer(
+    write_live_rows,
+    max_batch=int(os.getenv("LIVE_FLUSH_ROWS", "500")),
+    max_delay=float(os.getenv("LIVE_FLUSH_MS", "200")) / 1000.0,
+    max_pending=int(os.getenv("LIVE_MAX_PENDING", "50000")),
+)
+atexit.register(live_buffer.close)
+
+# Last known position per device, served by /positions without a database query.  This
+# process's own live points land in it at once; position_sync adds the rest of the fleet,
+# which other ingest processes write to latest_positions (the web dyno ingests nothing).
+latest_positions = LatestPositionStore(cell_deg=float(os.getenv("POSITION_GRID_DEG", "0.05")))
+position_sync = PositionSync(
+    db_pool,
+    latest_positions,
+    interval=float(os.getenv("POSITION_SYNC_INTERVAL", "1")),
+    lookback=float(os.getenv("POSITION_SYNC_LOOKBACK", "2")),
+    available=lambda: ensure_schema().get("latest_positions"),
+)
+
+ingest_stats = {"not_owned": 0}
+
+def owns_device(device_id):
+    """Whether this process handles the batch sessions of device_id"""
+    if INGEST_BATCH_ROUTING == "shared" or INGEST_SHARDS <= 1:
+        return True
+    return zlib.crc32(device_id.encode("utf-8")) % INGEST_SHARDS == INGEST_SHARD_INDEX
 
-            speed = max(0.0, speed)
+@metrics.timed("on_message_decode")
+def route_message(topic, payload):
+    """(key, stage, data, device_id) for an MQTT message, or None when it is not processed here.
 
-            # Insert into GPSData_live table instead of GPSData
-            cursor.execute("""
-                INSERT INTO GPSData_live (vehicle_id, driver_id, timestamp, lat, lon, speed)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, device_id, driver_id, timestamp, lat, lon, speed)
+    Messages with the same key are processed strictly in arrival order.  Raises
+    json.JSONDecodeError or compact_upload.ChunkError for payloads that cannot be read.
+    """
+    if topic.endswith("/chunk") or topic.endswith("/batch"):
+        # Per-device batch topics: drop other shards' devices before decoding anything
+        if not owns_device(topic.split("/")[1]):
+            ingest_stats["not_owned"] += 1
+            return None
+
+    if topic.endswith("/chunk"):
+        # Compact batch chunks are binary; only the header is read here
+        device_id = topic.split("/")[1]
+        upload_id, seq, _, driver_id = compact_upload.peek(payload)
+        points_log.info("📥 MQTT Topic: %s, chunk %d of upload %d (%d bytes)", topic, seq, upload_id, len(payload),
+                        extra={"device_id": device_id})
+        return ("batch", f"{device_id}_{driver_id}"), "batch_chunk", payload, device_id
+
+    data = json.loads(payload.decode())
+    device_id = data.get('device_id', '').strip()
+    points_log.info("📥 MQTT Topic: %s, Data: %s", topic, data, extra={"device_id": device_id or None})
+    if not device_id:
+        log.error("❌ Missing device_id")
+        return None
+
+    if topic.endswith("/boot"):
+        return ("boot", device_id), "boot", data, device_id
+    if topic.endswith("/notifications/ack"):
+        return ("notifications", device_id), "notification_ack", data, device_id
+    if topic.startswith("live/gps/"):
+        return ("live", device_id), "live", data, device_id
+    if topic == "gps/driver001" and not owns_device(device_id):
+        ingest_stats["not_owned"] += 1
+        return None
+    stage = {"START": "batch_start", "END": "batch_end"}.get(data.get('time', ''), "batch_point")
+    return ("batch", f"{device_id}_{data.get('driver_id', '').strip()}"), stage, data, device_id
 
-            conn.commit()
-            cursor.close()
-            conn.close()
+def on_message(client, userdata, msg):
+    """Decode on the paho network thread and hand the message to the ordered worker pool"""
+    try:
+        routed = route_message(msg.topic, msg.payload)
+        if routed is not None:
+            key, stage, data, device_id = routed
+            if admission.admit(key, stage, (key, stage, msg.topic, data, device_id), device_id):
+                message_dispatcher.submit(key, stage, msg.topic, data, device_id, timeout=submit_timeout(stage))
 
-            print(f"✅ Live GPS data saved to GPSData_live successfully")
-            return True
+    except json.JSONDecodeError:
+        log.error("❌ Invalid JSON received")
+    except compact_upload.ChunkError as e:
+        log.error(f"❌ Invalid batch chunk on {msg.topic}: {e}")
+    except QueueFull as e:
+        log.error(f"❌ Dropping MQTT message on {msg.topic}: {e}")
+    except Exception as e:
+        log.error(f"❌ MQTT Error: {e}")
+
+def process_message(topic, data, device_id):
+    """Handle one decoded MQTT message; runs on a dispatcher worker"""
+    with device_context(device_id):
+        try:
+            if topic.endswith("/boot"):
+                log.info(f"🔔 {device_id} booted. Sending driver list...")
+                send_driver_list(device_id)
+                notification_feed.deliver(device_id)
+                return
+
+            if topic.endswith("/notifications/ack"):
+                notification_feed.acknowledge(device_id, data['version'])
+                return
+
+            if topic.startswith("live/gps/"):
+                points_log.info("📡 Processing live GPS data from %s", device_id)
+                handle_live_gps_data(data)
+                return
+
+            if topic.endswith("/chunk"):
+                handle_batch_chunk(data, device_id)
+                return
+
+            if topic == "gps/driver001" or topic.endswith("/batch"):
+                driver_id = data.get('driver_id', '').strip()
+                time_stamp = data.get('time', '')
+                session_key = f"{device_id}_{driver_id}"
+
+                if time_stamp == "START":
+                    data_sessions.start(session_key, device_id, driver_id)
+                    if session_spool:
+                        session_spool.open(session_key, device_id, driver_id)
+                    log.info(f"🟢 Started batch data session for {device_id} - {driver_id}")
+                    return
+
+                if time_stamp == "END":
+                    log.info(f"📥 Received END marker for {device_id} - {driver_id}")
+                    finish_batch_session(device_id, driver_id, session_key)
+                    return
+
+                session = data_sessions.get(session_key)
+                if session is None:
+                    log.warning(f"⚠️ No active batch session for GPS data: {session_key}")
+                    return
+
+                is_valid, error_msg = validate_batch_gps_data(data)
+                if not is_valid:
+                    log.error(f"❌ Invalid batch GPS data: {error_msg}")
+                    return
+
+                # Store ISO timestamps in the PKT form they are saved with, so they pack into the epoch column
+                if 'T' in time_stamp or 'Z' in time_stamp:
+                    time_stamp = convert_to_pkt(time_stamp)
+
+                lat, lon, speed = float(data['lat']), float(data['lon']), float(data['speed'])
+                if not data_sessions.add_point(session, time_stamp, lat, lon, speed):
+                    log.error(f"❌ Batch session {session_key} is over its memory cap, point rejected")
+                    return
+                if session_spool:
+                    session_spool.append(session_key, parse_timestamp(time_stamp), time_stamp, lat, lon, speed)
+                if INCREMENTAL_BATCH and (session.stream is None or session.stream.ready(session)):
+                    advance_batch_stream(session)
+                points_log.info("📍 Added GPS point to batch session %s (Total: %d)", session_key, len(session))
 
         except Exception as e:
-            print(f"❌ Error saving live GPS data to database: {e}")
-            return False
+            log.error(f"❌ MQTT Error: {e}")
 
-    except Exception as e:
-        print(f"❌ Error handling live GPS data: {e}")
-        return False
+def close_batch_session(device_id, driver_id, session_key):
+    """Mark a batch session complete once its END marker or last chunk has arrived.
 
-def on_message(client, userdata, msg):
-    try:
-        topic = msg.topic
-        data = json.loads(msg.payload.decode())
-        print(f"📥 MQTT Topic: {topic}, Data: {data}")
+    Missing, oversized and empty sessions are confirmed here; returns the session whose
+    points still need saving, or None.  Shared with async_ingest.AsyncIngest.
+    """
+    session = data_sessions.get(session_key)
+    if session is None:
+        log.warning(f"⚠️ No active batch session found for {device_id} - {driver_id}")
+        send_confirmation(device_id, driver_id, "success", "no_session_but_confirmed")
+        return None
+
+    session.complete = True
+    points_count = len(session)
+
+    log.info(f"🔚 Batch session ended for {device_id} - {driver_id} with {points_count} points")
+
+    if session.overflowed:
+        log.error(f"❌ Batch session {session_key} exceeded its memory cap - rejecting it")
+        send_confirmation(device_id, driver_id, "error", "error_session_too_large")
+        discard_session(session_key)
+        return None
+
+    if points_count == 0:
+        log.info(f"📤 Empty batch session - sending success confirmation")
+        success = send_confirmation(device_id, driver_id, "success", "empty_session_confirmed")
+        if success:
+            discard_session(session_key)
+        return None
+
+    log.info(f"🔄 Starting to process {points_count} batch GPS points...")
+    return session
+
+def confirm_batch_session(device_id, driver_id, session_key, result):
+    """Confirm a saved batch session with its (success, message) result and clean it up"""
+    success, msg = result
+    log.info(f"🔄 Processing batch data - Success: {success}, Message: {msg}")
+    if success and session_spool:
+        # The points are committed, so the session no longer needs recovering
+        session_spool.remove(session_key)
+
+    confirmation_sent = send_confirmation(device_id, driver_id, "success" if success else "error",
+                                          msg)
+    log.info(f"📤 Confirmation sent: {confirmation_sent}")
+
+    if confirmation_sent:
+        discard_session(session_key)
+        log.info(f"🧹 Cleaned up batch session: {session_key}")
+    else:
+        log.error(f"❌ Failed to send confirmation, keeping session: {session_key}")
 
-        device_id = data.get('device_id', '').strip()
-        if not device_id:
-            print("❌ Missing device_id")
-            return
+def batch_session_failed(device_id, driver_id, error):
+    """Report a batch session that could not be saved; it stays open for a resend"""
+    log.error(f"❌ Error processing END marker: {error}")
+    send_confirmation(device_id, driver_id, "error", f"processing_error: {str(error)}")
 
-        if topic.endswith("/boot"):
-            print(f"🔔 {device_id} booted. Sending driver list...")
-            send_driver_list(device_id)
+def finish_batch_session(device_id, driver_id, session_key):
+    """Save and confirm a batch session once its END marker or last chunk has arrived"""
+    try:
+        session = close_batch_session(device_id, driver_id, session_key)
+        if session is None:
             return
+        result = finish_batch_stream(session) if session.stream is not None else None
+        if result is None:
+            result = save_gps_data_to_db(device_id, driver_id, session.points())
+        confirm_batch_session(device_id, driver_id, session_key, result)
+    except Exception as e:
+        batch_session_failed(device_id, driver_id, e)
 
-        if topic.startswith("live/gps/"):
-            print(f"📡 Processing live GPS data from {device_id}")
-            handle_live_gps_data(data)
-            return
+def handle_batch_chunk(payload, device_id, finish=finish_batch_session):
+    """Apply a compact chunk to its batch session; chunks already applied are acknowledged again.
 
-        if topic == "gps/driver001":
-            driver_id = data.get('driver_id', '').strip()
-            time_stamp = data.get('time', '')
-            session_key = f"{device_id}_{driver_id}"
-
-            if time_stamp == "START":
-                data_sessions[session_key] = {
-                    'start_time': datetime.now(),
-                    'points': [],
-                    'complete': False
-                }
-                print(f"🟢 Started batch data session for {device_id} - {driver_id}")
-                return
+    finish(device_id, driver_id, session_key) is called when the chunk closes the session.
+    """
+    try:
+        chunk = compact_upload.decode(payload)
+    except compact_upload.ChunkError as e:
+        log.error(f"❌ Invalid batch chunk from {device_id}: {e}")
+        try:
+            send_confirmation(device_id, compact_upload.peek(payload)[3], "error", "error_invalid_chunk")
+        except compact_upload.ChunkError:
+            pass
+        return
 
-            if time_stamp == "END":
-                print(f"📥 Received END marker for {device_id} - {driver_id}")
+    driver_id = chunk.driver_id
+    session_key = f"{device_id}_{driver_id}"
+    session = data_sessions.get(session_key)
 
-                if session_key in data_sessions:
-                    session = data_sessions[session_key]
-                    session['complete'] = True
-                    points_count = len(session['points'])
+    if chunk.first and (session is None or session.upload_id != chunk.upload_id):
+        session = data_sessions.start(session_key, device_id, driver_id, upload_id=chunk.upload_id)
+        if session_spool:
+            session_spool.open(session_key, device_id, driver_id, upload_id=chunk.upload_id)
+        log.info(f"🟢 Started batch data session for {device_id} - {driver_id} (upload {chunk.upload_id})")
 
-                    print(f"🔚 Batch session ended for {device_id} - {driver_id} with {points_count} points")
+    if session is None or session.upload_id != chunk.upload_id:
+        if chunk.last:
+            finish(device_id, driver_id, session_key)
+        else:
+            log.warning(f"⚠️ No active batch session for chunk {chunk.seq} of upload {chunk.upload_id}: {session_key}")
+            send_confirmation(device_id, driver_id, "error", "error_unknown_upload")
+        return
 
-                    try:
-                        if points_count == 0:
-                            print(f"📤 Empty batch session - sending success confirmation")
-                            success = send_confirmation(device_id, driver_id, "success", "empty_session_confirmed")
-                            if success:
-                                del data_sessions[session_key]
-                            return
-
-                        print(f"🔄 Starting to process {points_count} batch GPS points...")
-                        success, msg = save_gps_data_to_db(device_id, driver_id, session['points'])
-                        print(f"🔄 Processing batch data - Success: {success}, Message: {msg}")
-
-                        confirmation_sent = send_confirmation(device_id, driver_id, "success" if success else "error",
-                                                              msg)
-                        print(f"📤 Confirmation sent: {confirmation_sent}")
-
-                        if confirmation_sent:
-                            del data_sessions[session_key]
-                            print(f"🧹 Cleaned up batch session: {session_key}")
-                        else:
-                            print(f"❌ Failed to send confirmation, keeping session: {session_key}")
+    if chunk.seq <= session.chunk_seq:
+        log.warning(f"⚠️ Chunk {chunk.seq} of upload {chunk.upload_id} already applied to {session_key}")
+        if chunk.last:
+            finish(device_id, driver_id, session_key)
+        else:
+            send_confirmation(device_id, driver_id, "success", f"chunk_{chunk.seq}_duplicate")
+        return
+    if chunk.seq != session.chunk_seq + 1:
+        log.error(f"❌ Chunk {chunk.seq} of upload {chunk.upload_id} arrived before chunk {session.chunk_seq + 1}")
+        send_confirmation(device_id, driver_id, "error", f"error_chunk_gap_expected_{session.chunk_seq + 1}")
+        return
 
-                    except Exception as e:
-                        print(f"❌ Error processing END marker: {e}")
-                        send_confirmation(device_id, driver_id, "error", f"processing_error: {str(e)}")
+    if data_sessions.add_points(session, chunk.epochs, chunk.lats, chunk.lons, chunk.speeds):
+        if session_spool:
+            session_spool.append_chunk(session_key, chunk.seq, chunk.epochs, chunk.lats, chunk.lons, chunk.speeds)
+        log.info(f"📍 Added {len(chunk.epochs)} GPS points from chunk {chunk.seq} to batch session {session_key} "
+                 f"(Total: {len(session)})")
+    else:
+        log.error(f"❌ Batch session {session_key} is over its memory cap, chunk {chunk.seq} rejected")
+    session.chunk_seq = chunk.seq
 
-                else:
-                    print(f"⚠️ No active batch session found for {device_id} - {driver_id}")
-                    send_confirmation(device_id, driver_id, "success", "no_session_but_confirmed")
-                return
+    if INCREMENTAL_BATCH and not session.overflowed and (session.stream is None or session.stream.ready(session)):
+        advance_batch_stream(session)
 
-            if session_key not in data_sessions:
-                print(f"⚠️ No active batch session for GPS data: {session_key}")
-                return
+    if chunk.last:
+        finish(device_id, driver_id, session_key)
+    else:
+        send_confirmation(device_id, driver_id, "success", f"chunk_{chunk.seq}_received")
 
-            is_valid, error_msg = validate_batch_gps_data(data)
-            if not is_valid:
-                print(f"❌ Invalid batch GPS data: {error_msg}")
-                return
+DISPATCH_SUBMIT_TIMEOUT = float(os.getenv("DISPATCH_SUBMIT_TIMEOUT", "0"))
 
-            point = {
-                'timestamp': time_stamp,
-                'lat': float(data['lat']),
-                'lon': float(data['lon']),
-                'speed': float(data['speed'])
-            }
-            data_sessions[session_key]['points'].append(point)
-            print(
-                f"📍 Added GPS point to batch session {session_key} (Total: {len(data_sessions[session_key]['points'])})")
+def submit_timeout(stage):
+    """How long submit() may wait for queue space before a message is dropped.
 
-    except json.JSONDecodeError:
-        print("❌ Invalid JSON received")
-    except Exception as e:
-        print(f"❌ MQTT Error: {e}")
+    Live and boot messages are dropped after DISPATCH_SUBMIT_TIMEOUT (at once by default),
+    a newer one follows soon.  A lost batch message would corrupt its session, so those
+    wait for space, which holds up the network thread and pushes back on the broker.
+    """
+    return DISPATCH_SUBMIT_TIMEOUT if stage in COLLAPSIBLE_STAGES else None
+message_dispatcher = OrderedDispatcher(
+    process_message,
+    workers=int(os.getenv("INGEST_WORKERS", "4")),
+    max_queue=int(os.getenv("INGEST_QUEUE_MAX", "10000")),
+    name="ingest",
+)
+
+def ingest_pressure():
+    """Fill level of the fuller of the dispatch queue and the live write-behind queue"""
+    return max(message_dispatcher.depth() / message_dispatcher.max_queue,
+               live_buffer.depth() / live_buffer.max_pending)
+
+# Sheds live/boot floods (per-device token buckets, global high-water mark) so batches keep flowing
+admission = AdmissionController(
+    rate=float(os.getenv("ADMISSION_RATE", "2")),
+    burst=float(os.getenv("ADMISSION_BURST", "10")),
+    high_water=float(os.getenv("ADMISSION_HIGH_WATER", "0.7")),
+    pressure=ingest_pressure,
+)
+ADMISSION_RELEASE_INTERVAL = float(os.getenv("ADMISSION_RELEASE_MS", "200")) / 1000.0
+
+def release_parked_messages():
+    """Hand parked live/boot messages to the workers once their devices and the queues allow it"""
+    while True:
+        time.sleep(ADMISSION_RELEASE_INTERVAL)
+        for key, stage, topic, data, device_id in admission.take_parked():
+            try:
+                message_dispatcher.submit(key, stage, topic, data, device_id, timeout=submit_timeout(stage))
+            except QueueFull as e:
+                log.error(f"❌ Dropping parked MQTT message on {topic}: {e}")
 
 def verify_device_exists(device_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, ba_number, make FROM vehicles WHERE id = %s", device_id)
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if result:
+        if reference_data.vehicle_exists(device_id):
             return True
         else:
-            print(f"❌ Device '{device_id}' not found in vehicles table")
+            log.error(f"❌ Device '{device_id}' not found in vehicles table")
             return False
     except Exception as e:
-        print(f"❌ Error verifying device: {e}")
+        log.error(f"❌ Error verifying device: {e}")
         return False
 
 def verify_driver_exists(driver_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM drivers WHERE id = %s", driver_id)
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if result:
+        if reference_data.driver_exists(driver_id):
             return True
         else:
-            print(f"❌ Driver '{driver_id}' not found in drivers table")
+            log.error(f"❌ Driver '{driver_id}' not found in drivers table")
             return False
     except Exception as e:
-        print(f"❌ Error verifying driver: {e}")
+        log.error(f"❌ Error verifying driver: {e}")
         return False
 
 def convert_to_pkt(utc_time_str):
@@ -687,75 +1031,130 @@ def convert_to_pkt(utc_time_str):
     except:
         return datetime.now(PKT).strftime('%Y-%m-%d %H:%M:%S')
 
+def gps_point_rows(device_id, driver_id, gps_points):
+    """Build GPSData rows for a batch, dropping repeated timestamps within the batch"""
+    rows = []
+    seen = set()
+    for point in gps_points:
+        pkt_timestamp = point['timestamp']
+        if 'T' in pkt_timestamp or 'Z' in pkt_timestamp:
+            pkt_timestamp = convert_to_pkt(pkt_timestamp)
+        if pkt_timestamp in seen:
+            continue
+        seen.add(pkt_timestamp)
+        rows.append((device_id, driver_id, pkt_timestamp, point['lat'], point['lon'], max(0.0, point['speed'])))
+    return rows
+
+def bulk_insert_gps_points(cursor, device_id, driver_id, gps_points):
+    """Insert a batch with multi-row VALUES, letting the unique index drop duplicates.
+
+    Returns (inserted, skipped).
+    """
+    inserted = insert_gps_rows(cursor, gps_point_rows(device_id, driver_id, gps_points))
+    return inserted, len(gps_points) - inserted
+
+def insert_gps_rows(cursor, rows):
+    """Multi-row insert into GPSData that skips rows already stored; returns the number inserted"""
+    if not rows:
+        return 0
+    inserted = psycopg2.extras.execute_values(cursor, """
+        INSERT INTO GPSData (vehicle_id, driver_id, timestamp, lat, lon, speed)
+        VALUES %s
+        ON CONFLICT (vehicle_id, driver_id, timestamp) DO NOTHING
+        RETURNING 1
+    """, rows, page_size=GPS_INSERT_PAGE_SIZE, fetch=True)
+    return len(inserted)
+
+def insert_gps_points_row_by_row(cursor, device_id, driver_id, gps_points):
+    """Fallback used when the GPSData unique index is unavailable.
+
+    Returns (inserted, skipped, errors).
+    """
+    inserted_count = 0
+    skipped_count = 0
+    error_count = 0
+
+    for i, point in enumerate(gps_points):
+        try:
+            pkt_timestamp = point['timestamp']
+            if 'T' in pkt_timestamp or 'Z' in pkt_timestamp:
+                pkt_timestamp = convert_to_pkt(pkt_timestamp)
+
+            speed = max(0.0, point['speed'])
+            lat = point['lat']
+            lon = point['lon']
+
+            cursor.execute("""
+                SELECT COUNT(*) FROM GPSData 
+                WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s
+            """, (device_id, driver_id, pkt_timestamp))
+
+            existing_count = cursor.fetchone()[0]
+            if existing_count > 0:
+                points_log.warning("⚠️ Skipping duplicate point %d: %s", i + 1, pkt_timestamp)
+                skipped_count += 1
+                continue
+
+            cursor.execute("""
+                INSERT INTO GPSData (vehicle_id, driver_id, timestamp, lat, lon, speed)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (device_id, driver_id, pkt_timestamp, lat, lon, speed))
+            inserted_count += 1
+
+            if (i + 1) % 10 == 0:
+                points_log.info("📍 Processed %d/%d points...", i + 1, len(gps_points))
+
+        except Exception as e:
+            error_count += 1
+            log.error(f"❌ Error inserting GPS point {i + 1}: {e}")
+            continue
+
+    return inserted_count, skipped_count, error_count
+
+@metrics.timed("save_gps_data_to_db")
 def save_gps_data_to_db(device_id, driver_id, gps_points):
     """Save batch GPS data with distance calculation and event detection"""
     try:
-        print(f"🔄 Starting to save {len(gps_points)} GPS points to database...")
+        log.info(f"🔄 Starting to save {len(gps_points)} GPS points to database...")
 
         if not verify_device_exists(device_id):
-            print(f"❌ Device verification failed: {device_id}")
+            log.error(f"❌ Device verification failed: {device_id}")
             return False, "error_invalid_device"
         if not verify_driver_exists(driver_id):
-            print(f"❌ Driver verification failed: {driver_id}")
+            log.error(f"❌ Driver verification failed: {driver_id}")
             return False, "error_invalid_driver"
 
+        # Events found below are collected here and written together with the points
+        sink = EventSink()
+
         # Calculate distance traveled in this batch
-        distance_traveled = calculate_distance_and_check_events(gps_points, device_id, driver_id)
-        print(f"📏 Distance traveled in batch: {distance_traveled:.2f} km")
+        distance_traveled = calculate_distance_and_check_events(gps_points, device_id, driver_id, sink=sink)
+        log.info(f"📏 Distance traveled in batch: {distance_traveled:.2f} km")
 
         # Detect harsh driving events
-        detect_harsh_events(gps_points, device_id, driver_id)
+        detect_harsh_events(gps_points, device_id, driver_id, sink=sink)
 
         # Update vehicle mileage
         if distance_traveled > 0:
             update_vehicle_mileage(device_id, distance_traveled)
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        success_count = 0
-        error_count = 0
-
-        for i, point in enumerate(gps_points):
-            try:
-                pkt_timestamp = point['timestamp']
-                if 'T' in pkt_timestamp or 'Z' in pkt_timestamp:
-                    pkt_timestamp = convert_to_pkt(pkt_timestamp)
-
-                speed = max(0.0, point['speed'])
-                lat = point['lat']
-                lon = point['lon']
-
-                cursor.execute("""
-                    SELECT COUNT(*) FROM GPSData 
-                    WHERE vehicle_id = %s AND driver_id = %s AND timestamp = %s
-                """, device_id, driver_id, pkt_timestamp)
-
-                existing_count = cursor.fetchone()[0]
-                if existing_count > 0:
-                    print(f"⚠️ Skipping duplicate point {i + 1}: {pkt_timestamp}")
-                    success_count += 1
-                    continue
-
-                cursor.execute("""
-                    INSERT INTO GPSData (vehicle_id, driver_id, timestamp, lat, lon, speed)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, device_id, driver_id, pkt_timestamp, lat, lon, speed)
-                success_count += 1
-
-                if (i + 1) % 10 == 0:
-                    print(f"📍 Processed {i + 1}/{len(gps_points)} points...")
-
-            except Exception as e:
-                error_count += 1
-                print(f"❌ Error inserting GPS point {i + 1}: {e}")
-                continue
-
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            if GPS_BULK_INSERT and ensure_schema().get("gpsdata_unique"):
+                inserted_count, skipped_count = bulk_insert_gps_points(cursor, device_id, driver_id, gps_points)
+                error_count = 0
+            else:
+                inserted_count, skipped_count, error_count = insert_gps_points_row_by_row(
+                    cursor, device_id, driver_id, gps_points)
+            events_inserted, events_duplicate = flush_events(cursor, sink)
+            conn.commit()
+            cursor.close()
 
-        print(f"✅ Database operation completed: {success_count} saved, {error_count} errors")
-        print(f"📊 Batch summary: {distance_traveled:.2f} km traveled, events detected and vehicle mileage updated")
+        success_count = inserted_count + skipped_count
+        log.info(f"✅ Database operation completed: {inserted_count} inserted, "
+                 f"{skipped_count} skipped as duplicates, {error_count} errors")
+        log.info(f"🚨 Events: {events_inserted} inserted, {events_duplicate} duplicates dropped")
+        log.info(f"📊 Batch summary: {distance_traveled:.2f} km traveled, events detected and vehicle mileage updated")
 
         if success_count > 0:
             return True, f"success_saved_{success_count}_points_distance_{distance_traveled:.2f}km"
@@ -763,68 +1162,218 @@ def save_gps_data_to_db(device_id, driver_id, gps_points):
             return False, "error_no_valid_points"
 
     except Exception as e:
-        print(f"❌ Critical database error in save_gps_data_to_db: {e}")
+        log.error(f"❌ Critical database error in save_gps_data_to_db: {e}")
         return False, "error_database"
 
+INCREMENTAL_BATCH = os.getenv("INCREMENTAL_BATCH", "1") == "1"
+INCREMENTAL_CHUNK_POINTS = int(os.getenv("INCREMENTAL_CHUNK_POINTS", "250"))
+
+@metrics.timed("advance_batch_stream")
+def advance_batch_stream(session, final=False):
+    """Write the points of a batch session that can no longer change.
+
+    Returns False once the session cannot be streamed (missing unique indexes, unknown
+    device/driver or a write error); its END then goes through save_gps_data_to_db.
+    """
+    stream = session.stream
+    if stream is None:
+        stream = session.stream = TripStream(harsh_event_profile, INCREMENTAL_CHUNK_POINTS)
+        schema = ensure_schema()
+        if not (GPS_BULK_INSERT and schema.get("gpsdata_unique") and schema.get("events_unique")) or \
+                not verify_device_exists(session.device_id) or not verify_driver_exists(session.driver_id):
+            stream.active = False
+    if not stream.active:
+        return False
+
+    device_id, driver_id = session.device_id, session.driver_id
+    try:
+        while True:
+            chunk = stream.take(session, final)
+            if chunk is None:
+                return True
+
+            if chunk.start == 0:
+                record_overspeed_events(stream.sink, device_id, driver_id, chunk.timestamps[1:],
+                                        chunk.lats[1:], chunk.lons[1:], chunk.speeds[1:].tolist())
+            else:
+                record_overspeed_events(stream.sink, device_id, driver_id, chunk.timestamps,
+                                        chunk.lats, chunk.lons, chunk.speeds.tolist())
+            for index, event in chunk.harsh:
+                i = index - chunk.start
+                record_event(stream.sink, device_id, driver_id, chunk.timestamps[i],
+                             float(chunk.lats[i]), float(chunk.lons[i]), harsh_events.EVENT_TYPES[event])
+
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                inserted = insert_gps_rows(cursor, stream.rows(chunk, device_id, driver_id))
+                flush_events(cursor, stream.sink)
+                conn.commit()
+                cursor.close()
+            stream.commit(chunk, inserted)
+            log.info(f"📦 Streamed points {stream.dropped + chunk.start + 1}-{stream.dropped + chunk.end} "
+                     f"of batch session {session.key}")
+    except Exception as e:
+        log.error(f"❌ Incremental processing of {session.key} failed, falling back to END-time save: {e}")
+        stream.active = False
+        return False
+
+def finish_batch_stream(session):
+    """Finalize a streamed session at END; (success, message) like save_gps_data_to_db, or None to fall back"""
+    if not advance_batch_stream(session, final=True):
+        return None
+    stream = session.stream
+    distance_traveled = stream.distance_km()
+    if distance_traveled > 0:
+        update_vehicle_mileage(session.device_id, distance_traveled)
+
+    points_count = len(session)
+    log.info(f"✅ Streamed batch completed in {stream.chunks} chunks: {stream.inserted} inserted, "
+             f"{points_count - stream.inserted} skipped as duplicates")
+    log.info(f"🚨 Events: {stream.sink.inserted} inserted, {stream.sink.duplicates} duplicates dropped")
+    log.info(f"📊 Batch summary: {distance_traveled:.2f} km traveled, events detected and vehicle mileage updated")
+    return True, f"success_saved_{points_count}_points_distance_{distance_traveled:.2f}km"
+
+def discard_session(session_key):
+    data_sessions.pop(session_key)
+    if session_spool:
+        session_spool.remove(session_key)
+
+def recover_sessions():
+    """Rebuild batch sessions that were still open when the previous process stopped"""
+    if not session_spool:
+        return
+    try:
+        recovered = session_spool.recover()
+    except Exception as e:
+        log.error(f"❌ Session spool recovery failed: {e}")
+        return
+    for r in recovered:
+        data_sessions.restore(r.key, r.device_id, r.driver_id, r.started_at,
+                              r.epochs, r.lats, r.lons, r.speeds, r.irregular,
+                              upload_id=r.upload_id, chunk_seq=r.chunk_seq)
+        log.info(f"♻️ Recovered batch session {r.key} with {len(r)} points"
+                 f"{' (torn tail discarded)' if r.torn else ''}")
+    if recovered:
+        log.info(f"♻️ Recovered {len(recovered)} batch sessions in {session_spool.stats()['recovery_ms']} ms")
+
 def cleanup_old_sessions():
     while True:
         try:
-            now = datetime.now()
-            expired = [k for k, v in data_sessions.items() if (now - v['start_time']).seconds > 3600]
-            for key in expired:
-                print(f"🧹 Cleaning expired session: {key}")
-                del data_sessions[key]
+            # Sleeps until the next session deadline rather than rescanning every session
+            for key in data_sessions.wait_for_expiry():
+                if session_spool:
+                    session_spool.remove(key)
+                log.info(f"🧹 Cleaning expired session: {key}")
         except Exception as e:
-            print(f"❌ Cleanup error: {e}")
-        time.sleep(300)
-
-mqtt_client = mqtt.Client(client_id=f"GPSServer_{int(time.time())}", clean_session=True)
+            log.error(f"❌ Cleanup error: {e}")
+            time.sleep(5)
+
+MQTT_HOST = os.getenv("MQTT_HOST", "broker.hivemq.com")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+# Unique per process, so ingest processes started together do not take over each other's connection
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID") or f"GPSServer_{socket.gethostname()}_{os.getpid()}"
+mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=True)
 mqtt_client.on_message = on_message
+mqtt_client.on_publish = on_publish
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
-        print("✅ Connected to MQTT broker")
-        client.subscribe("gps/driver001")
-        client.subscribe("gps/+/boot")
-        client.subscribe("live/gps/+")
-        print("✅ Subscribed to MQTT topics (including live GPS)")
+        log.info("✅ Connected to MQTT broker")
+        topics = ingest_subscriptions()
+        client.subscribe([(topic, 0) for topic in topics])
+        log.info(f"✅ Subscribed to MQTT topics (including live GPS): {', '.join(topics)}")
     else:
-        print(f"❌ Failed to connect to MQTT broker, return code {rc}")
+        log.error(f"❌ Failed to connect to MQTT broker, return code {rc}")
+
+def ingest_subscriptions():
+    """Topic filters for this process; stateless traffic is always split through the share group"""
+    def shared(topic):
+        return f"$share/{INGEST_SHARE_GROUP}/{topic}" if INGEST_SHARE_GROUP else topic
+
+    batch_topics = ["gps/driver001", "gps/+/batch", "gps/+/chunk"]
+    if INGEST_BATCH_ROUTING == "shared":
+        batch_topics = [shared(topic) for topic in batch_topics]
+    # Acknowledgements reach every process, so each one's delivery cursors stay current
+    return [shared("gps/+/boot"), shared("live/gps/+"), "gps/+/notifications/ack"] + batch_topics
 
 def on_disconnect(client, userdata, rc):
-    print("❌ MQTT client disconnected" if rc != 0 else "✅ MQTT client disconnected")
+    log.error("❌ MQTT client disconnected" if rc != 0 else "✅ MQTT client disconnected")
+
+# Set once this process ingests MQTT (start_mqtt, or async_ingest); gunicorn's web dyno never does
+ingest_running = threading.Event()
+
+def ingest_status(view):
+    """Routes reporting this process's ingest pipeline, which the web dyno does not run"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ingest_running.is_set():
+            return json.dumps({"error": "this process does not ingest MQTT; query an ingest process's "
+                                        "INGEST_STATUS_PORT (see ingest.py)"}), 404
+        return view(*args, **kwargs)
+    return wrapper
 
 def start_mqtt():
+    ingest_running.set()
     try:
         mqtt_client.on_connect = on_connect
         mqtt_client.on_disconnect = on_disconnect
-        mqtt_client.connect("broker.hivemq.com", 1883, 60)
+        recover_sessions()
+        message_dispatcher.start()
+        # The network loop keeps retrying when the broker is not reachable yet
+        mqtt_client.connect_async(MQTT_HOST, MQTT_PORT, 60)
         mqtt_client.loop_start()
-        threading.Thread(target=cleanup_old_sessions, daemon=True).start()
+        threading.Thread(target=cleanup_old_sessions, name="session-cleanup", daemon=True).start()
+        threading.Thread(target=release_parked_messages, name="admission", daemon=True).start()
     except Exception as e:
-        print(f"❌ MQTT connection failed: {e}")
+        log.error(f"❌ MQTT connection failed: {e}")
+    try:
+        db_pool.warm()
+        ensure_schema()
+    except Exception as e:
+        log.error(f"❌ Database pool warm-up failed: {e}")
+    reference_data.start()
+    notification_feed.start()
 
 @app.route('/')
 def home():
-    logs_html = "<br>".join(list(logs_buffer)[-50:])  # last 50 logs
+    """Recent logs; ?level=WARNING, ?device=<id> and ?limit=<n> filter them"""
+    level = request.args.get('level', 'INFO').upper()
+    min_level = logging.getLevelName(level)
+    if not isinstance(min_level, int):
+        level, min_level = "INFO", logging.INFO
+    device = request.args.get('device') or None
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    entries = log_ring.query(min_level, device, limit)
+    logs_html = "<br>".join(
+        html.escape(f"{datetime.fromtimestamp(e.created, PKT).strftime('%H:%M:%S')} "
+                    f"{logging.getLevelName(e.level)} {e.message}")
+        for e in entries)
+    log_stats = logs.log_system.stats()
     return f"""
     <h2>✅ MQTT Server Running</h2>
     <p>Active Sessions: {len(data_sessions)}</p>
-    <h3>📜 Recent Logs:</h3>
+    <h3>📜 Recent Logs ({html.escape(level)}{f", device {html.escape(device)}" if device else ""}):</h3>
+    <p>{log_stats["point_lines_suppressed"]} point lines suppressed, {log_stats["dropped_queue_full"]} dropped</p>
     <div style="font-family: monospace; background:#111; color:#0f0; padding:10px; border-radius:8px; max-height:400px; overflow-y:auto;">
         {logs_html}
     </div>
     """
 
 @app.route('/sessions')
+@ingest_status
 def sessions():
     return json.dumps({
         "active_sessions": len(data_sessions),
+        "buffers": data_sessions.stats(),
+        "spool": session_spool.stats() if session_spool else None,
         "sessions": {
             k: {
-                "start_time": v["start_time"].isoformat(),
-                "points_count": len(v["points"]),
-                "complete": v["complete"]
+                "start_time": v.start_time.isoformat(),
+                "points_count": len(v),
+                "bytes": v.nbytes(),
+                "complete": v.complete,
+                "overflowed": v.overflowed,
+                "streamed_points": v.stream.processed if v.stream is not None else None
             } for k, v in data_sessions.items()
         }
     }, indent=2)
@@ -832,12 +1381,9 @@ def sessions():
 @app.route('/drivers')
 def drivers():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, rank, army_number, unit FROM drivers")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with db_pool.cursor() as cursor:
+            cursor.execute("SELECT id, name, rank, army_number, unit FROM drivers")
+            rows = cursor.fetchall()
         drivers = [{"id": r.id, "name": r.name, "rank": r.rank, "army_number": r.army_number, "unit": r.unit} for r in
                    rows]
         return json.dumps({"drivers": drivers}, indent=2)
@@ -847,12 +1393,9 @@ def drivers():
 @app.route('/vehicles')
 def vehicles():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, ba_number, make, type, model, total_milage, unit FROM vehicles")
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        with db_pool.cursor() as cursor:
+            cursor.execute("SELECT id, ba_number, make, type, model, total_milage, unit FROM vehicles")
+            rows = cursor.fetchall()
         vehicles = [{
             "id": r.id, "ba_number": r.ba_number, "make": r.make, "type": r.type,
             "model": r.model, "total_mileage": r.total_milage, "unit": r.unit
@@ -862,37 +1405,284 @@ def vehicles():
         return json.dumps({"error": str(e)})
 
 @app.route('/mqtt_status')
+@ingest_status
 def mqtt_status():
     return json.dumps({
         "mqtt_connected": mqtt_client.is_connected(),
+        "client_id": MQTT_CLIENT_ID,
+        "subscriptions": ingest_subscriptions(),
+        "batch_routing": INGEST_BATCH_ROUTING,
+        "shard": f"{INGEST_SHARD_INDEX + 1}/{INGEST_SHARDS}",
+        "messages_not_owned": ingest_stats["not_owned"],
+        "admission": admission.stats(),
         "active_sessions": len(data_sessions),
         "server_time": datetime.now().isoformat()
     }, indent=2)
 
+def register_gauges():
+    """In-memory sizes read when /metrics is scraped"""
+    metrics.registry.gauge("batch_sessions", "Batch sessions in memory", lambda: len(data_sessions))
+    metrics.registry.gauge("batch_buffered_points", "Points buffered in batch sessions",
+                           lambda: data_sessions.stats()["buffered_points"])
+    metrics.registry.gauge("road_cache_entries", "Road types cached in memory", lambda: len(road_type_cache))
+    metrics.registry.gauge("live_buffer_depth", "Live points waiting for the write-behind flush",
+                           lambda: live_buffer.depth())
+    metrics.registry.gauge("dispatch_queue_depth", "MQTT messages queued for the workers",
+                           lambda: message_dispatcher.depth())
+    metrics.registry.gauge("ingest_pressure", "Fill level used by admission control", ingest_pressure)
+    metrics.registry.gauge("confirmations_awaiting_ack", "QoS 1 publishes without a PUBACK yet",
+                           lambda: len(pending_publishes))
+    metrics.registry.gauge("notifications_pending", "Notifications not acknowledged by their devices",
+                           notification_feed.pending_count)
+    metrics.registry.gauge("db_pool_connections", "Postgres pool connections",
+                           lambda: {k: v for k, v in db_pool.stats().items() if k in ("size", "idle", "in_use")},
+                           label="state")
+
+register_gauges()
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+sampling_profiler = SamplingProfiler(max_seconds=float(os.getenv("PROFILE_MAX_SECONDS", "60")))
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample every thread for ?seconds= (default 10) at ?hz= (default 200).
+
+    ?format=collapsed (default) returns flamegraph-ready collapsed stacks, ?format=json a
+    per-thread breakdown.  Disabled unless PROFILE_TOKEN is set; send it as X-Profile-Token.
+    Keep seconds under the gunicorn worker timeout when profiling the web process.
+    """
+    if not PROFILE_TOKEN:
+        return json.dumps({"error": "profiling is disabled"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode(), PROFILE_TOKEN.encode()):
+        return json.dumps({"error": "unauthorized"}), 401
+    seconds = request.args.get('seconds', 10.0, type=float)
+    hz = request.args.get('hz', 200.0, type=float)
+    fmt = request.args.get('format', 'collapsed')
+    if not (0 < seconds and 0 < hz <= 1000) or fmt not in ('collapsed', 'json'):
+        return json.dumps({"error": "need seconds > 0, 0 < hz <= 1000 and format collapsed or json"}), 400
+
+    try:
+        # The request thread only waits for the sampler, so it is left out of the profile
+        profile = sampling_profiler.run(seconds, 1.0 / hz, exclude=(threading.get_ident(),))
+    except ProfilerBusy as e:
+        return json.dumps({"error": str(e)}), 409
+    log.info(f"🔬 Profiled {profile.samples} samples over {profile.duration:.1f}s")
+
+    if fmt == 'json':
+        return json.dumps(profile.summary(), indent=2)
+    filename = f"profile-{datetime.now(PKT).strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return profile.collapsed(), 200, {"Content-Type": "text/plain; charset=utf-8",
+                                      "Content-Disposition": f"attachment; filename={filename}"}
+
+@app.route('/dispatch')
+@ingest_status
+def dispatch_status():
+    status = message_dispatcher.stats()
+    status["confirmations"] = publish_status()
+    return json.dumps(status, indent=2)
+
+@app.route('/db_pool')
+def db_pool_status():
+    return json.dumps(db_pool.stats(), indent=2)
+
+@app.route('/road_cache')
+def road_cache_status():
+    return json.dumps(road_type_cache.stats(), indent=2)
+
+@app.route('/reference_cache')
+def reference_cache_status():
+    return json.dumps(reference_data.stats(), indent=2)
+
+NOTIFICATION_TOKEN = os.getenv("NOTIFICATION_TOKEN", "")
+
+@app.route('/notifications', methods=['GET', 'POST'])
+def notifications():
+    """Feed status; POST {"message": ..., "vehicle_id": ...} or {"message": ..., "unit": ...} adds one.
+
+    POST is disabled unless NOTIFICATION_TOKEN is set; send it as X-Notification-Token.
+    """
+    if request.method == 'GET':
+        return json.dumps(notification_feed.stats(), indent=2)
+    if not NOTIFICATION_TOKEN:
+        return json.dumps({"error": "posting notifications is disabled"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Notification-Token', '').encode(), NOTIFICATION_TOKEN.encode()):
+        return json.dumps({"error": "unauthorized"}), 401
+    body = request.get_json(silent=True) or {}
+    message = str(body.get('message', '')).strip()
+    if not message or ('vehicle_id' in body) == ('unit' in body):
+        return json.dumps({"error": "need a message and either vehicle_id or unit"}), 400
+    try:
+        # The web dyno never connects to the broker: it only inserts, the ingest processes deliver
+        vehicles = notification_feed.post(message, vehicle_id=body.get('vehicle_id'), unit=body.get('unit'),
+                                          push=mqtt_client.is_connected())
+    except Exception as e:
+        log.error(f"❌ Error adding notification: {e}")
+        return json.dumps({"error": str(e)}), 500
+    return json.dumps({"inserted": len(vehicles), "vehicles": vehicles})
+
+@app.route('/live_buffer')
+@ingest_status
+def live_buffer_status():
+    return json.dumps(live_buffer.stats(), indent=2)
+
+@app.route('/positions')
+def positions():
+    """Latest position per device; ?bbox=min_lat,min_lon,max_lat,max_lon and ?since=<version> filter it.
+
+    Versions are counted per process: a client that uses ?since= should keep talking to
+    the same process (the web dyno runs one gunicorn worker by default).
+    """
+    try:
+        bbox = request.args.get('bbox')
+        if bbox:
+            bbox = tuple(float(v) for v in bbox.split(','))
+            if len(bbox) != 4:
+                raise ValueError("bbox needs min_lat,min_lon,max_lat,max_lon")
+        since = request.args.get('since', type=int)
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+
+    position_sync.sync()
+    version, found = latest_positions.query(bbox=bbox or None, since=since)
+    return json.dumps({
+        "version": version,
+        "since": since,
+        "count": len(found),
+        "positions": found
+    })
+
+UPLOAD_TOKEN = os.getenv("UPLOAD_TOKEN", "")
+UPLOAD_CHUNK_POINTS = int(os.getenv("UPLOAD_CHUNK_POINTS", "5000"))
+UPLOAD_ERROR_SAMPLES = 20
+
+@app.route('/upload/<device_id>/<driver_id>', methods=['POST'])
+def upload_trip(device_id, driver_id):
+    """Backfill a trip from an NDJSON or CSV body (optionally gzip-compressed), read as a stream.
+
+    Points go through the same validation, distance, event and insert steps as a batch
+    session, in chunks of UPLOAD_CHUNK_POINTS, so memory stays flat for any file size.
+    ?format=csv|ndjson overrides detection from the Content-Type and the body.
+    Disabled unless UPLOAD_TOKEN is set; send it as X-Upload-Token.
+
+    The whole upload runs in one gunicorn sync worker, so the Procfile's --timeout
+    bounds its size; split trips that take longer to stream into several uploads.
+
+    Mileage is credited only when the whole body was read and stored.  After any failure
+    (unreadable body, dropped connection, worker timeout, database error) the client
+    resends the whole upload: chunks already committed are skipped by the unique indexes
+    and the trip's distance is credited once, by the upload that completes.
+    """
+    if not UPLOAD_TOKEN:
+        return json.dumps({"error": "bulk upload is disabled"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Upload-Token', '').encode(), UPLOAD_TOKEN.encode()):
+        return json.dumps({"error": "unauthorized"}), 401
+    if not verify_device_exists(device_id):
+        return json.dumps({"error": "error_invalid_device"}), 404
+    if not verify_driver_exists(driver_id):
+        return json.dumps({"error": "error_invalid_driver"}), 404
+    schema = ensure_schema()
+    if not (schema.get("gpsdata_unique") and schema.get("events_unique")):
+        return json.dumps({"error": "bulk upload needs the GPSData and events unique indexes"}), 503
+
+    started = time.monotonic()
+    session = BatchSession(f"upload_{device_id}_{driver_id}", device_id, driver_id, deadline=float('inf'))
+    stream = session.stream = TripStream(harsh_event_profile, UPLOAD_CHUNK_POINTS)
+    received = invalid = last_line = 0
+    errors = []
+    fmt = None
+
+    def result(status, code):
+        accepted = stream.dropped + len(session)
+        elapsed = time.monotonic() - started
+        return json.dumps({
+            "status": status,
+            "device_id": device_id,
+            "driver_id": driver_id,
+            "format": fmt,
+            "points_received": received,
+            "points_invalid": invalid,
+            "points_accepted": accepted,
+            "points_written": stream.dropped + stream.processed,
+            "inserted": stream.inserted,
+            "duplicates": stream.dropped + stream.processed - stream.inserted,
+            "events_inserted": stream.sink.inserted,
+            "events_duplicate": stream.sink.duplicates,
+            "distance_km": round(stream.distance_km(), 3),
+            "chunks": stream.chunks,
+            "elapsed_seconds": round(elapsed, 3),
+            "points_per_second": round(received / elapsed, 1) if elapsed > 0 else None,
+            "errors": errors,
+        }), code
+
+    try:
+        body = bulk_upload.open_body(request.stream, request.headers.get('Content-Encoding'))
+        fmt = request.args.get('format') or bulk_upload.detect_format(body, request.content_type)
+        for line_number, point in bulk_upload.iter_points(body, fmt):
+            received += 1
+            last_line = line_number
+            if point is None:
+                is_valid, error_msg = False, "Unparseable line"
+            else:
+                point['device_id'] = device_id
+                point['driver_id'] = driver_id
+                is_valid, error_msg = validate_batch_gps_data(point)
+            if not is_valid:
+                invalid += 1
+                if len(errors) < UPLOAD_ERROR_SAMPLES:
+                    errors.append({"line": line_number, "error": error_msg})
+                continue
+
+            time_stamp = point['time']
+            if 'T' in time_stamp or 'Z' in time_stamp:
+                time_stamp = convert_to_pkt(time_stamp)
+            session.append(time_stamp, float(point['lat']), float(point['lon']), float(point['speed']))
+
+            if stream.ready(session):
+                if not advance_batch_stream(session):
+                    return result("error_database", 500)
+                stream.compact(session)
+    except bulk_upload.UploadError as e:
+        # Nothing is credited: the client resends the whole upload (see the docstring)
+        errors.append({"line": last_line + 1, "error": str(e),
+                       "note": "no mileage was credited; resend the whole upload, stored points are skipped"})
+        return result("error_invalid_upload", 400)
+
+    if not advance_batch_stream(session, final=True):
+        return result("error_database", 500)
+    if stream.dropped + len(session) == 0:
+        return result("error_no_valid_points", 422)
+
+    distance_traveled = stream.distance_km()
+    if distance_traveled > 0:
+        update_vehicle_mileage(device_id, distance_traveled)
+    log.info(f"✅ Bulk upload for {device_id} - {driver_id}: {stream.dropped + len(session)} points, "
+             f"{stream.inserted} inserted, {distance_traveled:.2f} km, {invalid} invalid lines")
+    return result("success", 200)
+
 @app.route('/live_data_stats')
 def live_data_stats():
     """New endpoint to check live GPS data statistics"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Get count of GPS data from today
-        cursor.execute("""
-            SELECT COUNT(*) FROM GPSData_live 
-            WHERE CAST(timestamp AS DATE) = CAST(GETDATE() AS DATE)
-        """)
-        today_count = cursor.fetchone()[0]
-
-        # Get latest GPS data
-        cursor.execute("""
-            SELECT TOP 10 vehicle_id, driver_id, timestamp, lat, lon, speed 
-            FROM GPSData_live 
-            ORDER BY timestamp DESC
-        """)
-        latest_data = cursor.fetchall()
+        with db_pool.cursor() as cursor:
+            # Get count of GPS data from today
+            cursor.execute("""
+                SELECT COUNT(*) FROM GPSData_live 
+                WHERE CAST(timestamp AS DATE) = CURRENT_DATE
+            """)
+            today_count = cursor.fetchone()[0]
 
-        cursor.close()
-        conn.close()
+            # Get latest GPS data
+            cursor.execute("""
+                SELECT vehicle_id, driver_id, timestamp, lat, lon, speed 
+                FROM GPSData_live 
+                ORDER BY timestamp DESC
+                LIMIT 10
+            """)
+            latest_data = cursor.fetchall()
 
         return json.dumps({
             "today_gps_points": today_count,
@@ -913,8 +1703,8 @@ def live_data_stats():
 
 
 if __name__ == '__main__':
-    print("🚀 Starting MQTT GPS Server with Live Data Support...")
+    log.info("🚀 Starting MQTT GPS Server with Live Data Support...")
     start_mqtt()
-    print("🌐 Starting Flask web server...")
+    log.info("🌐 Starting Flask web server...")
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
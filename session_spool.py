@@ -0,0 +1,311 @@
+"""Append-only on-disk log of in-flight batch sessions.
+
+Every batch point is appended to a per-session file through a memory map, and the
+map is msync'ed every `sync_every` records or `sync_interval` seconds.  After a
+crash or worker recycle, recover() replays the files so the sessions can be rebuilt
+before devices send their END marker.
+
+File layout: header (magic, version, JSON length, JSON metadata) followed by records
+of [type u8][payload length u16][payload][crc32 u32].  The unused tail of the file is
+zero-filled, and a zero type byte marks the end of the log.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"GPSSPOOL"
+VERSION = 1
+HEADER = struct.Struct("<8sBI")
+RECORD_HEAD = struct.Struct("<BH")
+CRC = struct.Struct("<I")
+REGULAR = 1  # payload: epoch, lat, lon, speed
+IRREGULAR = 2  # payload: lat, lon, speed, then the raw timestamp as UTF-8
+CHUNK = 3  # payload: seq, point count; the chunk's REGULAR records follow
+REGULAR_PAYLOAD = struct.Struct("<qddd")
+IRREGULAR_PAYLOAD = struct.Struct("<ddd")
+CHUNK_PAYLOAD = struct.Struct("<II")
+# REGULAR records laid out as one NumPy row each, for writing a whole chunk at once
+REGULAR_RECORD = np.dtype([("kind", "u1"), ("length", "<u2"), ("epoch", "<i8"), ("lat", "<f8"),
+                           ("lon", "<f8"), ("speed", "<f8"), ("crc", "<u4")])
+
+
+class _SpoolFile:
+    __slots__ = ("path", "fd", "mm", "size", "offset", "pending", "last_sync")
+
+
+class RecoveredSession:
+    """Columns of a session read back from its spool file"""
+    __slots__ = ("key", "device_id", "driver_id", "started_at", "epochs", "lats", "lons", "speeds",
+                 "irregular", "upload_id", "chunk_seq", "torn")
+
+    def __len__(self):
+        return len(self.epochs)
+
+
+class SessionSpool:
+    def __init__(self, directory, sync_every=64, sync_interval=0.2, chunk_bytes=1 << 20):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.chunk_bytes = chunk_bytes
+        self._lock = threading.Lock()
+        self._files = {}
+        self._appended = 0
+        self._syncs = 0
+        self._recovered_sessions = 0
+        self._recovered_points = 0
+        self._recovery_ms = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.encode("utf-8").hex() + ".spool")
+
+    # ------------------ writing ------------------
+
+    def _map(self, spool, size):
+        os.ftruncate(spool.fd, size)
+        spool.mm = mmap.mmap(spool.fd, size)
+        spool.size = size
+
+    def open(self, key, device_id, driver_id, started_at=None, upload_id=None):
+        """Start a fresh spool file for key, discarding any previous one"""
+        self.remove(key)
+        meta = json.dumps({"key": key, "device_id": device_id, "driver_id": driver_id,
+                           "started_at": started_at or time.time(), "upload_id": upload_id}).encode("utf-8")
+        spool = _SpoolFile()
+        spool.path = self._path(key)
+        spool.fd = os.open(spool.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._map(spool, self.chunk_bytes)
+        header = HEADER.pack(MAGIC, VERSION, len(meta)) + meta
+        spool.mm[:len(header)] = header
+        spool.offset = len(header)
+        spool.pending = 0
+        spool.last_sync = time.monotonic()
+        spool.mm.flush()
+        with self._lock:
+            self._files[key] = spool
+
+    def append(self, key, epoch, raw_timestamp, lat, lon, speed):
+        """Log one point; epoch is None when the timestamp is kept as raw text"""
+        if epoch is None:
+            payload = IRREGULAR_PAYLOAD.pack(lat, lon, speed) + raw_timestamp.encode("utf-8")
+            kind = IRREGULAR
+        else:
+            payload = REGULAR_PAYLOAD.pack(epoch, lat, lon, speed)
+            kind = REGULAR
+        record = RECORD_HEAD.pack(kind, len(payload)) + payload
+        record += CRC.pack(zlib.crc32(record))
+        return self._write(key, record, 1)
+
+    def append_chunk(self, key, seq, epochs, lats, lons, speeds):
+        """Log a whole compact chunk; replay drops it unless every point made it to disk"""
+        marker = RECORD_HEAD.pack(CHUNK, CHUNK_PAYLOAD.size) + CHUNK_PAYLOAD.pack(seq, len(epochs))
+        marker += CRC.pack(zlib.crc32(marker))
+
+        records = np.empty(len(epochs), dtype=REGULAR_RECORD)
+        records["kind"] = REGULAR
+        records["length"] = REGULAR_PAYLOAD.size
+        records["epoch"] = epochs
+        records["lat"] = lats
+        records["lon"] = lons
+        records["speed"] = speeds
+        view = memoryview(records.view(np.uint8))
+        covered = REGULAR_RECORD.itemsize - CRC.size
+        records["crc"] = [zlib.crc32(view[i * REGULAR_RECORD.itemsize:i * REGULAR_RECORD.itemsize + covered])
+                          for i in range(len(records))]
+        return self._write(key, marker + records.tobytes(), len(records) + 1)
+
+    def _write(self, key, record, count):
+        with self._lock:
+            spool = self._files.get(key)
+            if spool is None:
+                return False
+            end = spool.offset + len(record)
+            if end + 1 > spool.size:
+                spool.mm.flush()
+                spool.mm.close()
+                self._map(spool, spool.size + max(self.chunk_bytes, len(record)))
+            spool.mm[spool.offset:end] = record
+            spool.offset = end
+            spool.pending += count
+            self._appended += count
+            if spool.pending >= self.sync_every or time.monotonic() - spool.last_sync >= self.sync_interval:
+                self._sync(spool)
+        return True
+
+    def _sync(self, spool):
+        spool.mm.flush()
+        spool.pending = 0
+        spool.last_sync = time.monotonic()
+        self._syncs += 1
+
+    def sync(self, key=None):
+        """Flush pending records of one session, or of all sessions"""
+        with self._lock:
+            spools = [self._files[key]] if key in self._files else [] if key else list(self._files.values())
+            for spool in spools:
+                if spool.pending:
+                    self._sync(spool)
+
+    def remove(self, key):
+        """Close and delete the spool file of a session that no longer needs recovery"""
+        with self._lock:
+            spool = self._files.pop(key, None)
+        if spool is not None:
+            spool.mm.close()
+            os.close(spool.fd)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self._lock:
+            spools = list(self._files.values())
+            self._files.clear()
+        for spool in spools:
+            spool.mm.flush()
+            spool.mm.close()
+            os.close(spool.fd)
+
+    # ------------------ recovery ------------------
+
+    def recover(self):
+        """Replay every spool file and reopen it for appending; returns RecoveredSession objects"""
+        started = time.monotonic()
+        recovered = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".spool"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                session, spool = self._replay(path)
+            except (OSError, ValueError) as e:
+                log.warning(f"⚠️ Discarding unreadable spool file {name}: {e}")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            with self._lock:
+                self._files[session.key] = spool
+            recovered.append(session)
+
+        with self._lock:
+            self._recovered_sessions += len(recovered)
+            self._recovered_points += sum(len(s) for s in recovered)
+            self._recovery_ms = round((time.monotonic() - started) * 1000, 2)
+        return recovered
+
+    def _replay(self, path):
+        spool = _SpoolFile()
+        spool.path = path
+        spool.fd = os.open(path, os.O_RDWR)
+        try:
+            size = os.fstat(spool.fd).st_size
+            if size < HEADER.size:
+                raise ValueError("truncated header")
+            spool.mm = mmap.mmap(spool.fd, size)
+            spool.size = size
+            mm = spool.mm
+            magic, version, meta_len = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("not a session spool file")
+            meta = json.loads(bytes(mm[HEADER.size:HEADER.size + meta_len]).decode("utf-8"))
+
+            session = RecoveredSession()
+            session.key = meta["key"]
+            session.device_id = meta["device_id"]
+            session.driver_id = meta["driver_id"]
+            session.started_at = meta["started_at"]
+            session.epochs = array('q')
+            session.lats = array('d')
+            session.lons = array('d')
+            session.speeds = array('d')
+            session.irregular = None
+            session.upload_id = meta.get("upload_id")
+            session.chunk_seq = -1
+            session.torn = False
+            chunk = None  # (seq, first point, end point, marker offset) of a chunk still being read
+
+            offset = HEADER.size + meta_len
+            head_size, crc_size = RECORD_HEAD.size, CRC.size
+            while offset + head_size <= size:
+                kind, length = RECORD_HEAD.unpack_from(mm, offset)
+                end = offset + head_size + length
+                if kind == 0 or end + crc_size > size:
+                    break
+                if CRC.unpack_from(mm, end)[0] != zlib.crc32(mm[offset:end]):
+                    session.torn = True
+                    break
+                body = offset + head_size
+                if kind == REGULAR:
+                    epoch, lat, lon, speed = REGULAR_PAYLOAD.unpack_from(mm, body)
+                elif kind == IRREGULAR:
+                    lat, lon, speed = IRREGULAR_PAYLOAD.unpack_from(mm, body)
+                    if session.irregular is None:
+                        session.irregular = {}
+                    session.irregular[len(session.epochs)] = bytes(
+                        mm[body + IRREGULAR_PAYLOAD.size:end]).decode("utf-8")
+                    epoch = 0
+                elif kind == CHUNK:
+                    if chunk is not None:
+                        break
+                    seq, count = CHUNK_PAYLOAD.unpack_from(mm, body)
+                    chunk = (seq, len(session.epochs), len(session.epochs) + count, offset)
+                    offset = end + crc_size
+                    if count == 0:
+                        session.chunk_seq, chunk = seq, None
+                    continue
+                else:
+                    session.torn = True
+                    break
+                session.epochs.append(epoch)
+                session.lats.append(lat)
+                session.lons.append(lon)
+                session.speeds.append(speed)
+                offset = end + crc_size
+                if chunk is not None and len(session.epochs) == chunk[2]:
+                    session.chunk_seq, chunk = chunk[0], None
+
+            if chunk is not None:
+                # Only part of the last chunk reached the disk: drop it so the device's re-send applies cleanly
+                session.torn = True
+                for column in (session.epochs, session.lats, session.lons, session.speeds):
+                    del column[chunk[1]:]
+                offset = chunk[3]
+
+            # Clear anything after the last good record so new appends start on a clean tail
+            if offset < size:
+                mm[offset:size] = bytes(size - offset)
+            spool.offset = offset
+            spool.pending = 0
+            spool.last_sync = time.monotonic()
+            return session, spool
+        except Exception:
+            if getattr(spool, "mm", None) is not None:
+                spool.mm.close()
+            os.close(spool.fd)
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "open_files": len(self._files),
+                "appended_records": self._appended,
+                "syncs": self._syncs,
+                "recovered_sessions": self._recovered_sessions,
+                "recovered_points": self._recovered_points,
+                "recovery_ms": self._recovery_ms,
+            }
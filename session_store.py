@@ -0,0 +1,228 @@
+import heapq
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+POINT_BYTES = 8 * 4  # epoch + lat + lon + speed
+
+
+def parse_timestamp(timestamp):
+    """Epoch seconds of a 'YYYY-MM-DD HH:MM:SS' wall-clock string, or None if it is not in that form"""
+    if len(timestamp) != 19 or timestamp[4] != '-' or timestamp[10] != ' ':
+        return None
+    try:
+        dt = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def format_timestamp(epoch):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+class BatchSession:
+    """Points of one START..END batch upload, stored column-wise in typed arrays"""
+    __slots__ = ("key", "device_id", "driver_id", "start_time", "deadline", "seq", "complete", "overflowed",
+                 "epochs", "lats", "lons", "speeds", "irregular", "stream", "upload_id", "chunk_seq")
+
+    def __init__(self, key, device_id, driver_id, deadline, seq=0, upload_id=None):
+        self.key = key
+        self.device_id = device_id
+        self.driver_id = driver_id
+        self.start_time = datetime.now()
+        self.deadline = deadline
+        self.seq = seq
+        self.complete = False
+        self.overflowed = False
+        self.epochs = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.speeds = array('d')
+        self.irregular = None  # index -> original timestamp that does not round-trip through epochs
+        self.stream = None  # TripStream while the session is processed incrementally
+        self.upload_id = upload_id  # set for sessions uploaded as compact chunks
+        self.chunk_seq = -1  # last chunk applied
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def append(self, timestamp, lat, lon, speed):
+        epoch = parse_timestamp(timestamp)
+        if epoch is None:
+            if self.irregular is None:
+                self.irregular = {}
+            self.irregular[len(self.epochs)] = timestamp
+            epoch = 0
+        self.epochs.append(epoch)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.speeds.append(speed)
+
+    def extend(self, epochs, lats, lons, speeds):
+        """Append whole columns (int64 epochs, float64 coordinates and speeds)"""
+        self.epochs.frombytes(epochs.astype('<i8', copy=False).tobytes())
+        self.lats.frombytes(lats.astype('<f8', copy=False).tobytes())
+        self.lons.frombytes(lons.astype('<f8', copy=False).tobytes())
+        self.speeds.frombytes(speeds.astype('<f8', copy=False).tobytes())
+
+    def timestamp(self, i):
+        if self.irregular and i in self.irregular:
+            return self.irregular[i]
+        return format_timestamp(self.epochs[i])
+
+    def points(self):
+        """The session as the list of point dicts the batch pipeline consumes"""
+        return [{'timestamp': self.timestamp(i), 'lat': self.lats[i], 'lon': self.lons[i], 'speed': self.speeds[i]}
+                for i in range(len(self.epochs))]
+
+    def nbytes(self):
+        """Memory actually held by the point buffers"""
+        size = sum(sys.getsizeof(column) for column in (self.epochs, self.lats, self.lons, self.speeds))
+        if self.irregular:
+            size += sys.getsizeof(self.irregular) + sum(sys.getsizeof(t) for t in self.irregular.values())
+        return size
+
+
+class SessionStore:
+    """Active batch sessions with memory caps and deadline-ordered expiry.
+
+    Expiry deadlines live in a heap, so the expiry thread sleeps until the next
+    session is due instead of scanning every session on a fixed interval.
+    """
+
+    def __init__(self, ttl=3600.0, max_session_bytes=16 * 1024 * 1024, max_total_bytes=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self._cond = threading.Condition(threading.Lock())
+        self._sessions = {}
+        self._deadlines = []  # heap of (deadline, key, session seq)
+        self._seq = 0
+        self._points = 0
+        self._rejected_points = 0
+        self._expired = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+    def get(self, key):
+        return self._sessions.get(key)
+
+    def items(self):
+        with self._cond:
+            return list(self._sessions.items())
+
+    def start(self, key, device_id, driver_id, upload_id=None):
+        """Open a fresh session for key, replacing any previous one"""
+        with self._cond:
+            self._seq += 1
+            session = BatchSession(key, device_id, driver_id, time.time() + self.ttl, self._seq, upload_id)
+            old = self._sessions.pop(key, None)
+            if old is not None:
+                self._points -= len(old)
+            self._sessions[key] = session
+            first = not self._deadlines or session.deadline < self._deadlines[0][0]
+            heapq.heappush(self._deadlines, (session.deadline, key, session.seq))
+            if first:
+                self._cond.notify()
+        return session
+
+    def restore(self, key, device_id, driver_id, started_at, epochs, lats, lons, speeds, irregular=None,
+                upload_id=None, chunk_seq=-1):
+        """Rebuild a session from recovered columns; its deadline counts from the original start"""
+        with self._cond:
+            self._seq += 1
+            session = BatchSession(key, device_id, driver_id, started_at + self.ttl, self._seq, upload_id)
+            session.chunk_seq = chunk_seq
+            session.start_time = datetime.fromtimestamp(started_at)
+            session.epochs, session.lats, session.lons, session.speeds = epochs, lats, lons, speeds
+            session.irregular = irregular or None
+            if len(session) * POINT_BYTES > self.max_session_bytes or \
+                    (self._points + len(session)) * POINT_BYTES > self.max_total_bytes:
+                session.overflowed = True
+            old = self._sessions.pop(key, None)
+            if old is not None:
+                self._points -= len(old)
+            self._points += len(session)
+            self._sessions[key] = session
+            heapq.heappush(self._deadlines, (session.deadline, key, session.seq))
+            self._cond.notify()
+        return session
+
+    def add_point(self, session, timestamp, lat, lon, speed):
+        """Append a point unless a memory cap would be exceeded; returns False when it is rejected"""
+        with self._cond:
+            if (len(session) + 1) * POINT_BYTES > self.max_session_bytes or \
+                    (self._points + 1) * POINT_BYTES > self.max_total_bytes:
+                session.overflowed = True
+                self._rejected_points += 1
+                return False
+            self._points += 1
+        session.append(timestamp, lat, lon, speed)
+        return True
+
+    def add_points(self, session, epochs, lats, lons, speeds):
+        """Append a chunk of points as columns; all or nothing under the memory caps"""
+        count = len(epochs)
+        with self._cond:
+            if (len(session) + count) * POINT_BYTES > self.max_session_bytes or \
+                    (self._points + count) * POINT_BYTES > self.max_total_bytes:
+                session.overflowed = True
+                self._rejected_points += count
+                return False
+            self._points += count
+        session.extend(epochs, lats, lons, speeds)
+        return True
+
+    def pop(self, key):
+        with self._cond:
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                self._points -= len(session)
+            return session
+
+    def expire_due(self, now=None):
+        """Drop sessions whose deadline has passed; returns their keys"""
+        now = time.time() if now is None else now
+        expired = []
+        with self._cond:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, key, seq = heapq.heappop(self._deadlines)
+                session = self._sessions.get(key)
+                # Skip heap entries left behind by sessions that already ended or restarted
+                if session is not None and session.seq == seq:
+                    del self._sessions[key]
+                    self._points -= len(session)
+                    self._expired += 1
+                    expired.append(key)
+        return expired
+
+    def wait_for_expiry(self, max_wait=300.0):
+        """Block until the earliest deadline (or max_wait), then expire what is due"""
+        with self._cond:
+            timeout = max_wait
+            if self._deadlines:
+                timeout = min(max_wait, max(0.0, self._deadlines[0][0] - time.time()))
+            if timeout > 0:
+                self._cond.wait(timeout)
+        return self.expire_due()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active_sessions": len(self._sessions),
+                "buffered_points": self._points,
+                "buffered_bytes_estimate": self._points * POINT_BYTES,
+                "max_session_bytes": self.max_session_bytes,
+                "max_total_bytes": self.max_total_bytes,
+                "rejected_points": self._rejected_points,
+                "expired_sessions": self._expired,
+                "ttl_seconds": self.ttl,
+            }
@@ -0,0 +1,127 @@
+"""Incremental processing of a batch session while its points are still arriving.
+
+A point is final once the rolling median around it can no longer change, i.e. once
+`smoothing_window // 2` later points exist (or the session has ended).  Final points
+are handed out in chunks.  Each chunk is evaluated on a slice that also includes
+enough earlier points for the longest harsh-event window and its smoothing, so the
+detections match a whole-trip harsh_events.detect() run exactly.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+import harsh_events
+from event_sink import EventSink
+from geodistance import segment_distances_km
+
+LOOKBACK = 3  # longest harsh-event window, in points
+
+# Points [start, end) of a session with their computed segment distances and harsh events
+StreamChunk = namedtuple("StreamChunk", "start end timestamps lats lons speeds segments harsh")
+
+
+def _column(values, lo, hi):
+    return np.frombuffer(values[lo:hi], dtype=np.float64) if hi > lo else np.zeros(0)
+
+
+class TripStream:
+    """Running distance, harsh-event and row state of one batch session"""
+    __slots__ = ("profile", "chunk_points", "half", "processed", "segments", "seen", "sink", "inserted",
+                 "chunks", "active", "dropped", "distance_base")
+
+    def __init__(self, profile=harsh_events.DEFAULT_PROFILE, chunk_points=250):
+        self.profile = profile
+        self.chunk_points = max(1, chunk_points)
+        self.half = profile.smoothing_window // 2
+        self.processed = 0  # points [0, processed) are written
+        self.segments = []
+        self.seen = set()  # timestamps already written, as gps_point_rows drops repeats
+        self.sink = EventSink()
+        self.inserted = 0
+        self.chunks = 0
+        self.active = True
+        self.dropped = 0  # written points removed from the front of the session by compact()
+        self.distance_base = 0.0  # distance of segments folded away by compact()
+
+    def ready(self, session):
+        return self.active and len(session) - self.processed >= self.chunk_points + self.half
+
+    def distance_km(self):
+        return self.distance_base + (float(np.concatenate(self.segments).sum()) if self.segments else 0.0)
+
+    def _epochs(self, session, lo, hi):
+        epochs = np.frombuffer(session.epochs[lo:hi], dtype=np.int64).astype(np.float64)
+        if session.irregular:
+            for i, timestamp in session.irregular.items():
+                if lo <= i < hi:
+                    epochs[i - lo] = harsh_events.parse_timestamps([timestamp])[0]
+        return epochs
+
+    def take(self, session, final=False):
+        """The next chunk of final points, or None when not enough have arrived"""
+        n = len(session)
+        start = self.processed
+        end = n if final else n - self.half
+        if end <= start or (not final and end - start < self.chunk_points):
+            return None
+
+        # Context: earlier points for the look-back windows and the median around them,
+        # later points so the median at the chunk end is not cut short
+        lo = max(0, start - LOOKBACK - 2 * self.half)
+        hi = n if final else end + self.half
+        # rolling_median leaves trips shorter than the window unsmoothed, so wait for more points
+        if not final and hi - lo < self.profile.smoothing_window:
+            return None
+
+        speeds = _column(session.speeds, lo, hi)
+        events = harsh_events.detect(self._epochs(session, lo, hi), speeds, self.profile)
+        events = events[(events['index'] >= start - lo) & (events['index'] < end - lo)]
+        harsh = [(int(index) + lo, int(event)) for index, event, _ in events]
+
+        first = max(start, 1)
+        segments = segment_distances_km(_column(session.lats, first - 1, end), _column(session.lons, first - 1, end))
+
+        return StreamChunk(
+            start, end,
+            [session.timestamp(i) for i in range(start, end)],
+            _column(session.lats, start, end), _column(session.lons, start, end),
+            speeds[start - lo:end - lo], segments, harsh,
+        )
+
+    def rows(self, chunk, device_id, driver_id):
+        """GPSData rows for a chunk, skipping timestamps an earlier chunk already wrote"""
+        rows = []
+        for timestamp, lat, lon, speed in zip(chunk.timestamps, chunk.lats.tolist(), chunk.lons.tolist(),
+                                              chunk.speeds.tolist()):
+            if timestamp in self.seen:
+                continue
+            self.seen.add(timestamp)
+            rows.append((device_id, driver_id, timestamp, lat, lon, max(0.0, speed)))
+        return rows
+
+    def commit(self, chunk, inserted):
+        """Mark a chunk as written"""
+        self.processed = chunk.end
+        if len(chunk.segments):
+            self.segments.append(chunk.segments)
+        self.inserted += inserted
+        self.chunks += 1
+
+    def compact(self, session):
+        """Drop written points the next chunk no longer needs as context, keeping memory flat.
+
+        Used for uploads that are not spooled or kept for a retry.  Repeated timestamps
+        across compactions are then left to the GPSData unique index.
+        """
+        drop = self.processed - LOOKBACK - 2 * self.half
+        if drop <= 0:
+            return
+        for column in (session.epochs, session.lats, session.lons, session.speeds):
+            del column[:drop]
+        if session.irregular:
+            session.irregular = {i - drop: t for i, t in session.irregular.items() if i >= drop} or None
+        self.processed -= drop
+        self.dropped += drop
+        self.distance_base = self.distance_km()
+        self.segments = []
+        self.seen.clear()